@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+## @package catalog_pages
+# Index page build time against catalog size.
+#
+# For each catalog size a fresh service is filled with that many books and
+# a logged on user requests the first, a middle and the last page of the
+# index through the WSGI application. For comparison, the time to render
+# the whole catalog on one page, as the index did before it was paginated,
+# is shown up to 100000 books.
+#
+# The same user then checks out and purchases a book, which looks the book
+# up by ID, once as is and once right after a change to another book, so
+# that any cache of the catalog would have to be read again.
+#
+# Usage: python catalog_pages.py [sizes] [requests per page]
+# e.g.   python catalog_pages.py 1000,10000,100000,1000000 50
+
+# system modules
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.dont_write_byte_code = True
+
+# local modules
+import threads
+import service
+
+## Largest catalog the whole page is rendered for
+FULL_MAX = 100000
+
+##
+# @brief mean time of a request
+#
+# @return milliseconds
+def timed(client, path, n):
+	start = time.time()
+	for i in xrange(n):
+		(status, data) = client.request('GET', path)
+		assert status.startswith('200'), status
+	return 1e3 * (time.time() - start) / n
+
+##
+# @brief mean time of a checkout and of the purchase that follows it
+#
+# @param client the Client, logged on
+# @param n number of purchases
+# @param write function run before each checkout, or None
+#
+# @return tuple (checkout, purchase) in milliseconds
+def timed_purchase(client, n, write=None):
+	times = [ 0.0, 0.0 ]
+	for i in xrange(n):
+		# a fresh csrf token, not timed
+		(status, data) = client.request('GET', '/')
+		if write is not None:
+			write()
+		start = time.time()
+		(status, data) = client.request('POST', '/checkout', dict(book=threads.BOOK,
+				csrf_token=client.token(data)))
+		checkout = time.time()
+		assert 'Logged in as' in data, status
+		(status, data) = client.request('POST', '/purchase', dict(book=threads.BOOK,
+				name='Catalog Bench', card='1234567812345678', ccv='123',
+				expmonth='1', expyear='30', csrf_token=client.token(data)))
+		assert threads.PRICE in data, status
+		times[0] += checkout - start
+		times[1] += time.time() - checkout
+	return (1e3 * times[0] / n, 1e3 * times[1] / n)
+
+##
+# @brief build a service with a catalog of the given size and time its pages
+#
+# @return tuple (first, middle, last, whole catalog, checkout, purchase,
+# checkout after a write) in milliseconds
+def run(size, n):
+	root = tempfile.mkdtemp()
+	try:
+		with open(os.path.join(root, 'ctf.yaml'), 'w') as f:
+			f.write(threads.CONFIG % dict(threads=1))
+		with open(os.path.join(root, 'ctf.aes'), 'wb') as f:
+			f.write(os.urandom(16))
+		con = sqlite3.connect(os.path.join(root, 'ctf.db'))
+		with open(os.path.join(threads.ROOT, 'init.sql')) as f:
+			con.executescript(f.read())
+		con.commit()
+		con.close()
+		app = service.create_app(os.path.join(root, 'ctf.yaml'), root=root)
+		# fill after the migrations have given Books its ID column
+		con = sqlite3.connect(os.path.join(root, 'ctf.db'))
+		extra = size - con.execute('SELECT COUNT(*) FROM Books').fetchone()[0]
+		con.executemany('INSERT INTO Books(Name, Price) VALUES (?, ?)',
+				(( 'Book number %d' % i, 10 + i % 90, ) for i in xrange(extra)))
+		con.commit()
+		con.close()
+		client = threads.Client(app, 'catalog')
+		if threads.flow(client, 'reader') is not None:
+			raise RuntimeError('failed to log on')
+		first = timed(client, '/', n)
+		middle = timed(client, '/?after=%d' % (size // 2), n)
+		last = timed(client, '/?before=%d' % (size + 1), n)
+		(checkout, purchase) = timed_purchase(client, n)
+		con = sqlite3.connect(os.path.join(root, 'ctf.db'))
+		def write():
+			con.execute('UPDATE Books SET Price=Price+1 WHERE ID=1')
+			con.commit()
+		try:
+			(written, _) = timed_purchase(client, n, write)
+		finally:
+			con.close()
+		full = None
+		if size <= FULL_MAX:
+			# what the index did before: render every book
+			context = service.AppContext(os.path.join(root, 'ctf.yaml'), root=root)
+			d = service.db.DB(context.config.db)
+			# the templates read the csrf token from the request context
+			service.web.ctx.ctf = context
+			service.web.ctx.session_hash = os.urandom(20)
+			service.web.ctx.csrf_client = service.csrf.client_id()
+			start = time.time()
+			books = d.getBooks()
+			unicode(service.render.index_books(books))
+			full = 1e3 * (time.time() - start)
+		return (first, middle, last, full, checkout, purchase, written)
+	finally:
+		shutil.rmtree(root)
+
+def main(argv):
+	sizes = [ int(s) for s in argv[1].split(',') ] if len(argv) > 1 else [ 1000, 10000, 100000, 1000000 ]
+	n = int(argv[2]) if len(argv) > 2 else 50
+	service.captcha.submit = lambda *args: threads.Accepted()
+	print '%10s %10s %10s %10s %12s %12s %12s %14s' % ('books', 'first ms', 'middle ms', 'last ms', 'all rows ms',
+			'checkout ms', 'purchase ms', 'after write ms')
+	for size in sizes:
+		(first, middle, last, full, checkout, purchase, written) = run(size, n)
+		print '%10d %10.2f %10.2f %10.2f %12s %12.2f %12.2f %14.2f' % (size, first, middle, last,
+				'%.1f' % full if full is not None else '-', checkout, purchase, written)
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
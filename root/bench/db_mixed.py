@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+## @package db_mixed
+# Mixed read/write benchmark of db.DB.
+#
+# Threads run a request-like mix of getValidUser, getPrice and getBooks
+# reads with a share of addUser writes against a fresh database. Each run
+# is repeated with SQLite's default pragmas and with the pragmas from
+# ctf-data/ctf.yaml, and with the reads going through web.db.sqlwhere
+# string building (how db.DB ran them before) and through the cached
+# parameterized statements.
+#
+# Usage: python db_mixed.py [threads] [operations per thread] [write percent]
+# e.g.   python db_mixed.py 4 2000 10
+
+# system modules
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import web
+
+sys.dont_write_byte_code = True
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'document-root', 'lib'))
+
+# local modules
+import config
+import db
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PASSWORD = '1234567890abcdef098712345678900987654321'
+BOOK = 'Security Engineering'
+USERS = 1000
+
+##
+# @brief the reads as db.DB ran them before, building the where clause
+# with web.db.sqlwhere on every call
+class SQLWhere:
+	def __init__(self, d):
+		self.d = d
+	def getBooks(self):
+		return self.d.xec.select('Books', what='*')
+	def getPrice(self, book):
+		return self.d.xec.select('Books', what='Price', where=web.db.sqlwhere(dict(Name=book)))[0].Price
+	def getValidUser(self, username, password):
+		where = dict(Username=username, Password=password)
+		return self.d.xec.select('Users', what='GUID', where=web.db.sqlwhere(where))[0].GUID
+
+##
+# @brief run the mix on a fresh database
+#
+# @param pragmas connection pragmas
+# @param reader function returning the object the reads go through
+# @param nthreads number of threads
+# @param nops operations per thread
+# @param writes percentage of writes
+#
+# @return tuple (operations per second, mean read us, mean write us)
+def run(pragmas, reader, nthreads, nops, writes):
+	root = tempfile.mkdtemp()
+	try:
+		path = os.path.join(root, 'ctf.db')
+		con = sqlite3.connect(path)
+		with open(os.path.join(ROOT, 'init.sql')) as f:
+			con.executescript(f.read())
+		con.commit()
+		con.close()
+		d = db.DB(path, pool=nthreads, pragmas=pragmas)
+		for i in xrange(USERS):
+			d.addUser('user%d' % i, PASSWORD)
+		r = reader(d)
+		timings = { 'read': [], 'write': [] }
+		def worker(n):
+			rnd = random.Random(n)
+			reads = []
+			writeops = []
+			for i in xrange(nops):
+				start = time.time()
+				if rnd.randrange(100) < writes:
+					d.addUser('t%d_%d' % (n, i), PASSWORD)
+					writeops.append(time.time() - start)
+					continue
+				op = i % 3
+				if op == 0:
+					r.getValidUser('user%d' % rnd.randrange(USERS), PASSWORD)
+				elif op == 1:
+					r.getPrice(BOOK)
+				else:
+					list(r.getBooks())
+				reads.append(time.time() - start)
+			timings['read'].extend(reads)
+			timings['write'].extend(writeops)
+		threads = [ threading.Thread(target=worker, args=(n,)) for n in range(nthreads) ]
+		start = time.time()
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		elapsed = time.time() - start
+		mean = lambda l: 1e6 * sum(l) / len(l) if l else 0.0
+		return (nthreads * nops / elapsed, mean(timings['read']), mean(timings['write']))
+	finally:
+		shutil.rmtree(root)
+
+def main(argv):
+	nthreads = int(argv[1]) if len(argv) > 1 else 4
+	nops = int(argv[2]) if len(argv) > 2 else 2000
+	writes = int(argv[3]) if len(argv) > 3 else 10
+	c = config.Configurator()
+	c.load(os.path.join(ROOT, 'document-root', 'ctf-data', 'ctf.yaml'))
+	print '%d threads, %d%% writes' % (nthreads, writes)
+	print '%-10s %-10s %10s %10s %10s' % ('pragmas', 'reads', 'ops/s', 'read us', 'write us')
+	for (pname, pragmas) in [ ('default', {}), ('ctf.yaml', c.db_pragmas) ]:
+		for (rname, reader) in [ ('sqlwhere', SQLWhere), ('cached', lambda d: d) ]:
+			(rate, read, write) = run(pragmas, reader, nthreads, nops, writes)
+			print '%-10s %-10s %10.0f %10.1f %10.1f' % (pname, rname, rate, read, write)
+
+if __name__ == '__main__':
+	import logging
+	logging.disable(logging.CRITICAL)
+	sys.exit(main(sys.argv))
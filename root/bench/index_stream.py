@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+## @package index_stream
+# Time to first byte and buffering of the streamed index page.
+#
+# A logged on user requests index pages of growing size through the WSGI
+# application, once streamed in chunks of service.BOOKS_PER_CHUNK books and
+# once with the whole page in one chunk, the way the index was rendered
+# before it was streamed. For each the time to the first book, the total
+# time and the largest piece of the body held at once are shown.
+#
+# Usage: python index_stream.py [page sizes] [requests per size]
+# e.g.   python index_stream.py 50,500,5000 20
+
+# system modules
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.dont_write_byte_code = True
+
+# local modules
+import threads
+import service
+
+##
+# @brief request the first index page repeatedly
+#
+# @return tuple (ms to the first book, total ms, largest chunk in bytes)
+def timed(client, n):
+	first = 0.0
+	total = 0.0
+	largest = 0
+	for i in xrange(n):
+		start = time.time()
+		(status, body) = client.open('GET', '/')
+		assert status.startswith('200'), status
+		seen = False
+		for chunk in body:
+			largest = max(largest, len(chunk))
+			if not seen and 'checkout' in chunk:
+				first += time.time() - start
+				seen = True
+		total += time.time() - start
+	return (1e3 * first / n, 1e3 * total / n, largest)
+
+def main(argv):
+	sizes = [ int(s) for s in argv[1].split(',') ] if len(argv) > 1 else [ 50, 500, 5000 ]
+	n = int(argv[2]) if len(argv) > 2 else 20
+	service.captcha.submit = lambda *args: threads.Accepted()
+	chunk = service.BOOKS_PER_CHUNK
+	root = tempfile.mkdtemp()
+	try:
+		with open(os.path.join(root, 'ctf.yaml'), 'w') as f:
+			f.write(threads.CONFIG % dict(threads=1))
+		with open(os.path.join(root, 'ctf.aes'), 'wb') as f:
+			f.write(os.urandom(16))
+		con = sqlite3.connect(os.path.join(root, 'ctf.db'))
+		with open(os.path.join(threads.ROOT, 'init.sql')) as f:
+			con.executescript(f.read())
+		con.commit()
+		con.close()
+		app = service.create_app(os.path.join(root, 'ctf.yaml'), root=root)
+		con = sqlite3.connect(os.path.join(root, 'ctf.db'))
+		con.executemany('INSERT INTO Books(Name, Price) VALUES (?, ?)',
+				(( 'Book number %d' % i, 10 + i % 90, ) for i in xrange(max(sizes))))
+		con.commit()
+		con.close()
+		client = threads.Client(app, 'stream')
+		if threads.flow(client, 'reader') is not None:
+			raise RuntimeError('failed to log on')
+		print '%8s %-10s %10s %10s %12s' % ('books', 'mode', 'first ms', 'total ms', 'largest B')
+		for size in sizes:
+			service.BOOKS_PER_PAGE = size
+			for (mode, per) in [ ('whole', size), ('streamed', chunk) ]:
+				service.BOOKS_PER_CHUNK = per
+				(first, total, largest) = timed(client, n)
+				print '%8d %-10s %10.2f %10.2f %12d' % (size, mode, first, total, largest)
+	finally:
+		shutil.rmtree(root)
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
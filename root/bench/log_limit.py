@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+## @package log_limit
+# Cost of a logging call that the rate limit suppresses.
+#
+# Times l.warn('Bad password match for user %s', username), the message a
+# logon brute force produces, when it is written to a file, when it is
+# queued for the background writer, when the rate limit of CTFLogger
+# suppresses it, and when its level is disabled, the least a logging call
+# can cost.
+#
+# Usage: python log_limit.py [calls]
+
+# system modules
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.dont_write_byte_code = True
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'document-root', 'lib'))
+
+# local modules
+import log
+
+##
+# @brief time a callable
+#
+# @return microseconds per call, best of three runs
+def usec(f, n):
+	return min(timeit.repeat(f, number=n, repeat=3)) / n * 1e6
+
+def main(argv):
+	n = int(argv[1]) if len(argv) > 1 else 100000
+	root = tempfile.mkdtemp()
+	try:
+		path = os.path.join(root, 'ctf.log')
+		loggers = [
+			( 'written', log.CTFLogger(path, stderr=False), ),
+			( 'queued', log.CTFLogger(path, stderr=False, queue=n, overflow='block'), ),
+			( 'suppressed', log.CTFLogger(path, stderr=False, limit_burst=20, limit_window=3600), ),
+			( 'disabled', log.CTFLogger(path, stderr=False, level=logging.ERROR), ),
+		]
+		print '%-12s %10s' % ('call', 'us/call')
+		for (name, l) in loggers:
+			print '%-12s %10.2f' % (name, usec(lambda: l.warn('Bad password match for user %s', 'admin'), n))
+			for h in l.handlers:
+				h.close()
+	finally:
+		shutil.rmtree(root)
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
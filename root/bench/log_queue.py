@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+## @package log_queue
+# Latency of logging calls with a slow disk.
+#
+# Threads log the messages of a request, then spend a moment on the rest
+# of it, through a CTFLogger whose file stalls every so often, the way a
+# busy disk or a full page cache does. Each run
+# reports the latency of the logging calls as the request threads see it,
+# writing on the logging thread and through log.QueueHandler with either
+# overflow policy, and how many records were dropped.
+#
+# Usage: python log_queue.py [threads] [records per thread] [stall ms]
+# e.g.   python log_queue.py 8 2000 50
+
+# system modules
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.dont_write_byte_code = True
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'document-root', 'lib'))
+
+# local modules
+import log
+
+## One write in this many stalls
+STALL_EVERY = 200
+## Seconds each simulated request spends on other things than logging
+REQUEST_TIME = 0.0002
+
+##
+# @brief file whose writes now and then take a long time
+class StallingFile:
+	def __init__(self, path, stall):
+		self.f = open(path, 'a')
+		self.stall = stall
+		self.writes = 0
+	def write(self, text):
+		self.writes += 1
+		if self.writes % STALL_EVERY == 0:
+			time.sleep(self.stall)
+		self.f.write(text)
+	def flush(self):
+		self.f.flush()
+	def close(self):
+		self.f.close()
+
+##
+# @brief log from a number of threads
+#
+# @param mode 'sync' or an entry of log.OVERFLOW
+#
+# @return tuple (sorted call latencies in seconds, records dropped)
+def run(mode, nthreads, nrecords, stall):
+	root = tempfile.mkdtemp()
+	try:
+		stream = StallingFile(os.path.join(root, 'ctf.log'), stall)
+		h = logging.StreamHandler(stream)
+		h.setFormatter(logging.Formatter(log.LFORMAT, log.DFORMAT))
+		l = log.CTFLogger(stderr=False)
+		if mode == 'sync':
+			l.addHandler(h)
+		else:
+			l.addHandler(log.QueueHandler([ h ], overflow=mode))
+		latencies = []
+		def worker(n):
+			mine = []
+			for i in xrange(nrecords):
+				start = time.time()
+				l.info('GET index')
+				l.debug('Creating new user u%d_%d' % (n, i))
+				mine.append(time.time() - start)
+				time.sleep(REQUEST_TIME)
+			latencies.extend(mine)
+		threads = [ threading.Thread(target=worker, args=(n,)) for n in range(nthreads) ]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		for h in l.handlers:
+			h.close()
+		stream.close()
+		return (sorted(latencies), l.dropped)
+	finally:
+		shutil.rmtree(root)
+
+def main(argv):
+	nthreads = int(argv[1]) if len(argv) > 1 else 8
+	nrecords = int(argv[2]) if len(argv) > 2 else 2000
+	stall = float(argv[3]) / 1e3 if len(argv) > 3 else 0.05
+	print '%d threads, a %.0f ms stall every %d writes' % (nthreads, stall * 1e3, STALL_EVERY)
+	print '%-6s %10s %10s %10s %10s' % ('mode', 'p50 us', 'p99 us', 'max ms', 'dropped')
+	for mode in ( 'sync', ) + log.OVERFLOW:
+		(latencies, dropped) = run(mode, nthreads, nrecords, stall)
+		pct = lambda p: 1e6 * latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+		print '%-6s %10.1f %10.1f %10.1f %10d' % (mode, pct(0.5), pct(0.99), 1e3 * latencies[-1], dropped)
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
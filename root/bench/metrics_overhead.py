@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+## @package metrics_overhead
+# Cost of the request metrics.
+#
+# Times a stage marked with metrics.timer() outside of a request, which is
+# what the hooks in scp, db and sessions cost in tools and tests, and
+# inside one, and the whole instrumentation of a typical request: begin(),
+# the cookie, session, db, db_wait and render stages and end(). Then fills
+# a registry with every route, method and status the service has and times
+# rendering /metrics.
+#
+# Usage: python metrics_overhead.py [calls]
+
+# system modules
+import os
+import sys
+import timeit
+
+sys.dont_write_byte_code = True
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'document-root', 'lib'))
+
+# local modules
+import metrics
+
+ROUTES = ( '/', '/adduser', '/logon', '/logoff', '/checkout', '/purchase', '/search', '/metrics', 'other', )
+STAGES = ( 'cookie', 'session', 'db', 'render', )
+
+##
+# @brief time a callable
+#
+# @return microseconds per call, best of three runs
+def usec(f, n):
+	return min(timeit.repeat(f, number=n, repeat=3)) / n * 1e6
+
+##
+# @brief the instrumentation of one request, without the work it times
+def request(registry, route):
+	metrics.begin()
+	for stage in STAGES:
+		with metrics.timer(stage):
+			if stage == 'db':
+				with metrics.timer('db_wait'):
+					pass
+	metrics.end('GET', route, 200, 0.005, registry=registry)
+
+def main(argv):
+	n = int(argv[1]) if len(argv) > 1 else 100000
+	registry = metrics.Registry()
+	def stage():
+		with metrics.timer('db'):
+			pass
+	print '%-20s %10s' % ('call', 'us/call')
+	print '%-20s %10.2f' % ('timer, no request', usec(stage, n))
+	metrics.begin()
+	print '%-20s %10.2f' % ('timer', usec(stage, n))
+	print '%-20s %10.2f' % ('request', usec(lambda: request(registry, '/'), n))
+	for route in ROUTES:
+		for status in ( 200, 303, 400, 404, 500, ):
+			for method in ( 'GET', 'POST', ):
+				metrics.begin()
+				for name in STAGES:
+					with metrics.timer(name):
+						pass
+				metrics.end(method, route, status, 0.005, registry=registry)
+	text = registry.render()
+	print '%-20s %10.2f' % ('render /metrics', usec(registry.render, max(1, n // 1000)))
+	print '%d lines, %d bytes' % (len(text.splitlines()), len(text))
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+## @package scp_suites
+# Benchmark of cookie verification for each scp cipher suite.
+#
+# The legacy suite is timed both with a cold key cache, which is what
+# every new user or expiration pays, and with a warm one. The first line is
+# the original request path, which called isValid() and then getData().
+#
+# Usage: python scp_suites.py [iterations]
+
+# system modules
+import os
+import sys
+import time
+import timeit
+
+sys.dont_write_byte_code = True
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'document-root', 'lib'))
+
+# local modules
+import scp
+
+##
+# @brief time a callable
+#
+# @param f the function to time
+# @param n number of calls
+#
+# @return microseconds per call, best of three runs
+def usec(f, n):
+	return min(timeit.repeat(f, number=n, repeat=3)) / n * 1e6
+
+def main(argv):
+	n = int(argv[1]) if len(argv) > 1 else 5000
+	secret = os.urandom(16)
+	session = os.urandom(20)
+	user = '0f8fad5b-d9cb-469f-a165-70867728950e'
+	expiration = int(time.time()) + 300
+	results = []
+	legacy = scp.SecureCookie(session, secret)
+	s = legacy.serialize(user, expiration, 'username', version=scp.V1)
+	def twopass():
+		scp.SecureCookie.keys.clear()
+		legacy.isValid(s)
+		scp.SecureCookie.keys.clear()
+		legacy.getData(s)
+	results.append(('legacy v1 2-pass', usec(twopass, n)))
+	for version in ( scp.V1, scp.V2 ):
+		s = legacy.serialize(user, expiration, 'username', version=version)
+		def cold():
+			scp.SecureCookie.keys.clear()
+			legacy.verify(s)
+		results.append(('legacy v%d cold' % version, usec(cold, n)))
+		results.append(('legacy v%d warm' % version, usec(lambda: legacy.verify(s), n)))
+	if 'aead' in scp.suites():
+		aead = scp.SecureCookie(session, secret, suite='aead')
+		s = aead.serialize(user, expiration, 'username')
+		results.append(('aead v3', usec(lambda: aead.verify(s), n)))
+	else:
+		print 'aead suite is not available with this Crypto library'
+	base = results[0][1]
+	print '%-16s %10s %8s' % ('suite', 'us/verify', 'speedup')
+	for (name, t) in results:
+		print '%-16s %10.2f %7.1fx' % (name, t, base / t)
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+## @package search
+# Catalog search latency against catalog size.
+#
+# A fresh database is filled with synthetic titles of two to six words
+# drawn from a pseudo-word vocabulary with a Zipf-like distribution, so
+# that some words occur in a large share of the titles and most are rare.
+# db.DB.search() is then timed for a rare, a medium and a common word, a
+# two word query, a two letter prefix and a single letter, next to the
+# LIKE '%word%' scan a search would need without the full-text index (up
+# to LIKE_MAX books).
+#
+# search() ranks every match and gives up after db.SEARCH_BUDGET, in which
+# case the results column says 'too many'. The full rank column is the
+# same query without the budget. For comparison, each term is also run
+# ranking only the first CAPPED matches by ID, which is faster for common
+# words, and the overlap column shows how many of its first page are on
+# the first page of the full ranking.
+#
+# Usage: python search.py [sizes] [queries per term]
+# e.g.   python search.py 10000,100000,1000000 50
+
+# system modules
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.dont_write_byte_code = True
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'document-root', 'lib'))
+
+# local modules
+import db
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+## Number of distinct words in the titles
+VOCABULARY = 50000
+## Largest catalog the LIKE scan is timed for
+LIKE_MAX = 1000000
+## Number of matches ranked by the capped query
+CAPPED = 1000
+## Search ranking only the first CAPPED matches by ID
+SQL_CAPPED = ('SELECT Books.ID, Books.Name, Books.Price FROM '
+		'(SELECT rowid, rank FROM BooksSearch WHERE BooksSearch MATCH ? LIMIT ?) AS Matches '
+		'JOIN Books ON Books.ID=Matches.rowid ORDER BY Matches.rank LIMIT ?')
+SYLLABLES = [ c + v for c in 'bcdfghklmnprstvz' for v in 'aeiou' ]
+
+##
+# @brief the vocabulary, most frequent word first
+def vocabulary(rnd):
+	words = set()
+	while len(words) < VOCABULARY:
+		words.add(''.join(rnd.choice(SYLLABLES) for i in xrange(rnd.randint(2, 4))))
+	words = sorted(words)
+	rnd.shuffle(words)
+	return words
+
+##
+# @brief generate titles whose words follow a Zipf-like distribution
+def titles(rnd, words, n):
+	# rank k with probability about 1/k: k = N ** u for uniform u
+	scale = float(len(words))
+	for i in xrange(n):
+		title = [ words[int(scale ** rnd.random()) - 1] for j in xrange(rnd.randint(2, 6)) ]
+		yield (' '.join(title).title(), 10 + i % 90)
+
+##
+# @brief mean latency of a function
+#
+# @return tuple (milliseconds, result of the last call)
+def timed(f, n):
+	start = time.time()
+	for i in xrange(n):
+		result = f()
+	return (1e3 * (time.time() - start) / n, result)
+
+##
+# @brief fill a fresh database and time the searches
+#
+# @return list of tuples (label, term, search ms, search results or None,
+# full rank ms, capped ms, overlap of the capped results, LIKE ms or None)
+def run(size, n):
+	root = tempfile.mkdtemp()
+	try:
+		path = os.path.join(root, 'ctf.db')
+		con = sqlite3.connect(path)
+		with open(os.path.join(ROOT, 'init.sql')) as f:
+			con.executescript(f.read())
+		con.commit()
+		con.close()
+		d = db.DB(path, pool=1)
+		rnd = random.Random(size)
+		words = vocabulary(rnd)
+		# the triggers keep the full-text index in sync while filling
+		con = sqlite3.connect(path)
+		con.executemany('INSERT INTO Books(Name, Price) VALUES (?, ?)', titles(rnd, words, size))
+		con.commit()
+		con.close()
+		terms = [
+			( 'common', words[0], ),
+			( 'medium', words[100], ),
+			( 'rare', words[len(words) // 2], ),
+			( 'two words', '%s %s' % (words[0], words[1]), ),
+			( 'prefix', words[5][:2], ),
+			( 'letter', words[5][:1], ),
+		]
+		results = []
+		for (label, term) in terms:
+			(ms, found) = timed(lambda: d.search(term), n)
+			expression = db.match_expression(term)
+			with d.connection() as xec:
+				(full, books) = timed(lambda: xec.rows(db.SQL_SEARCH, (expression, db.SEARCH_LIMIT, 0)), n)
+				(capped, rows) = timed(lambda: xec.rows(SQL_CAPPED, (expression, CAPPED, db.SEARCH_LIMIT)), n)
+			overlap = len(set(b.ID for b in books) & set(b.ID for b in rows))
+			like = None
+			if size <= LIKE_MAX and ' ' not in term:
+				with d.connection() as xec:
+					# stops at the first page of matches, so a common word
+					# is found early and a rare one reads the whole table
+					(like, rows) = timed(lambda: xec.rows('SELECT ID, Name, Price FROM Books '
+							'WHERE Name LIKE ? LIMIT ?', ('%' + term + '%', db.SEARCH_LIMIT)), 3)
+			results.append((label, term, ms, found, full, capped, overlap, like))
+		return results
+	finally:
+		shutil.rmtree(root)
+
+def main(argv):
+	sizes = [ int(s) for s in argv[1].split(',') ] if len(argv) > 1 else [ 10000, 100000, 1000000 ]
+	n = int(argv[2]) if len(argv) > 2 else 50
+	print '%10s %-10s %-14s %10s %8s %12s %10s %8s %10s' % ('books', 'query', 'term', 'search ms', 'results',
+			'full rank ms', 'capped ms', 'overlap', 'LIKE ms')
+	for size in sizes:
+		for (label, term, ms, found, full, capped, overlap, like) in run(size, n):
+			print '%10d %-10s %-14s %10.2f %8s %12.2f %10.2f %8d %10s' % (size, label, term, ms,
+					len(found) if found is not None else 'too many', full, capped, overlap,
+					'%.1f' % like if like is not None else '-')
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
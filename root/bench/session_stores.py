@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+## @package session_stores
+# Benchmark of the session stores against web.py's DiskStore.
+#
+# For each population size, every store is filled with that many sessions
+# and then timed on a request-like load/save of random existing sessions
+# and on one cleanup pass. Stores are created in a temporary directory.
+#
+# Usage: python session_stores.py [sizes] [operations]
+# e.g.   python session_stores.py 10000,100000,1000000 10000
+
+# system modules
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import web
+
+sys.dont_write_byte_code = True
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'document-root', 'lib'))
+
+# local modules
+import db
+import sessions
+
+## A session as service.py stores it
+SESSION = { 'ip': '10.0.0.1', 'session_id': 'x' * 40, 'csrf_token': 'y' * 32 }
+
+##
+# @brief build each store under test
+#
+# @param root temporary directory for on-disk stores
+#
+# @return list of (name, store)
+def stores(root):
+	xec = db.Connection(os.path.join(root, 'ctf.db'))
+	xec.migrate()
+	return [
+		('disk', web.session.DiskStore(os.path.join(root, 'sessions'))),
+		('memory', sessions.MemoryStore(size=10 ** 7)),
+		('sqlite', sessions.SQLiteStore(xec, sweep=0)),
+	]
+
+##
+# @brief fill a store with sessions
+#
+# @param store the store
+# @param keys session ids
+def fill(store, keys):
+	xec = getattr(store, '_xec', None)
+	if xec is None:
+		for key in keys:
+			store[key] = SESSION
+		return
+	# one transaction, otherwise filling dominates the run
+	with xec.transaction():
+		for key in keys:
+			store[key] = SESSION
+
+def main(argv):
+	sizes = [int(n) for n in (argv[1] if len(argv) > 1 else '10000,100000,1000000').split(',')]
+	ops = int(argv[2]) if len(argv) > 2 else 10000
+	print '%-8s %9s %10s %12s %10s' % ('store', 'sessions', 'fill s', 'load+save us', 'cleanup s')
+	for n in sizes:
+		root = tempfile.mkdtemp()
+		try:
+			keys = ['%040x' % random.getrandbits(160) for i in xrange(n)]
+			sample = [random.choice(keys) for i in xrange(ops)]
+			for (name, store) in stores(root):
+				start = time.time()
+				fill(store, keys)
+				filled = time.time() - start
+				start = time.time()
+				for key in sample:
+					if key in store:
+						store[key] = store[key]
+				request = (time.time() - start) / ops * 1e6
+				start = time.time()
+				store.cleanup(web.config.session_parameters.timeout)
+				cleanup = time.time() - start
+				print '%-8s %9d %10.2f %12.1f %10.2f' % (name, n, filled, request, cleanup)
+		finally:
+			shutil.rmtree(root)
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+## @package threads
+# Concurrency stress test of the service in threaded mode.
+#
+# The WSGI application from service.create_app() is driven in-process by
+# many threads at once, the way a threaded FastCGI or WSGI server calls it.
+# Every thread plays a different user through adduser, logon, checkout and
+# purchase, and checks that each page belongs to its own user. The run
+# fails if any response is wrong or any account is missing afterwards, and
+# reports completed purchase flows per second for each thread count.
+# Each flow also replays its auth cookie with another User-Agent, which
+# the service has to reject, as the cookie is bound to the session hash.
+#
+# The service runs on a fresh database and configuration in a temporary
+# directory. reCAPTCHA answers are accepted locally instead of being
+# submitted to the captcha service.
+#
+# Usage: python threads.py [thread counts] [flows per thread]
+# e.g.   python threads.py 1,4,16,32 20
+
+# system modules
+import Cookie
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import wsgiref.util
+from StringIO import StringIO
+
+sys.dont_write_byte_code = True
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'document-root'))
+
+# local modules
+import service
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+## Security Engineering, the second book of init.sql
+BOOK = '2'
+PRICE = '45.99'
+RE_TOKEN = re.compile('name="csrf_token" value="([^"]+)"')
+
+CONFIG = '''log:
+        file: ctf.log
+        level: CRITICAL
+db:
+        file: ctf.db
+server:
+        threads: %(threads)d
+session:
+        store: sqlite
+        sweep: 0
+cookie:
+        suite: aead
+csrf:
+        mode: stateless
+secret:
+        file: ctf.aes
+captcha:
+        private: ctf.aes
+        public: ctf.aes
+'''
+
+##
+# @brief reCAPTCHA result that is always valid
+class Accepted:
+	is_valid = True
+	error_code = None
+
+##
+# @brief A browser with its own cookies and User-Agent
+class Client:
+	##
+	# @param app the WSGI callable
+	# @param agent the User-Agent, which is part of the session hash
+	def __init__(self, app, agent):
+		self.app = app
+		self.agent = agent
+		self.cookies = {}
+	##
+	# @brief issue a request, leaving the body to be read
+	#
+	# @param method GET or POST
+	# @param path the path, with an optional query string
+	# @param form dictionary of form fields for POST
+	#
+	# @return tuple (status, iterator over the body)
+	def open(self, method, path, form=None):
+		body = urllib.urlencode(form or {})
+		(path, query) = (path.split('?', 1) + [ '' ])[:2]
+		env = {
+			'REQUEST_METHOD': method,
+			'PATH_INFO': path,
+			'QUERY_STRING': query,
+			'HTTPS': 'on',
+			'HTTP_USER_AGENT': self.agent,
+			'HTTP_COOKIE': '; '.join('%s=%s' % kv for kv in self.cookies.items()),
+			'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+			'CONTENT_LENGTH': str(len(body)),
+			'wsgi.input': StringIO(body),
+			'wsgi.url_scheme': 'https',
+		}
+		wsgiref.util.setup_testing_defaults(env)
+		response = {}
+		def start_response(status, headers, exc_info=None):
+			response['status'] = status
+			response['headers'] = headers
+		body = self.app(env, start_response)
+		for (name, value) in response['headers']:
+			if name.lower() != 'set-cookie':
+				continue
+			for morsel in Cookie.SimpleCookie(value).values():
+				if morsel.value and morsel['expires'] != -1:
+					self.cookies[morsel.key] = morsel.value
+				else:
+					self.cookies.pop(morsel.key, None)
+		return (response['status'], body)
+	##
+	# @brief issue a request
+	#
+	# @param method GET or POST
+	# @param path the path, with an optional query string
+	# @param form dictionary of form fields for POST
+	#
+	# @return tuple (status, body)
+	def request(self, method, path, form=None):
+		(status, body) = self.open(method, path, form)
+		return (status, ''.join(body))
+	##
+	# @brief get the csrf token of a page
+	def token(self, data):
+		m = RE_TOKEN.search(data)
+		return m.group(1) if m else ''
+
+##
+# @brief create an account and buy a book as that user
+#
+# @param client the Client
+# @param username the user
+#
+# @return None on success, otherwise a description of the failure
+def flow(client, username):
+	password = 'pw' + username
+	(status, data) = client.request('POST', '/adduser', dict(username=username,
+			password=password, password2=password,
+			recaptcha_challenge_field='x', recaptcha_response_field='x'))
+	if not status.startswith('303'):
+		return 'adduser %s: %s' % (username, status)
+	client.cookies.pop(service.COOKIE_NAME, None)
+	(status, data) = client.request('GET', '/logon')
+	(status, data) = client.request('POST', '/logon', dict(username=username,
+			password=password, csrf_token=client.token(data)))
+	if not status.startswith('303') or service.COOKIE_NAME not in client.cookies:
+		return 'logon %s: %s' % (username, status)
+	thief = Client(client.app, client.agent + ' thief')
+	thief.cookies = dict(client.cookies)
+	(status, data) = thief.request('GET', '/')
+	if not status.startswith('303'):
+		return 'index %s: cookie accepted with another User-Agent: %s' % (username, status)
+	(status, data) = client.request('GET', '/')
+	if 'Welcome %s' % username not in data:
+		return 'index %s: %s' % (username, status)
+	(status, data) = client.request('POST', '/checkout', dict(book=BOOK,
+			csrf_token=client.token(data)))
+	if 'Logged in as %s' % username not in data:
+		return 'checkout %s: %s' % (username, status)
+	(status, data) = client.request('POST', '/purchase', dict(book=BOOK,
+			name='Stress Test', card='1234567812345678', ccv='123',
+			expmonth='1', expyear='30', csrf_token=client.token(data)))
+	if 'Logged in as %s' % username not in data or PRICE not in data:
+		return 'purchase %s: %s' % (username, status)
+	return None
+
+##
+# @brief check that clients that differ only in their User-Agent get
+# different session hashes, which the flows rely on to tell them apart
+#
+# @return True or False
+def session_hash_differs():
+	hashes = set()
+	for agent in ( 'agent a', 'agent b', ):
+		service.web.ctx.env = { 'HTTP_USER_AGENT': agent }
+		hashes.add(service.get_session_hash())
+	return len(hashes) == 2
+
+##
+# @brief run the flows from a number of threads against a fresh service
+#
+# @param nthreads number of threads
+# @param nflows flows per thread
+#
+# @return tuple (flows per second, list of failures)
+def run(nthreads, nflows):
+	root = tempfile.mkdtemp()
+	try:
+		with open(os.path.join(root, 'ctf.yaml'), 'w') as f:
+			f.write(CONFIG % dict(threads=nthreads))
+		with open(os.path.join(root, 'ctf.aes'), 'wb') as f:
+			f.write(os.urandom(16))
+		con = sqlite3.connect(os.path.join(root, 'ctf.db'))
+		with open(os.path.join(ROOT, 'init.sql')) as f:
+			con.executescript(f.read())
+		con.commit()
+		con.close()
+		app = service.create_app(os.path.join(root, 'ctf.yaml'), root=root)
+		failures = []
+		def worker(n):
+			for i in xrange(nflows):
+				username = 'u%d_%d_%d' % (nthreads, n, i)
+				try:
+					failure = flow(Client(app, 'agent %s' % username), username)
+				except Exception, e:
+					failure = '%s: %r' % (username, e)
+				if failure:
+					failures.append(failure)
+		threads = [ threading.Thread(target=worker, args=(n,)) for n in range(nthreads) ]
+		start = time.time()
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		elapsed = time.time() - start
+		con = sqlite3.connect(os.path.join(root, 'ctf.db'))
+		users = con.execute('SELECT COUNT(*) FROM Users').fetchone()[0]
+		con.close()
+		if users != nthreads * nflows:
+			failures.append('%d users created, expected %d' % (users, nthreads * nflows))
+		return (nthreads * nflows / elapsed, failures)
+	finally:
+		shutil.rmtree(root)
+
+def main(argv):
+	counts = [ int(n) for n in argv[1].split(',') ] if len(argv) > 1 else [ 1, 4, 16, 32 ]
+	nflows = int(argv[2]) if len(argv) > 2 else 20
+	service.captcha.submit = lambda *args: Accepted()
+	if not session_hash_differs():
+		print 'the session hash does not depend on the User-Agent'
+		return 1
+	print '%8s %10s %9s' % ('threads', 'flows/s', 'failures')
+	ok = True
+	for n in counts:
+		(rate, failures) = run(n, nflows)
+		print '%8d %10.1f %9d' % (n, rate, len(failures))
+		for failure in failures[:10]:
+			print '\t' + failure
+		ok = ok and not failures
+	return 0 if ok else 1
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+## @package workers
+# Throughput benchmark of pre-forked workers.
+#
+# Serves a WSGI application whose cost per request is a legacy cookie
+# verification with a cold key cache, the dominant CPU cost of a
+# logged-in page, from 1 up to N pre-forked workers sharing one listening
+# socket, the same way service.py shares the FastCGI socket it inherits
+# from lighttpd. Clients run in separate processes.
+#
+# Usage: python workers.py [max workers] [requests per run]
+
+# system modules
+import httplib
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+import wsgiref.simple_server
+
+sys.dont_write_byte_code = True
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'document-root', 'lib'))
+
+# local modules
+import scp
+import workers
+
+SECRET = os.urandom(16)
+SESSION = os.urandom(20)
+COOKIE = scp.SecureCookie(SESSION, SECRET).serialize('0f8fad5b-d9cb-469f-a165-70867728950e', int(time.time()) + 3600, 'username')
+
+##
+# @brief the benchmarked application
+def app(environ, start_response):
+	scp.SecureCookie.keys.clear()
+	v = scp.verifier(SESSION, SECRET).verify(COOKIE)
+	start_response('200 OK', [('Content-Type', 'text/plain')])
+	return [v.data]
+
+##
+# @brief quiet request handler
+class Handler(wsgiref.simple_server.WSGIRequestHandler):
+	def log_message(self, *args):
+		pass
+
+##
+# @brief serve forever on an inherited listening socket
+#
+# @param sock the listening socket
+def serve(sock):
+	server = wsgiref.simple_server.WSGIServer(sock.getsockname(), Handler, bind_and_activate=False)
+	server.socket = sock
+	(server.server_name, server.server_port) = sock.getsockname()
+	server.setup_environ()
+	server.set_app(app)
+	server.serve_forever()
+
+##
+# @brief issue requests
+#
+# @param args tuple (port, number of requests)
+def client(args):
+	(port, n) = args
+	for i in xrange(n):
+		conn = httplib.HTTPConnection('127.0.0.1', port)
+		conn.request('GET', '/')
+		conn.getresponse().read()
+		conn.close()
+
+def main(argv):
+	nmax = int(argv[1]) if len(argv) > 1 else workers.count(0)
+	requests = int(argv[2]) if len(argv) > 2 else 2000
+	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	sock.bind(('127.0.0.1', 0))
+	sock.listen(128)
+	port = sock.getsockname()[1]
+	nclients = 2 * nmax
+	print '%8s %10s %8s' % ('workers', 'req/s', 'scaling')
+	base = None
+	for n in range(1, nmax + 1):
+		supervisor = os.fork()
+		if not supervisor:
+			workers.Prefork(n, lambda: serve(sock)).run()
+			os._exit(0)
+		time.sleep(0.5)
+		pool = multiprocessing.Pool(nclients)
+		start = time.time()
+		pool.map(client, [(port, requests // nclients)] * nclients)
+		rate = requests / (time.time() - start)
+		pool.terminate()
+		os.kill(supervisor, signal.SIGTERM)
+		os.waitpid(supervisor, 0)
+		base = base or rate
+		print '%8d %10.0f %7.2fx' % (n, rate, rate / base)
+
+if __name__ == '__main__':
+	import logging
+	logging.disable(logging.CRITICAL)
+	sys.exit(main(sys.argv))
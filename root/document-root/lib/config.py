@@ -16,19 +16,41 @@ sys.dont_write_byte_code = True
 class Configurator:
 	def __init__(self):
 		self._secret = None
+		self._root = None
 	##
 	# @brief Load configuration file
 	#
 	# @param path file to load
-	def load(self, path):
+	# @param root directory that relative file names in the configuration
+	# are resolved against. Defaults to the working directory.
+	def load(self, path, root=None):
 		with open(path, "r") as f:
 			self._config = yaml.load(f)
+		self._root = root
+	##
+	# @brief resolve a file name from the configuration
+	#
+	# @param path the configured file name
+	#
+	# @return the file name, relative to the root if one was given
+	def _path(self, path):
+		if path is None or self._root is None:
+			return path
+		return os.path.join(self._root, path)
 	##
 	# @return db file path
 	@property
 	def db(self):
 		try:
-			return self._config['db']['file']
+			return self._path(self._config['db']['file'])
+		except:
+			return None
+	##
+	# @return dictionary of sqlite connection pragmas, see db.PRAGMAS
+	@property
+	def db_pragmas(self):
+		try:
+			return dict((k, v) for (k, v) in self._config['db'].items() if k != 'file')
 		except:
 			return None
 	##
@@ -36,7 +58,7 @@ class Configurator:
 	@property
 	def log(self):
 		try:
-			return self._config['log']['file']
+			return self._path(self._config['log']['file'])
 		except:
 			return None
 	##
@@ -48,12 +70,190 @@ class Configurator:
 		except:
 			return None
 	##
+	# @return log format, 'text' or 'json'
+	@property
+	def log_format(self):
+		try:
+			return self._config['log']['format']
+		except:
+			return None
+	##
+	# @return size of the queue that log records are written from by a
+	# background thread, 0 to write them on the logging thread
+	@property
+	def log_queue(self):
+		try:
+			return int(self._config['log']['queue'])
+		except:
+			return None
+	##
+	# @return what to do with log records when the queue is full, 'drop'
+	# or 'block'
+	@property
+	def log_overflow(self):
+		try:
+			return self._config['log']['overflow']
+		except:
+			return None
+	##
+	# @return size in bytes at which the log file is rotated, 0 for no limit
+	@property
+	def log_rotate_size(self):
+		try:
+			return int(self._config['log']['rotate']['size'])
+		except:
+			return None
+	##
+	# @return seconds between rotations of the log file, 0 for no limit
+	@property
+	def log_rotate_interval(self):
+		try:
+			return int(self._config['log']['rotate']['interval'])
+		except:
+			return None
+	##
+	# @return number of rotated log files kept, 0 to keep all
+	@property
+	def log_rotate_keep(self):
+		try:
+			return int(self._config['log']['rotate']['keep'])
+		except:
+			return None
+	##
+	# @return messages of a template logged per window, 0 for no limit
+	@property
+	def log_limit_burst(self):
+		try:
+			return int(self._config['log']['limit']['burst'])
+		except:
+			return None
+	##
+	# @return length of a rate limit window, in seconds
+	@property
+	def log_limit_window(self):
+		try:
+			return float(self._config['log']['limit']['window'])
+		except:
+			return None
+	##
+	# @return one in this many messages beyond the limit is logged, 0 for none
+	@property
+	def log_limit_sample(self):
+		try:
+			return int(self._config['log']['limit']['sample'])
+		except:
+			return None
+	##
+	# @return name of the cipher suite for new cookies
+	@property
+	def cookie_suite(self):
+		try:
+			return self._config['cookie']['suite']
+		except:
+			return None
+	##
+	# @return csrf token mode, 'session' or 'stateless'
+	@property
+	def csrf_mode(self):
+		try:
+			return self._config['csrf']['mode']
+		except:
+			return None
+	##
+	# @return lifetime of stateless csrf tokens, in seconds
+	@property
+	def csrf_ttl(self):
+		try:
+			return int(self._config['csrf']['ttl'])
+		except:
+			return None
+	##
+	# @return whether stateless csrf tokens may only be used once
+	@property
+	def csrf_single_use(self):
+		try:
+			return bool(self._config['csrf']['single_use'])
+		except:
+			return None
+	##
+	# @return session store backend, 'disk', 'memory' or 'sqlite'
+	@property
+	def session_store(self):
+		try:
+			return self._config['session']['store']
+		except:
+			return None
+	##
+	# @return session lifetime, in seconds
+	@property
+	def session_ttl(self):
+		try:
+			return int(self._config['session']['ttl'])
+		except:
+			return None
+	##
+	# @return maximum number of sessions in the memory store
+	@property
+	def session_size(self):
+		try:
+			return int(self._config['session']['size'])
+		except:
+			return None
+	##
+	# @return seconds between sweeps of the sqlite store
+	@property
+	def session_sweep(self):
+		try:
+			return float(self._config['session']['sweep'])
+		except:
+			return None
+	##
+	# @return number of worker processes, 0 for one per CPU
+	@property
+	def workers(self):
+		try:
+			return int(self._config['server']['workers'])
+		except:
+			return None
+	##
+	# @return number of threads serving requests in each worker process
+	@property
+	def threads(self):
+		try:
+			return int(self._config['server']['threads'])
+		except:
+			return None
+	##
+	# @return list of client addresses that may read /metrics
+	@property
+	def metrics_allow(self):
+		try:
+			return [ str(ip) for ip in self._config['metrics']['allow'] ]
+		except:
+			return None
+	##
+	# @return directory that worker processes share their metrics in
+	@property
+	def metrics_dir(self):
+		try:
+			return self._path(self._config['metrics']['dir'])
+		except:
+			return None
+	##
+	# @return seconds between the metrics snapshots of a worker
+	@property
+	def metrics_interval(self):
+		try:
+			return float(self._config['metrics']['interval'])
+		except:
+			return None
+	##
 	# @return log level
 	@property
 	def secret(self):
 		if self._secret is None:
 			try:
-				keyfile = self._config['secret']['file']
+				keyfile = self._path(self._config['secret']['file'])
 			except (IOError, KeyError):
 				return None
 			with file(keyfile) as f:
@@ -63,7 +263,7 @@ class Configurator:
 	# @return public key file
 	@property
 	def captcha_public_key(self):
-		path = self._config['captcha']['public']
+		path = self._path(self._config['captcha']['public'])
 		try:
 			with file(path) as f:
 					self._captcha_public_key = f.read()
@@ -74,7 +274,7 @@ class Configurator:
 	# @return private key file
 	@property
 	def captcha_private_key(self):
-		path = self._config['captcha']['private']
+		path = self._path(self._config['captcha']['private'])
 		try:
 			with file(path) as f:
 				self._captcha_private_key = f.read()
@@ -90,6 +290,45 @@ class TestConfigurator(unittest.TestCase):
 		self.assertTrue(c)
 		self.assertTrue(c.load('test-data/ctf.yaml') is None)
 		self.assertRaises(IOError, c.load, '')
+	def test_root(self):
+		c = Configurator()
+		c.load('test-data/ctf.yaml')
+		self.assertEqual(c.db, 'test-data/ctf.db')
+		c.load('test-data/ctf.yaml', root='/var/www')
+		self.assertEqual(( c.db, c.log, ), ( '/var/www/test-data/ctf.db', '/var/www/test-data/ctf.log', ))
+	def test_log(self):
+		c = Configurator()
+		c.load('test-data/ctf.yaml')
+		self.assertEqual(( c.lvl, c.log_format, c.log_queue, c.log_overflow, ), ( 'DEBUG', 'text', 10000, 'drop', ))
+		self.assertEqual(( c.log_rotate_size, c.log_rotate_interval, c.log_rotate_keep, ), ( 104857600, 86400, 14, ))
+		self.assertEqual(( c.log_limit_burst, c.log_limit_window, c.log_limit_sample, ), ( 20, 10, 1000, ))
+	def test_cookie_suite(self):
+		c = Configurator()
+		c.load('test-data/ctf.yaml')
+		self.assertEqual(c.cookie_suite, 'aead')
+	def test_csrf(self):
+		c = Configurator()
+		c.load('test-data/ctf.yaml')
+		self.assertEqual(( c.csrf_mode, c.csrf_ttl, c.csrf_single_use, ), ( 'stateless', 3600, True, ))
+	def test_db_pragmas(self):
+		c = Configurator()
+		c.load('test-data/ctf.yaml')
+		self.assertEqual(c.db_pragmas, dict(journal_mode='wal', synchronous='normal',
+				mmap_size=268435456, cache_size=-8000, busy_timeout=5000))
+	def test_workers(self):
+		c = Configurator()
+		c.load('test-data/ctf.yaml')
+		self.assertEqual(c.workers, 0)
+		self.assertEqual(c.threads, 10)
+	def test_session(self):
+		c = Configurator()
+		c.load('test-data/ctf.yaml')
+		self.assertEqual(( c.session_store, c.session_ttl, c.session_size, c.session_sweep, ), ( 'sqlite', 86400, 100000, 60, ))
+	def test_metrics(self):
+		c = Configurator()
+		c.load('test-data/ctf.yaml')
+		self.assertEqual(( c.metrics_allow, c.metrics_dir, c.metrics_interval, ),
+				( [ '127.0.0.1', '::1' ], 'test-data/metrics', 5, ))
 
 if __name__ == '__main__':
 	# run from the same directory as the module
@@ -0,0 +1,180 @@
+## @package csrf
+# Stateless Cross Site Request Forgery tokens.
+#
+# A token carries the time it was issued, a random nonce, and an HMAC of
+# both together with the session fingerprint and a client id, keyed with
+# the server secret. The session fingerprint is derived from headers that
+# any client can send, so it alone does not tell clients apart; the client
+# id is a random value that the service keeps in a cookie of the client,
+# which another site can neither read nor set. Checking a token needs no
+# server side state.
+#
+# Tokens can optionally be made single use, which is tracked by an
+# in-memory set of spent nonces. The set is local to the process: with
+# pre-forked workers, a token spent in one worker is still accepted once
+# by each of the others, until it expires.
+
+# system modules
+import hashlib
+import hmac
+import os
+import re
+import sys
+import threading
+import time
+import unittest
+
+# local modules
+import scp
+
+sys.dont_write_byte_code = True
+
+## Default token lifetime, in seconds
+CSRF_TTL = 3600
+## Maximum number of spent nonces remembered for single use tokens
+NONCE_MAX = 65536
+NONCE_LEN = 8
+## Length of a client id, in bytes
+CLIENT_LEN = 16
+RE_CLIENT = re.compile('^[0-9a-f]{%d}$' % (2 * CLIENT_LEN))
+
+##
+# @brief generate a client id to bind the tokens of a client to
+#
+# @return the client id as a hex string
+def client_id():
+	return os.urandom(CLIENT_LEN).encode('hex')
+
+##
+# @brief Issues and checks signed csrf tokens
+class CSRF:
+	##
+	# @brief create a token signer
+	#
+	# @param secret the server secret
+	# @param ttl seconds that a token stays valid
+	# @param single_use reject tokens that have already been checked
+	#
+	# @return CSRF object
+	def __init__(self, secret, ttl=CSRF_TTL, single_use=True):
+		# derive a key so that tokens are never valid MACs elsewhere
+		self._mac = scp.keyed(hmac.new(secret, 'csrf', hashlib.sha1).digest())
+		self._ttl = ttl
+		self._used = scp.KeyCache(size=NONCE_MAX) if single_use else None
+		self._lock = threading.Lock()
+	##
+	# @brief compute the signature of a token
+	#
+	# @param issued issue time of the token as a hex string
+	# @param nonce nonce of the token as a hex string
+	# @param session the session fingerprint
+	# @param client the client id
+	#
+	# @return signature as a hex string
+	def _sign(self, issued, nonce, session, client):
+		h = self._mac.copy()
+		h.update('%s.%s.%s.%s' % (issued, nonce, client, session))
+		return h.hexdigest()
+	##
+	# @brief issue a token
+	#
+	# @param session the session fingerprint the token is bound to
+	# @param client the client id the token is bound to, see client_id()
+	# @param now current time, defaults to time.time()
+	#
+	# @return the token string
+	def token(self, session, client, now=None):
+		if not RE_CLIENT.match(client):
+			raise ValueError('malformed client id')
+		if now is None:
+			now = time.time()
+		issued = '%x' % int(now)
+		nonce = os.urandom(NONCE_LEN).encode('hex')
+		return '%s.%s.%s' % (issued, nonce, self._sign(issued, nonce, session, client))
+	##
+	# @brief check a token
+	#
+	# @param token the token submitted by the client
+	# @param session the session fingerprint of the request
+	# @param client the client id of the request
+	# @param now current time, defaults to time.time()
+	#
+	# @return True or False
+	def check(self, token, session, client, now=None):
+		if now is None:
+			now = time.time()
+		if not client or not RE_CLIENT.match(client):
+			return False
+		try:
+			(issued, nonce, mac) = str(token).split('.')
+			expiration = int(issued, 16) + self._ttl
+		except (ValueError, UnicodeError):
+			return False
+		if expiration <= now:
+			return False
+		if not hmac.compare_digest(mac, self._sign(issued, nonce, session, client)):
+			return False
+		if self._used is None:
+			return True
+		with self._lock:
+			if self._used.get(nonce, now) is not None:
+				return False
+			self._used.put(nonce, True, expiration, now)
+		return True
+
+TEST_SESSION = '123456789009876543211234567890'
+TEST_CLIENT = 'a' * (2 * CLIENT_LEN)
+
+class TestCSRF(unittest.TestCase):
+	def setUp(self):
+		self.secret = os.urandom(16)
+	def test_token(self):
+		c = CSRF(self.secret, single_use=False)
+		t = c.token(TEST_SESSION, TEST_CLIENT)
+		self.assertTrue(c.check(t, TEST_SESSION, TEST_CLIENT))
+		self.assertTrue(c.check(t, TEST_SESSION, TEST_CLIENT))
+	def test_single_use(self):
+		c = CSRF(self.secret)
+		t = c.token(TEST_SESSION, TEST_CLIENT)
+		self.assertTrue(c.check(t, TEST_SESSION, TEST_CLIENT))
+		self.assertFalse(c.check(t, TEST_SESSION, TEST_CLIENT))
+		self.assertTrue(c.check(c.token(TEST_SESSION, TEST_CLIENT), TEST_SESSION, TEST_CLIENT))
+	def test_client_id(self):
+		self.assertTrue(RE_CLIENT.match(client_id()))
+		self.assertNotEqual(client_id(), client_id())
+	def test_neg_session(self):
+		c = CSRF(self.secret)
+		self.assertFalse(c.check(c.token(TEST_SESSION, TEST_CLIENT), TEST_SESSION + 'x', TEST_CLIENT))
+	def test_neg_client(self):
+		# a token minted by one client, with the same headers as another
+		c = CSRF(self.secret, single_use=False)
+		(a, b) = (client_id(), client_id())
+		t = c.token(TEST_SESSION, a)
+		self.assertTrue(c.check(t, TEST_SESSION, a))
+		self.assertFalse(c.check(t, TEST_SESSION, b))
+		for client in ( '', None, a.upper(), a[:-1], ):
+			self.assertFalse(c.check(t, TEST_SESSION, client))
+		self.assertRaises(ValueError, c.token, TEST_SESSION, '')
+	def test_neg_secret(self):
+		t = CSRF(self.secret).token(TEST_SESSION, TEST_CLIENT)
+		self.assertFalse(CSRF(os.urandom(16)).check(t, TEST_SESSION, TEST_CLIENT))
+	def test_neg_expired(self):
+		c = CSRF(self.secret, ttl=10)
+		t = c.token(TEST_SESSION, TEST_CLIENT, now=1000)
+		self.assertTrue(c.check(t, TEST_SESSION, TEST_CLIENT, now=1009))
+		t = c.token(TEST_SESSION, TEST_CLIENT, now=1000)
+		self.assertFalse(c.check(t, TEST_SESSION, TEST_CLIENT, now=1010))
+	def test_neg_tampered(self):
+		c = CSRF(self.secret)
+		(issued, nonce, mac) = c.token(TEST_SESSION, TEST_CLIENT).split('.')
+		later = '%x' % (int(issued, 16) + 100)
+		self.assertFalse(c.check('.'.join((later, nonce, mac)), TEST_SESSION, TEST_CLIENT))
+	def test_neg_malformed(self):
+		c = CSRF(self.secret)
+		for t in ( '', 'abc', 'x.y.z', '1.2', None, u'\u2603' ):
+			self.assertFalse(c.check(t, TEST_SESSION, TEST_CLIENT))
+
+if __name__ == '__main__':
+	# run from the same directory as the module
+	os.chdir(os.path.dirname(os.path.abspath(sys.argv[0])))
+	sys.exit(unittest.main(verbosity=2))
@@ -11,15 +11,23 @@
 # - Users.Password	=> string, exactly 40 characters
 
 # system modules
+import collections
+import contextlib
 import os
+import Queue
 import re
+import shutil
 import sqlite3
 import sys
+import tempfile
+import threading
+import time
 import unittest
 import uuid
 import web
 
 # local modules
+import metrics
 from log import l
 
 sys.dont_write_byte_code = True
@@ -30,22 +38,428 @@ HEXCHARS='[a-f0-9]'
 RE_UUID = re.compile('^%s{8}-%s{4}-%s{4}-%s{4}-%s{12}$' % (HEXCHARS, HEXCHARS, HEXCHARS, HEXCHARS, HEXCHARS))
 RE_SHA1 = re.compile('^%s{40}$' % HEXCHARS)
 
+## Default maximum number of open connections, one per serving thread
+POOL_SIZE = 10
+## Default number of books per batch of iterBooks()
+BATCH_SIZE = 100
+
+RE_UINT = re.compile('^\d+$')
+RE_INT = re.compile('^-?\d+$')
+## Connection pragmas that can be configured, in the order they are applied,
+# with the values they accept. The busy timeout comes first so that
+# switching the journal mode waits for other connections.
+PRAGMAS = collections.OrderedDict([
+	( 'busy_timeout', RE_UINT ),
+	( 'journal_mode', re.compile('^(delete|truncate|persist|memory|wal|off)$', re.I) ),
+	( 'synchronous', re.compile('^(off|normal|full|extra|[0-3])$', re.I) ),
+	( 'mmap_size', RE_UINT ),
+	( 'cache_size', RE_INT ),
+])
+
+## Hot queries. They run as parameterized statements directly on the
+# sqlite3 connection, which keeps them compiled in its statement cache.
+SQL_BOOKS = 'SELECT ID, Name, Price FROM Books ORDER BY ID'
+SQL_BOOK = 'SELECT ID, Name, Price FROM Books WHERE ID=?'
+SQL_BOOK_NAME = 'SELECT ID, Name, Price FROM Books WHERE Name=? ORDER BY ID LIMIT 1'
+SQL_BOOKS_AFTER = 'SELECT ID, Name, Price FROM Books WHERE ID>? ORDER BY ID LIMIT ?'
+SQL_BOOKS_BEFORE = 'SELECT ID, Name, Price FROM Books WHERE ID<? ORDER BY ID DESC LIMIT ?'
+SQL_CATALOG_VERSION = 'SELECT Version FROM Catalog'
+SQL_SEARCH = ('SELECT Books.ID, Books.Name, Books.Price FROM BooksSearch '
+		'JOIN Books ON Books.ID=BooksSearch.rowid WHERE BooksSearch MATCH ? '
+		'ORDER BY BooksSearch.rank LIMIT ? OFFSET ?')
+SQL_HAS_SEARCH = "SELECT 1 FROM sqlite_master WHERE name='BooksSearch'"
+SQL_USER = 'SELECT GUID, Password FROM Users WHERE Username=?'
+SQL_USER_G = 'SELECT Username, Password FROM Users WHERE GUID=?'
+SQL_VALID_USER = 'SELECT GUID FROM Users WHERE Username=? AND Password=?'
+
+## Lookups that must be served by an index, with example parameters.
+# The whole catalog is read by DB.catalog(), which is not one of them.
+LOOKUPS = [
+	( SQL_BOOK, ( 1, ) ),
+	( SQL_BOOK_NAME, ( 'x', ) ),
+	( SQL_BOOKS_AFTER, ( 0, 50, ) ),
+	( SQL_BOOKS_BEFORE, ( 100, 50, ) ),
+	( SQL_USER, ( 'x', ) ),
+	( SQL_USER_G, ( 'x', ) ),
+	( SQL_VALID_USER, ( 'x', 'x', ) ),
+	( SQL_SEARCH, ( '"x"*', 20, 0, ) ),
+]
+## Query plan steps that are scans, but not of a whole table: a virtual
+# table that uses one of its indexes, e.g. a full-text MATCH
+RE_BOUNDED_SCAN = re.compile('VIRTUAL TABLE INDEX \d+:\S')
+
+## Words of a search query, see match_expression()
+RE_TERM = re.compile('\w+', re.UNICODE)
+## Maximum number of words of a search query that are used
+SEARCH_TERMS_MAX = 8
+## Shortest last word that is searched as a prefix, the shortest prefix the
+# full-text index has, see SEARCH_SCHEMA
+SEARCH_PREFIX_MIN = 2
+## Seconds a search may take before it is stopped, see DB.search()
+SEARCH_BUDGET = 0.05
+## SQLite instructions between checks of the time budget of a query
+PROGRESS_STEPS = 1000
+## Default number of search results
+SEARCH_LIMIT = 20
+
+## Triggers that bump the catalog version on every change to Books
+CATALOG_TRIGGERS = (
+	'CREATE TRIGGER IF NOT EXISTS BooksInsert AFTER INSERT ON Books '
+		'BEGIN UPDATE Catalog SET Version=Version+1; END',
+	'CREATE TRIGGER IF NOT EXISTS BooksUpdate AFTER UPDATE ON Books '
+		'BEGIN UPDATE Catalog SET Version=Version+1; END',
+	'CREATE TRIGGER IF NOT EXISTS BooksDelete AFTER DELETE ON Books '
+		'BEGIN UPDATE Catalog SET Version=Version+1; END',
+)
+
+## Schema migrations, in order. Step n upgrades a database from
+# PRAGMA user_version n to n + 1.
+MIGRATIONS = [
+	# 1: the tables created by init.sql, which is version 0
+	(
+		'CREATE TABLE IF NOT EXISTS Users(GUID, Username UNIQUE, Password, SessionID)',
+		'CREATE TABLE IF NOT EXISTS Books(Name VARCHAR(255), Price REAL)',
+	),
+	# 2: indexes for the lookups
+	(
+		'CREATE INDEX IF NOT EXISTS UsersGUID ON Users(GUID)',
+		'CREATE INDEX IF NOT EXISTS BooksName ON Books(Name)',
+	),
+	# 3: catalog version, bumped by every change to Books
+	(
+		'CREATE TABLE IF NOT EXISTS Catalog(Version INTEGER NOT NULL)',
+		'INSERT INTO Catalog SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM Catalog)',
+	) + CATALOG_TRIGGERS,
+	# 4: integer primary key for Books, keeping the current rowids as IDs
+	(
+		'CREATE TABLE BooksByID(ID INTEGER PRIMARY KEY, Name VARCHAR(255), Price REAL)',
+		'INSERT INTO BooksByID(ID, Name, Price) SELECT rowid, Name, Price FROM Books',
+		'DROP TABLE Books',
+		'ALTER TABLE BooksByID RENAME TO Books',
+		'CREATE INDEX BooksName ON Books(Name)',
+	) + CATALOG_TRIGGERS + (
+		'UPDATE Catalog SET Version=Version+1',
+	),
+	# 5: full-text index of book names, see create_search_index()
+	(
+		lambda conn: create_search_index(conn),
+	),
+	# 6: sessions, see sessions.SQLiteStore. The store used to create the
+	# table itself, hence IF NOT EXISTS.
+	(
+		'CREATE TABLE IF NOT EXISTS Sessions('
+			'SessionID TEXT PRIMARY KEY, Expires REAL NOT NULL, Data TEXT)',
+		'CREATE INDEX IF NOT EXISTS SessionsExpires ON Sessions(Expires)',
+	),
+]
+## Version of the schema defined by MIGRATIONS
+SCHEMA_VERSION = len(MIGRATIONS)
+## Version of the schema that has the full-text index
+SEARCH_VERSION = 5
+
+## Full-text index of book names, kept in sync with Books by triggers
+SEARCH_SCHEMA = (
+	"CREATE VIRTUAL TABLE BooksSearch USING fts5(Name, content='Books', "
+		"content_rowid='ID', prefix='2 3')",
+	"INSERT INTO BooksSearch(BooksSearch) VALUES('rebuild')",
+	'CREATE TRIGGER BooksSearchInsert AFTER INSERT ON Books BEGIN '
+		'INSERT INTO BooksSearch(rowid, Name) VALUES (new.ID, new.Name); END',
+	'CREATE TRIGGER BooksSearchDelete AFTER DELETE ON Books BEGIN '
+		"INSERT INTO BooksSearch(BooksSearch, rowid, Name) VALUES ('delete', old.ID, old.Name); END",
+	'CREATE TRIGGER BooksSearchUpdate AFTER UPDATE ON Books BEGIN '
+		"INSERT INTO BooksSearch(BooksSearch, rowid, Name) VALUES ('delete', old.ID, old.Name); "
+		'INSERT INTO BooksSearch(rowid, Name) VALUES (new.ID, new.Name); END',
+)
+
+##
+# @brief check whether SQLite was built with the FTS5 full-text extension
+#
+# @param conn sqlite3 connection
+#
+# @return True or False
+def have_fts5(conn):
+	try:
+		conn.execute('CREATE VIRTUAL TABLE temp.Fts5Probe USING fts5(x)')
+	except sqlite3.OperationalError:
+		return False
+	conn.execute('DROP TABLE temp.Fts5Probe')
+	return True
+
+##
+# @brief Create the full-text index of book names, if SQLite has FTS5.
+# Without it, the schema goes on without the index and catalog search is
+# disabled; Connection.migrate() creates the index once FTS5 is there.
+#
+# @param conn sqlite3 connection, in the migration transaction
+def create_search_index(conn):
+	if not have_fts5(conn):
+		l.warn("SQLite has no FTS5, catalog search is disabled.")
+		return
+	for statement in SEARCH_SCHEMA:
+		conn.execute(statement)
+
+##
+# @brief Turn what a user typed into a full-text query. Only the words are
+# kept and each is quoted, so the input can never be FTS query syntax. All
+# words must match, the last one as a prefix so that results show up while
+# it is still being typed, unless it is shorter than SEARCH_PREFIX_MIN:
+# such a prefix is not in the index and would read every term.
+#
+# @param text the search text
+#
+# @return the MATCH expression, or None if there are no words
+def match_expression(text):
+	terms = RE_TERM.findall(text)[:SEARCH_TERMS_MAX]
+	if not terms:
+		return None
+	expression = ' '.join([ '"%s"' % t for t in terms ])
+	if len(terms[-1]) >= SEARCH_PREFIX_MIN:
+		expression += '*'
+	return expression
+
+##
+# @brief check connection pragmas and turn them into statements
+#
+# @param pragmas dictionary of pragma name => value
+#
+# @return list of PRAGMA statements, in the order they must be run
+def pragma_statements(pragmas):
+	statements = []
+	for (name, valid) in PRAGMAS.items():
+		if name not in pragmas or pragmas[name] is None:
+			continue
+		value = str(pragmas[name])
+		if not valid.match(value):
+			l.error("Ignoring invalid value %s for pragma %s." % (value, name))
+			continue
+		statements.append('PRAGMA %s=%s' % (name, value))
+	for name in set(pragmas) - set(PRAGMAS):
+		l.error("Ignoring unsupported pragma %s." % name)
+	return statements
+
+##
+# @brief A web.py sqlite handle that owns exactly one connection.
+#
+# web.database opens a connection for every thread that touches it. Pooled
+# handles are passed from thread to thread instead, one thread at a time,
+# so the thread-local context is replaced with a plain one.
+class Connection(web.db.SqliteDB):
+	##
+	# @brief open a connection
+	#
+	# @param path path to the database file
+	# @param pragmas list of PRAGMA statements run when the connection opens
+	def __init__(self, path, pragmas=()):
+		web.db.SqliteDB.__init__(self, db=path, check_same_thread=False)
+		self._ctx = web.storage()
+		self._pragmas = pragmas
+		# Prevent web.db from printing queries
+		self.printing = False
+	def _load_context(self, ctx):
+		web.db.SqliteDB._load_context(self, ctx)
+		for pragma in self._pragmas:
+			ctx.db.execute(pragma)
+	##
+	# @brief Bring the schema up to date. The steps run in one immediate
+	# transaction, so that processes starting at the same time wait for each
+	# other and a failed step leaves the database as it was. A step is
+	# either an SQL statement or a function of the sqlite3 connection.
+	#
+	# @return the schema version
+	def migrate(self):
+		conn = self.ctx.db
+		version = conn.execute('PRAGMA user_version').fetchone()[0]
+		if version >= SCHEMA_VERSION and not self._search_missing(version):
+			return version
+		# sqlite3 commits before any DDL statement unless it is left
+		# to manage the transaction itself
+		isolation = conn.isolation_level
+		conn.isolation_level = None
+		try:
+			conn.execute('BEGIN IMMEDIATE')
+			try:
+				version = conn.execute('PRAGMA user_version').fetchone()[0]
+				while version < SCHEMA_VERSION:
+					for statement in MIGRATIONS[version]:
+						if callable(statement):
+							statement(conn)
+						else:
+							conn.execute(statement)
+					version += 1
+					l.info("Migrated database %s to version %d." % (self.keywords['database'], version))
+				if self._search_missing(version):
+					# migrated while SQLite had no FTS5
+					create_search_index(conn)
+				conn.execute('PRAGMA user_version=%d' % version)
+				conn.execute('COMMIT')
+			except:
+				conn.execute('ROLLBACK')
+				raise
+		finally:
+			conn.isolation_level = isolation
+		return version
+	##
+	# @param version the schema version
+	#
+	# @return whether the schema should have the full-text index, does not,
+	# and it can be created. A schema newer than this code is left alone.
+	def _search_missing(self, version):
+		conn = self.ctx.db
+		return SEARCH_VERSION <= version <= SCHEMA_VERSION and \
+				not conn.execute(SQL_HAS_SEARCH).fetchone() and have_fts5(conn)
+	##
+	# @return whether the full-text index exists
+	def searchable(self):
+		return self.ctx.db.execute(SQL_HAS_SEARCH).fetchone() is not None
+	##
+	# @brief run a parameterized statement on the sqlite3 connection
+	#
+	# @param sql the statement, with ? placeholders
+	# @param params tuple of parameters
+	# @param budget seconds after which the statement is stopped with
+	# sqlite3.OperationalError('interrupted'), None for no limit
+	#
+	# @return list of rows as web.storage
+	def rows(self, sql, params=(), budget=None):
+		conn = self.ctx.db
+		if budget is not None:
+			deadline = time.time() + budget
+			conn.set_progress_handler(lambda: time.time() > deadline, PROGRESS_STEPS)
+		cur = conn.cursor()
+		try:
+			cur.execute(sql, params)
+			names = [ d[0] for d in cur.description ]
+			return [ web.storage(zip(names, row)) for row in cur.fetchall() ]
+		finally:
+			cur.close()
+			if budget is not None:
+				conn.set_progress_handler(None, PROGRESS_STEPS)
+
+##
+# @brief Stand-in for a web.database handle that runs each query on a
+# connection borrowed from the pool of a DB.
+#
+# Results are read completely before the connection is returned, so
+# select() and query() return lists instead of lazy iterators.
+class PooledQueries:
+	## Methods of web.database that are forwarded
+	METHODS = ( 'query', 'select', 'where', 'insert', 'multiple_insert', 'update', 'delete', )
+	##
+	# @param db the DB whose pool is used
+	def __init__(self, db):
+		self._db = db
+	def __getattr__(self, name):
+		if name not in self.METHODS:
+			raise AttributeError(name)
+		def pooled(*args, **kwargs):
+			with self._db.connection() as xec:
+				res = getattr(xec, name)(*args, **kwargs)
+				if isinstance(res, web.utils.IterBetter):
+					res = list(res)
+				return res
+		return pooled
+
+##
+# @brief In-memory copy of the book catalog at one version
+class Catalog:
+	##
+	# @param version the catalog version the books were read at
+	# @param books list of books as web.storage, in ID order
+	def __init__(self, version, books):
+		self.version = version
+		self.books = books
+
 ##
 # @brief Database Interface
+#
+# Queries run on a bounded pool of connections. A thread borrows a
+# connection for the duration of a query, or of a connection() block, so
+# any number of serving threads can share one DB with at most pool
+# connections open.
 class DB:
 	##
-	# @brief Create a new connection to the database
+	# @brief Create a new connection pool for the database
 	#
 	# @param path path to the database file
+	# @param pool maximum number of open connections. An in-memory database
+	# only exists on the connection that created it, so it always gets one.
+	# @param pragmas dictionary of connection pragmas, see PRAGMAS
 	#
 	# @return new DB object.
-	def __init__(self, path):
+	def __init__(self, path, pool=POOL_SIZE, pragmas=None):
 		if not os.path.exists(path) and path != ':memory:':
 			l.critical("Database %s does not exist, cannot connect." % path)
 			raise IOError
-		self.xec = web.database(dbn='sqlite', db=path)
-		# Prevent web.db from printing queries
-		self.xec.printing = False
+		self.path = path
+		self.size = 1 if path == ':memory:' else max(1, pool)
+		self._idle = Queue.LifoQueue()
+		self._lock = threading.Lock()
+		self._local = threading.local()
+		self._pragmas = pragma_statements(pragmas or {})
+		self.xec = PooledQueries(self)
+		self._catalog = None
+		# one thread reloads the catalog while the others wait for it
+		self._catalog_lock = threading.Lock()
+		self.catalog_hits = 0
+		self.catalog_reloads = 0
+		# open the first connection now so that errors show up early
+		xec = Connection(path, self._pragmas)
+		self.version = xec.migrate()
+		if self.version > SCHEMA_VERSION:
+			l.warn("Database %s has schema version %d, newer than %d." % (path, self.version, SCHEMA_VERSION))
+		## whether the full-text index exists, see search()
+		self.searchable = xec.searchable()
+		self._idle.put(xec)
+		self._opened = 1
+	##
+	# @brief borrow a connection from the pool, opening one if the pool is
+	# not full yet, otherwise waiting for another thread to return one
+	#
+	# @return Connection object
+	def _acquire(self):
+		try:
+			return self._idle.get_nowait()
+		except Queue.Empty:
+			pass
+		with self._lock:
+			grow = self._opened < self.size
+			if grow:
+				self._opened += 1
+		if not grow:
+			return self._idle.get()
+		try:
+			return Connection(self.path, self._pragmas)
+		except:
+			with self._lock:
+				self._opened -= 1
+			raise
+	##
+	# @brief Borrow a connection for a block of queries, e.g. a transaction.
+	# Nested blocks in the same thread share the connection. The block is
+	# timed as the db stage of the request, less the time spent waiting for
+	# a connection, which is the db_wait stage.
+	#
+	# @return context manager yielding a web.py database handle
+	@contextlib.contextmanager
+	def connection(self):
+		xec = getattr(self._local, 'xec', None)
+		if xec is not None:
+			yield xec
+			return
+		with metrics.timer('db'):
+			with metrics.timer('db_wait'):
+				xec = self._acquire()
+			self._local.xec = xec
+			try:
+				yield xec
+			finally:
+				self._local.xec = None
+				self._idle.put(xec)
+	##
+	# @return number of connections opened by the pool
+	@property
+	def opened(self):
+		return self._opened
 	##
 	# @brief Add a new user to the database
 	#
@@ -61,39 +475,142 @@ class DB:
 			l.error("password type is not str.")
 			return None
 		if len(username) > USERNAME_MAX:
-			l.error('username is greater than %d characters.' % USERNAME_MAX)
+			l.error('username is greater than %d characters.', USERNAME_MAX)
 			return None
 		if not RE_SHA1.match(password):
-			l.error("%s does not match regular expression '%s'." % (password, RE_SHA1.pattern))
+			l.error("%s does not match regular expression '%s'.", password, RE_SHA1.pattern)
 			return None
 		# The guid will be stored in the cookie with the user.
 		guid = str(uuid.uuid4())
 		try:
 			self.xec.insert('Users', GUID=guid, Username=username, Password=password)
 		except sqlite3.IntegrityError:
-			l.warn("username %s already exists." % username)
+			l.warn("username %s already exists.", username)
 			return None
 		return guid
-	# @brief get all books in the table
+	##
+	# @brief Get the whole book catalog, for the few callers that need every
+	# book; single books are looked up with getBook(). It is kept in memory
+	# and only read again from the database when the catalog version, which
+	# triggers on Books bump, has changed. Checking the version is a one row
+	# read.
+	#
+	# @return Catalog object, which must not be modified
+	def catalog(self):
+		with self._catalog_lock:
+			with self.connection() as xec:
+				version = xec.rows(SQL_CATALOG_VERSION)[0].Version
+				catalog = self._catalog
+				if catalog is not None and catalog.version == version:
+					self.catalog_hits += 1
+					return catalog
+				# read after the version, so the books are never older than it
+				books = xec.rows(SQL_BOOKS)
+			catalog = Catalog(version, books)
+			self._catalog = catalog
+			self.catalog_reloads += 1
+			return catalog
+	##
+	# @brief Get a page of books in ID order. Pages are found by keyset on
+	# the primary key, so the cost of a page does not depend on its position
+	# or on the size of the catalog.
+	#
+	# @param after only books with an ID greater than this
+	# @param before only books with an ID less than this, the limit closest
+	# to it. Ignored if after is given.
+	# @param limit maximum number of books, None for all of them
+	#
+	# @return list of books as web.storage with ID, Name and Price
+	def getBooks(self, after=None, before=None, limit=None):
+		if limit is None and after is None and before is None:
+			return self.catalog().books
+		if limit is None:
+			limit = -1
+		with self.connection() as xec:
+			if after is not None or before is None:
+				return xec.rows(SQL_BOOKS_AFTER, (after or 0, limit))
+			res = xec.rows(SQL_BOOKS_BEFORE, (before, limit))
+		res.reverse()
+		return res
+	##
+	# @brief Iterate over books in ID order, in batches. Each batch is its
+	# own keyset query, so no connection is held between batches, e.g. while
+	# a streamed page is sent to a slow client.
+	#
+	# @param after only books with an ID greater than this
+	# @param limit maximum number of books, None for all of them
+	# @param batch maximum number of books per batch
+	#
+	# @return generator of lists of books as web.storage
+	def iterBooks(self, after=None, limit=None, batch=BATCH_SIZE):
+		while limit is None or limit > 0:
+			n = batch if limit is None else min(batch, limit)
+			books = self.getBooks(after=after, limit=n)
+			if not books:
+				return
+			yield books
+			if len(books) < n:
+				return
+			after = books[-1].ID
+			if limit is not None:
+				limit -= n
+	##
+	# @brief Search the book names with the full-text index. Every match is
+	# ranked, so a word that is in a large share of the names costs time in
+	# proportion; the search is stopped once it has taken SEARCH_BUDGET.
+	#
+	# @param text the search text, see match_expression()
+	# @param offset number of results to skip
+	# @param limit maximum number of results
 	#
-	# @return iterable of all books
-	def getBooks(self):
-		return self.xec.select('Books', what='*')
+	# @return list of books as web.storage with ID, Name and Price, best
+	# matches first, or an empty list if the database has no full-text
+	# index, see searchable. None if too many books match to rank them in
+	# time.
+	def search(self, text, offset=0, limit=SEARCH_LIMIT):
+		expression = match_expression(text)
+		if expression is None or not self.searchable:
+			return []
+		with self.connection() as xec:
+			try:
+				return xec.rows(SQL_SEARCH, (expression, limit, offset), budget=SEARCH_BUDGET)
+			except sqlite3.OperationalError as e:
+				if str(e) != 'interrupted':
+					raise
+		l.info('Search for %s stopped after %.0f ms.', expression, SEARCH_BUDGET * 1000)
+		return None
+	##
+	# @brief look up a book by its primary key, or by the name index
+	#
+	# @param book the integer ID of the book. The full name of the book is
+	# still accepted for requests from pages rendered before books had IDs;
+	# of books with the same name, the first one is returned.
+	#
+	# @return web.storage with ID, Name and Price, or None
+	def getBook(self, book):
+		if type(book) in ( int, long, ):
+			sql = SQL_BOOK
+		elif isinstance(book, basestring):
+			sql = SQL_BOOK_NAME
+		else:
+			l.error("book type is not int or str.")
+			return None
+		with self.connection() as xec:
+			res = xec.rows(sql, (book,))
+		if not res:
+			l.warn('No entry for %s', book)
+			return None
+		return res[0]
 	##
 	# @brief lookup the price of a book
 	#
-	# @param book the full name of the book
+	# @param book the integer ID of the book, or its full name, see getBook()
 	#
 	# @return the price of the book
 	def getPrice(self, book):
-		where = dict(Name=book)
-		res = self.xec.select('Books', what='Price', where=web.db.sqlwhere(where))
-		try:
-			return res[0].Price
-		except IndexError:
-			l.warn('No entry for %s' % book)
-		except AttributeError:
-			l.critical('BUG: no attribute Price')
+		res = self.getBook(book)
+		if res is not None:
+			return res.Price
 	##
 	# @brief Get entries associated with a user by username
 	#
@@ -105,15 +622,15 @@ class DB:
 			l.error("username type is not str")
 			return ( None, None, )
 		if len(username) > USERNAME_MAX:
-			l.error("%s is greater than %d characters." % (username, USERNAME_MAX))
+			l.error("%s is greater than %d characters.", username, USERNAME_MAX)
 			return ( None, None, )
-		where = dict(Username=username)
-		res = self.xec.select('Users', what='GUID,Password', where=web.db.sqlwhere(where))
+		with self.connection() as xec:
+			res = xec.rows(SQL_USER, (username,))
 		try:
 			res = res[0]
 		except IndexError:
 			# This username did not exist, return the correct type
-			l.warn("username %s does not exist." % username)
+			l.warn("username %s does not exist.", username)
 			return ( None, None, )
 		return (res.GUID, res.Password)
 	##
@@ -127,15 +644,15 @@ class DB:
 			l.error("guid type is not str")
 			return ( None, None, )
 		if not RE_UUID.match(guid):
-			l.error("%s does not match regular expression '%s'." % (guid, RE_UUID.pattern))
+			l.error("%s does not match regular expression '%s'.", guid, RE_UUID.pattern)
 			return ( None, None, )
-		where = dict(GUID=guid)
-		res = self.xec.select('Users', what='Username,Password', where=web.db.sqlwhere(where))
+		with self.connection() as xec:
+			res = xec.rows(SQL_USER_G, (guid,))
 		try:
 			res = res[0]
 		except IndexError:
 			# This guid did not exist, return the correct type
-			l.warn("guid %s does not exist." % guid)
+			l.warn("guid %s does not exist.", guid)
 			return ( None, None, )
 		return (res.Username, res.Password)
 	##
@@ -149,21 +666,21 @@ class DB:
 			l.error("username type is not str")
 			return None
 		if len(username) > USERNAME_MAX:
-			l.error("%s is more that %d characters." % (username, USERNAME_MAX))
+			l.error("%s is more that %d characters.", username, USERNAME_MAX)
 			return None
 		if type(password) is not str:
 			l.error("password type is not str")
 			return None
 		if not RE_SHA1.match(password):
-			l.error("%s does not match regular expression '%s'." % (password, RE_SHA1.pattern))
+			l.error("%s does not match regular expression '%s'.", password, RE_SHA1.pattern)
 			return None
-		where = dict(Username=username, Password=password)
-		res = self.xec.select('Users', what='GUID', where=web.db.sqlwhere(where))
+		with self.connection() as xec:
+			res = xec.rows(SQL_VALID_USER, (username, password))
 		try:
 			res = res[0]
 		except IndexError:
 			# This guid did not exist, return the correct type
-			l.warn("Bad password match for user %s" % username)
+			l.warn("Bad password match for user %s", username)
 			return None
 		return res.GUID
 
@@ -174,9 +691,7 @@ testpass = '1234567890abcdef098712345678900987654321'
 class TestDB(unittest.TestCase):
 	def setUp(self):
 		self.db = DB(testdb)
-		self.db.xec.query("CREATE TABLE Users(GUID, Username UNIQUE, Password)")
-		self.db.xec.query("CREATE TABLE Books(Name, Price)")
-		self.db.xec.query('INSERT INTO Books VALUES ("Secure Electronic Commerce", 27.50)')
+		self.db.xec.query('INSERT INTO Books(Name, Price) VALUES ("Secure Electronic Commerce", 27.50)')
 	def test_init(self):
 		# Initialization is already tested in setup
 		# This is a necessary evil if we are going to keep the database in memory
@@ -200,12 +715,35 @@ class TestDB(unittest.TestCase):
 	def test_getBooks(self):
 		res = self.db.getBooks()
 		self.assertFalse(res is None)
+	def test_getBooks_pages(self):
+		for i in range(2, 8):
+			self.db.xec.query('INSERT INTO Books(Name, Price) VALUES ($name, 1)', vars=dict(name='Book %d' % i))
+		ids = lambda books: [ b.ID for b in books ]
+		self.assertEqual(ids(self.db.getBooks(limit=3)), [ 1, 2, 3, ])
+		self.assertEqual(ids(self.db.getBooks(after=3, limit=3)), [ 4, 5, 6, ])
+		self.assertEqual(ids(self.db.getBooks(after=6, limit=3)), [ 7, ])
+		self.assertEqual(ids(self.db.getBooks(after=7, limit=3)), [])
+		self.assertEqual(ids(self.db.getBooks(before=4, limit=2)), [ 2, 3, ])
+		self.assertEqual(ids(self.db.getBooks(before=3, limit=3)), [ 1, 2, ])
+		self.assertEqual(ids(self.db.getBooks(after=5)), [ 6, 7, ])
+		self.assertEqual([ ids(b) for b in self.db.iterBooks(batch=3) ], [ [ 1, 2, 3, ], [ 4, 5, 6, ], [ 7, ] ])
+		self.assertEqual([ ids(b) for b in self.db.iterBooks(after=1, limit=4, batch=3) ], [ [ 2, 3, 4, ], [ 5, ] ])
+		self.assertEqual(list(self.db.iterBooks(after=7)), [])
 	def test_getPrice(self):
 		res = self.db.getPrice('Secure Electronic Commerce')
 		self.assertEqual(res, 27.50)
 	def test_getPrice_neg_nobook(self):
 		res = self.db.getPrice('Not a Book')
 		self.assertTrue(res is None)
+	def test_getPrice_id(self):
+		self.assertEqual(self.db.getPrice(1), 27.50)
+		self.assertTrue(self.db.getPrice(2) is None)
+	def test_getBook(self):
+		book = self.db.getBook(1)
+		self.assertEqual(( book.ID, book.Name, book.Price, ), ( 1, 'Secure Electronic Commerce', 27.50, ))
+		self.assertEqual(self.db.getBook(u'Secure Electronic Commerce').ID, 1)
+		self.assertTrue(self.db.getBook(None) is None)
+		self.assertTrue(self.db.getBook(1.0) is None)
 	def test_getUser(self):
 		guid = self.db.addUser(testuser, testpass)
 		self.assertFalse(guid is None)
@@ -239,6 +777,226 @@ class TestDB(unittest.TestCase):
 	def test_getValidUser_neg_nomatch(self):
 		self.assertEqual(self.db.getValidUser(testuser, testpass), None)
 
+class TestMigrations(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, 'ctf.db')
+		# a database as created by init.sql
+		con = sqlite3.connect(self.path)
+		con.execute("CREATE TABLE Users(GUID, Username UNIQUE, Password, SessionID)")
+		con.execute("CREATE TABLE Books(Name VARCHAR(255), Price REAL)")
+		con.execute('INSERT INTO Books VALUES ("Secure Electronic Commerce", 27.50)')
+		con.commit()
+		con.close()
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+	def indexes(self):
+		con = sqlite3.connect(self.path)
+		try:
+			return set(r[0] for r in con.execute("SELECT name FROM sqlite_master WHERE type='index'"))
+		finally:
+			con.close()
+	def test_upgrade(self):
+		d = DB(self.path)
+		self.assertEqual(d.version, SCHEMA_VERSION)
+		self.assertTrue(set([ 'UsersGUID', 'BooksName', ]) <= self.indexes())
+		self.assertEqual(d.getPrice('Secure Electronic Commerce'), 27.50)
+		# the rowid became the ID and the catalog triggers survived the rebuild
+		self.assertEqual(d.getBook(1).Name, 'Secure Electronic Commerce')
+		d.xec.query('INSERT INTO Books(Name, Price) VALUES ("Security Engineering", 45.99)')
+		self.assertEqual(d.getPrice(2), 45.99)
+		self.assertEqual(DB(self.path).version, SCHEMA_VERSION)
+	def test_rollback(self):
+		con = sqlite3.connect(self.path)
+		con.execute("CREATE TABLE UsersGUID(x)")
+		con.commit()
+		con.close()
+		self.assertRaises(sqlite3.OperationalError, DB, self.path)
+		con = sqlite3.connect(self.path)
+		self.assertEqual(con.execute('PRAGMA user_version').fetchone()[0], 0)
+		con.close()
+		self.assertFalse('BooksName' in self.indexes())
+	def test_newer(self):
+		con = sqlite3.connect(self.path)
+		con.execute('PRAGMA user_version=%d' % (SCHEMA_VERSION + 1))
+		con.close()
+		self.assertEqual(DB(self.path).version, SCHEMA_VERSION + 1)
+	def test_no_fts5(self):
+		global have_fts5
+		saved = have_fts5
+		have_fts5 = lambda conn: False
+		try:
+			d = DB(self.path)
+			self.assertEqual(( d.version, d.searchable, ), ( SCHEMA_VERSION, False, ))
+			self.assertEqual(d.search('commerce'), [])
+			d.xec.query('INSERT INTO Books(Name, Price) VALUES ("Security Engineering", 45.99)')
+		finally:
+			have_fts5 = saved
+		# the index is created once FTS5 is available
+		d = DB(self.path)
+		self.assertTrue(d.searchable)
+		self.assertEqual(sorted([ b.Name for b in d.search('secur') ]), [ 'Secure Electronic Commerce', 'Security Engineering' ])
+
+class TestCatalog(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, 'ctf.db')
+		open(self.path, 'w').close()
+		self.db = DB(self.path, pragmas=dict(journal_mode='wal'))
+		self.db.xec.query('INSERT INTO Books(Name, Price) VALUES ("Secure Electronic Commerce", 27.50)')
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+	def test_hits(self):
+		books = self.db.getBooks()
+		self.assertEqual([ b.Name for b in books ], [ 'Secure Electronic Commerce' ])
+		self.assertTrue(self.db.getBooks() is books)
+		self.assertEqual(( self.db.catalog_hits, self.db.catalog_reloads, ), ( 1, 1, ))
+	def test_lookups_do_not_load(self):
+		self.assertEqual(self.db.getPrice('Secure Electronic Commerce'), 27.50)
+		self.assertEqual(self.db.getBook(1).Name, 'Secure Electronic Commerce')
+		self.assertEqual(( self.db.catalog_hits, self.db.catalog_reloads, ), ( 0, 0, ))
+		# the first of the books with a name, as before books had IDs
+		self.db.xec.query('INSERT INTO Books(Name, Price) VALUES ("Secure Electronic Commerce", 5)')
+		self.assertEqual(self.db.getBook('Secure Electronic Commerce').ID, 1)
+	def test_concurrent_reload(self):
+		threads = [ threading.Thread(target=self.db.getBooks) for i in range(8) ]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		self.assertEqual(( self.db.catalog_hits, self.db.catalog_reloads, ), ( 7, 1, ))
+	def test_users_do_not_invalidate(self):
+		self.db.getBooks()
+		self.db.addUser(testuser, testpass)
+		self.db.getBooks()
+		self.assertEqual(self.db.catalog_reloads, 1)
+	def test_reload(self):
+		self.db.getBooks()
+		# a change made by another process
+		con = sqlite3.connect(self.path)
+		con.execute('UPDATE Books SET Price=30 WHERE Name="Secure Electronic Commerce"')
+		con.execute('INSERT INTO Books(Name, Price) VALUES ("Security Engineering", 45.99)')
+		con.commit()
+		con.close()
+		self.assertEqual(self.db.getPrice('Secure Electronic Commerce'), 30)
+		self.assertEqual(self.db.getPrice('Security Engineering'), 45.99)
+		self.assertEqual(len(self.db.getBooks()), 2)
+		self.assertEqual(self.db.catalog_reloads, 2)
+
+class TestSearch(unittest.TestCase):
+	def setUp(self):
+		self.db = DB(testdb)
+		for name in [ 'Security Engineering', 'Web Security, Privacy, and Commerce', 'Java Servlet Programming' ]:
+			self.db.xec.query('INSERT INTO Books(Name, Price) VALUES ($name, 1)', vars=dict(name=name))
+	def names(self, text, **kwargs):
+		return [ b.Name for b in self.db.search(text, **kwargs) ]
+	def test_match_expression(self):
+		self.assertEqual(match_expression('web secur'), '"web" "secur"*')
+		self.assertEqual(match_expression('" OR NEAR(ab cd) *'), '"OR" "NEAR" "ab" "cd"*')
+		self.assertEqual(match_expression(' -- '), None)
+		# a one letter prefix is not in the index
+		self.assertEqual(match_expression('web s'), '"web" "s"')
+		self.assertEqual(match_expression('b'), '"b"')
+	def test_search(self):
+		self.assertEqual(self.names('security'), [ 'Security Engineering', 'Web Security, Privacy, and Commerce' ])
+		self.assertEqual(self.names('web secu'), [ 'Web Security, Privacy, and Commerce' ])
+		self.assertEqual(self.names('java', offset=1), [])
+		self.assertEqual(self.names('"'), [])
+		self.assertEqual(len(self.db.search('security', limit=1)), 1)
+	def test_rank(self):
+		# the best match has the highest ID, every match is ranked
+		self.db.xec.query('INSERT INTO Books(Name, Price) VALUES ($name, 1)', vars=dict(name='Security'))
+		self.assertEqual(self.names('security')[0], 'Security')
+		self.assertEqual(self.names('security', offset=1, limit=1), [ 'Security Engineering' ])
+	def test_budget(self):
+		global SEARCH_BUDGET, PROGRESS_STEPS
+		saved = ( SEARCH_BUDGET, PROGRESS_STEPS, )
+		# out of time at the first check
+		( SEARCH_BUDGET, PROGRESS_STEPS, ) = ( -1, 1, )
+		try:
+			self.assertTrue(self.db.search('security') is None)
+		finally:
+			( SEARCH_BUDGET, PROGRESS_STEPS, ) = saved
+		# the connection is not left with the budget
+		with self.db.connection() as xec:
+			self.assertEqual(len(xec.rows(SQL_SEARCH, ( '"security"', 20, 0, ))), 2)
+		self.assertEqual(len(self.db.search('security')), 2)
+	def test_sync(self):
+		self.db.xec.query('UPDATE Books SET Name=$name WHERE ID=3', vars=dict(name='Servlets'))
+		self.assertEqual(self.names('java'), [])
+		self.assertEqual(self.names('servlets'), [ 'Servlets' ])
+		self.db.xec.query('DELETE FROM Books WHERE ID=3')
+		self.assertEqual(self.names('servlets'), [])
+
+class TestQueryPlans(unittest.TestCase):
+	def test_no_full_scan(self):
+		d = DB(testdb)
+		with d.connection() as xec:
+			for (sql, params) in LOOKUPS:
+				for step in xec.rows('EXPLAIN QUERY PLAN ' + sql, params):
+					full = step.detail.startswith('SCAN') and not RE_BOUNDED_SCAN.search(step.detail)
+					self.assertFalse(full, '%s: %s' % (sql, step.detail))
+
+class TestDBPool(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		path = os.path.join(self.dir, 'ctf.db')
+		con = sqlite3.connect(path)
+		con.execute("CREATE TABLE Users(GUID, Username UNIQUE, Password)")
+		con.commit()
+		con.close()
+		self.db = DB(path, pool=4)
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+	def test_memory(self):
+		self.assertEqual(DB(testdb, pool=4).size, 1)
+	def test_nested(self):
+		with self.db.connection() as outer:
+			with self.db.connection() as inner:
+				self.assertTrue(outer is inner)
+		self.assertEqual(self.db.opened, 1)
+	def test_transaction(self):
+		with self.db.connection() as xec:
+			with xec.transaction():
+				self.assertNotEqual(self.db.addUser(testuser, testpass), None)
+		self.assertNotEqual(self.db.getValidUser(testuser, testpass), None)
+	def test_pragmas(self):
+		d = DB(self.db.path, pragmas=dict(journal_mode='wal', synchronous='normal',
+				busy_timeout=1000, cache_size=-2000, mmap_size=0))
+		with d.connection() as xec:
+			self.assertEqual(xec.rows('PRAGMA journal_mode')[0].journal_mode, 'wal')
+			self.assertEqual(xec.rows('PRAGMA synchronous')[0].synchronous, 1)
+			self.assertEqual(xec.rows('PRAGMA busy_timeout')[0].timeout, 1000)
+			self.assertEqual(xec.rows('PRAGMA cache_size')[0].cache_size, -2000)
+	def test_pragma_statements(self):
+		self.assertEqual(pragma_statements(dict(cache_size=-2000, busy_timeout=10)),
+				[ 'PRAGMA busy_timeout=10', 'PRAGMA cache_size=-2000', ])
+		self.assertEqual(pragma_statements(dict(journal_mode='wal; DROP TABLE Users')), [])
+		self.assertEqual(pragma_statements(dict(mmap_size=-1, journal_mode=None)), [])
+		self.assertEqual(pragma_statements(dict(writable_schema=1)), [])
+	def test_threads(self):
+		nthreads = 16
+		guids = {}
+		errors = []
+		def worker(n):
+			try:
+				for i in range(20):
+					username = 'user%d_%d' % (n, i)
+					guid = self.db.addUser(username, testpass)
+					if self.db.getValidUser(username, testpass) != guid:
+						errors.append(username)
+					guids[username] = guid
+			except Exception, e:
+				errors.append(e)
+		threads = [ threading.Thread(target=worker, args=(n,)) for n in range(nthreads) ]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		self.assertEqual(errors, [])
+		self.assertEqual(len(set(guids.values())), nthreads * 20)
+		self.assertTrue(self.db.opened <= 4)
+
 if __name__ == '__main__':
 	import logging
 	# suppress logging for unit tests
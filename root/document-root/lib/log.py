@@ -4,9 +4,19 @@
 # Wrap standard logging with formatting and file logging.
 
 # system modules
+import errno
+import fcntl
+import glob
+import gzip
+import json
 import logging
 import os
+import Queue
+import re
+import shutil
 import sys
+import threading
+import time
 import traceback
 import unittest
 
@@ -14,6 +24,433 @@ sys.dont_write_byte_code = True
 
 LFORMAT = '%(asctime)s [%(levelname)s]:\t%(module)s:%(lineno)d: %(message)s'
 DFORMAT = '%Y-%m-%d %H:%M:%S'
+## Log formats, see CTFLogger
+FORMATS = ( 'text', 'json', )
+## Fields of request records, see CTFLogger.request()
+REQUEST_FIELDS = ( 'method', 'route', 'status', 'duration', 'user', )
+
+## Default number of records the queue holds, see QueueHandler
+QUEUE_SIZE = 10000
+## Most records the writer formats and writes at once
+BATCH_SIZE = 256
+## Seconds between flushes of the log files by the writer
+FLUSH_INTERVAL = 1.0
+## What to do with a record when the queue is full: drop it and count it,
+# or wait for the writer to make room
+OVERFLOW = ( 'drop', 'block', )
+
+##
+# @brief Handler that moves the formatting and writing of records off the
+# logging thread. Records are put on a bounded queue, and a writer thread
+# formats them in batches and writes each batch to the stream of each
+# handler with a single write. Streams are flushed every FLUSH_INTERVAL
+# seconds, when the queue runs empty or for records of level ERROR and
+# above, and when the handler is closed, which logging.shutdown() does at
+# exit.
+#
+# The writer thread does not survive fork(), so a forked process starts
+# its own with a new queue the first time it logs.
+class QueueHandler(logging.Handler):
+	##
+	# @param handlers the handlers that write the records, usually
+	# logging.StreamHandler or logging.FileHandler
+	# @param size number of records the queue holds
+	# @param overflow an entry of OVERFLOW
+	def __init__(self, handlers, size=QUEUE_SIZE, overflow='drop'):
+		if overflow not in OVERFLOW:
+			raise ValueError('overflow must be one of %s' % ', '.join(OVERFLOW))
+		logging.Handler.__init__(self)
+		self.handlers = handlers
+		self.size = size
+		self.overflow = overflow
+		## number of records dropped because the queue was full
+		self.dropped = 0
+		self._dropped_lock = threading.Lock()
+		self._pid = None
+		self._start()
+	##
+	# @brief start the writer of this process
+	def _start(self):
+		self.queue = Queue.Queue(self.size)
+		self._writer = threading.Thread(target=self._write_loop, args=(self.queue,), name='log writer')
+		self._writer.daemon = True
+		self._writer.start()
+		self._pid = os.getpid()
+	##
+	# @brief Queue a record. Unlike logging.Handler.handle() this does not
+	# take the handler lock, the queue has its own.
+	def handle(self, record):
+		if self.filter(record):
+			self.emit(record)
+		return record
+	def emit(self, record):
+		if self._pid != os.getpid():
+			self.acquire()
+			try:
+				if self._pid != os.getpid():
+					self._start()
+			finally:
+				self.release()
+		if record.exc_info:
+			# the traceback may not outlive the exception handler
+			record.exc_text = logging._defaultFormatter.formatException(record.exc_info)
+			record.exc_info = None
+		try:
+			if self.overflow == 'block':
+				self.queue.put(record)
+			else:
+				self.queue.put_nowait(record)
+		except Queue.Full:
+			with self._dropped_lock:
+				self.dropped += 1
+	##
+	# @brief write records to the streams of the handlers
+	#
+	# @param records list of logging.LogRecord
+	def _write(self, records):
+		for h in self.handlers:
+			try:
+				lines = [ h.format(r) for r in records if r.levelno >= h.level ]
+				if not lines:
+					continue
+				text = '\n'.join(lines) + '\n'
+				if isinstance(text, unicode):
+					text = text.encode('utf-8')
+				h.acquire()
+				try:
+					if isinstance(h, RotatingFileHandler):
+						h.write(text)
+					else:
+						h.stream.write(text)
+				finally:
+					h.release()
+			except Exception:
+				h.handleError(records[0])
+	##
+	# @brief flush the streams of the handlers
+	def _flush(self):
+		for h in self.handlers:
+			h.flush()
+	##
+	# @brief Body of the writer thread: take the records off the queue in
+	# batches until the None that close() puts there.
+	#
+	# @param queue the queue of this process
+	def _write_loop(self, queue):
+		flushed = time.time()
+		reported = 0
+		while True:
+			try:
+				records = [ queue.get(timeout=FLUSH_INTERVAL) ]
+			except Queue.Empty:
+				self._flush()
+				flushed = time.time()
+				continue
+			try:
+				while len(records) < BATCH_SIZE:
+					records.append(queue.get_nowait())
+			except Queue.Empty:
+				pass
+			stop = None in records
+			records = [ r for r in records if r is not None ]
+			if self.dropped > reported:
+				dropped = self.dropped
+				records.append(logging.LogRecord('', logging.WARNING, __file__, 0,
+						'Log queue full, dropped %d records.' % (dropped - reported), None, None))
+				reported = dropped
+			self._write(records)
+			urgent = [ r for r in records if r.levelno >= logging.ERROR ]
+			if stop or urgent or queue.empty() or time.time() - flushed >= FLUSH_INTERVAL:
+				self._flush()
+				flushed = time.time()
+			if stop:
+				return
+	##
+	# @brief wait for the queued records to be written
+	def close(self):
+		if self._pid == os.getpid() and self._writer.is_alive():
+			self.queue.put(None)
+			self._writer.join()
+		for h in self.handlers:
+			h.close()
+		logging.Handler.close(self)
+
+## Seconds a rotated log file is left alone before it is compressed, for
+# other processes to finish writing what they had buffered for it
+COMPRESS_DELAY = 5.0
+## Rotated log files are named after the log file and the time of rotation
+RE_SEGMENT = re.compile('(\.\d{8}-\d{6})(-\d+)?(\.gz)?$')
+
+##
+# @brief sort key of rotated log files, oldest first
+#
+# @param path path of a rotated file
+#
+# @return tuple (time of rotation, number among those of the same second)
+def segment_order(path):
+	m = RE_SEGMENT.search(path)
+	return (m.group(1), int(m.group(2)[1:]) if m.group(2) else 0)
+
+##
+# @brief File handler that rotates the log file by size or time and
+# compresses the rotated files on a background thread.
+#
+# Any number of processes can write the same log file. Before writing, a
+# handler checks whether the file is due for rotation. The one that
+# rotates it holds an flock() on a lock file next to the log while it
+# renames the file to <file>.<YYYYmmdd-HHMMSS>; the others notice that
+# the path refers to a new file and reopen it. Whatever they still write
+# to the old file lands in the rotated one, which is why it is only
+# compressed once it has not been written for COMPRESS_DELAY seconds.
+class RotatingFileHandler(logging.FileHandler):
+	##
+	# @param filename the log file
+	# @param size rotate once the file has reached this many bytes, 0 for
+	# no limit
+	# @param interval rotate when the time passes a multiple of this many
+	# seconds since the epoch, e.g. 86400 for every day at midnight UTC, 0
+	# for no limit
+	# @param keep number of rotated files kept, 0 to keep all
+	# @param delay see COMPRESS_DELAY
+	def __init__(self, filename, size=0, interval=0, keep=0, delay=COMPRESS_DELAY):
+		logging.FileHandler.__init__(self, filename)
+		self.size = size
+		self.interval = interval
+		self.keep = keep
+		self.delay = delay
+		self._id = self._identity(os.fstat(self.stream.fileno()))
+		self._pid = None
+		self._lockfile = None
+		self._compressor = None
+	##
+	# @return what tells files apart
+	def _identity(self, st):
+		return (st.st_dev, st.st_ino)
+	##
+	# @brief check whether a log file is due for rotation
+	#
+	# @param st os.stat() of the file
+	# @param now the time
+	def _due(self, st, now):
+		if self.size and st.st_size >= self.size:
+			return True
+		if self.interval and st.st_size and int(st.st_mtime // self.interval) < int(now // self.interval):
+			return True
+		return False
+	##
+	# @brief open the file that the path now refers to
+	def _reopen(self):
+		self.stream.close()
+		self.stream = self._open()
+		self._id = self._identity(os.fstat(self.stream.fileno()))
+	##
+	# @brief Set up the lock file and the compressor for this process. The
+	# compressor thread does not survive fork(), and an flock() on a
+	# descriptor inherited over fork() is shared with the parent.
+	def _start(self):
+		if self._pid == os.getpid():
+			return
+		self._lockfile = open(self.baseFilename + '.lock', 'a')
+		self._segments = Queue.Queue()
+		self._compressor = threading.Thread(target=self._compress_loop,
+				args=(self._segments,), name='log compressor')
+		self._compressor.daemon = True
+		self._compressor.start()
+		self._pid = os.getpid()
+	##
+	# @brief Write to the log file, rotating it first if it is due. Callers
+	# hold the handler lock.
+	#
+	# @param text the formatted records
+	def write(self, text):
+		now = time.time()
+		try:
+			st = os.stat(self.baseFilename)
+		except OSError:
+			st = None
+		if st is None or self._identity(st) != self._id:
+			# rotated by another process, or removed
+			self._reopen()
+			st = os.fstat(self.stream.fileno())
+		if self._due(st, now):
+			self._rotate(now)
+		self.stream.write(text)
+	##
+	# @brief rename the log file and queue it for compression, unless
+	# another process got there first
+	def _rotate(self, now):
+		self._start()
+		fcntl.flock(self._lockfile, fcntl.LOCK_EX)
+		try:
+			try:
+				st = os.stat(self.baseFilename)
+			except OSError:
+				st = None
+			if st is not None and self._identity(st) == self._id and self._due(st, now):
+				self.stream.flush()
+				name = '%s.%s' % (self.baseFilename, time.strftime('%Y%m%d-%H%M%S', time.localtime(now)))
+				segment = name
+				n = 0
+				while os.path.exists(segment) or os.path.exists(segment + '.gz'):
+					n += 1
+					segment = '%s-%d' % (name, n)
+				os.rename(self.baseFilename, segment)
+				self._segments.put(segment)
+			self._reopen()
+		finally:
+			fcntl.flock(self._lockfile, fcntl.LOCK_UN)
+	def emit(self, record):
+		try:
+			text = self.format(record) + '\n'
+			if isinstance(text, unicode):
+				text = text.encode('utf-8')
+			self.write(text)
+			self.flush()
+		except Exception:
+			self.handleError(record)
+	##
+	# @brief compress a rotated file to <segment>.gz
+	def _compress(self, segment):
+		while True:
+			wait = os.stat(segment).st_mtime + self.delay - time.time()
+			if wait <= 0:
+				break
+			time.sleep(wait)
+		with open(segment, 'rb') as src:
+			dst = gzip.open(segment + '.gz.tmp', 'wb')
+			try:
+				shutil.copyfileobj(src, dst)
+			finally:
+				dst.close()
+		os.rename(segment + '.gz.tmp', segment + '.gz')
+		os.unlink(segment)
+	##
+	# @brief remove the oldest rotated files beyond keep
+	def _prune(self):
+		if not self.keep:
+			return
+		segments = [ p for p in glob.glob(self.baseFilename + '.*') if RE_SEGMENT.search(p[len(self.baseFilename):]) ]
+		segments.sort(key=segment_order)
+		for p in segments[:-self.keep]:
+			try:
+				os.unlink(p)
+			except OSError as e:
+				if e.errno != errno.ENOENT:
+					raise
+	##
+	# @brief Body of the compressor thread: compress the rotated files
+	# until the None that close() puts on the queue.
+	def _compress_loop(self, segments):
+		while True:
+			segment = segments.get()
+			if segment is None:
+				return
+			try:
+				self._compress(segment)
+				self._prune()
+			except (IOError, OSError):
+				# another process may have compressed or pruned it
+				pass
+	##
+	# @brief close the file and wait for the rotated files to be compressed
+	def close(self):
+		if self._pid == os.getpid() and self._compressor.is_alive():
+			self._segments.put(None)
+			self._compressor.join()
+			self._lockfile.close()
+		logging.FileHandler.close(self)
+
+##
+# @brief Formatter that writes a record as one JSON object per line, with
+# the fields time (local, with milliseconds), ts (seconds since the epoch),
+# level, module, line and msg, the REQUEST_FIELDS of request records, and
+# exc for exceptions.
+class JSONFormatter(logging.Formatter):
+	def format(self, record):
+		msg = record.getMessage()
+		if isinstance(msg, str):
+			msg = msg.decode('utf-8', 'replace')
+		entry = {
+			'time': '%s.%03d' % (self.formatTime(record, DFORMAT), record.msecs),
+			'ts': round(record.created, 3),
+			'level': record.levelname,
+			'module': record.module,
+			'line': record.lineno,
+			'msg': msg,
+		}
+		for k in REQUEST_FIELDS:
+			if k in record.__dict__:
+				entry[k] = record.__dict__[k]
+		if record.exc_info and not record.exc_text:
+			record.exc_text = self.formatException(record.exc_info)
+		if record.exc_text:
+			entry['exc'] = record.exc_text.decode('utf-8', 'replace') if isinstance(record.exc_text, str) else record.exc_text
+		return json.dumps(entry, separators=(',', ':'))
+
+## Default seconds over which the messages of a template are counted
+LIMIT_WINDOW = 10.0
+## Most templates counted at once. Messages with other templates share one
+# count, so that a flood of distinct messages cannot grow the counts.
+LIMIT_TEMPLATES = 1000
+
+##
+# @brief Rate limit of log messages by template, the message before the
+# arguments are filled in. Messages are counted in windows of a fixed
+# length. The first burst messages of a template in a window are logged;
+# of the rest, one in sample is, and the others are suppressed.
+class RateLimiter:
+	##
+	# @param burst messages of a template logged per window
+	# @param window length of a window, in seconds
+	# @param sample log one in this many messages beyond burst, 0 for none
+	def __init__(self, burst, window=LIMIT_WINDOW, sample=0):
+		self.burst = burst
+		self.window = window
+		self.sample = sample
+		## number of messages suppressed so far
+		self.suppressed = 0
+		self._counts = {}
+		self._lock = threading.Lock()
+		self._start = time.time()
+		## time at which the current window ends, see sweep()
+		self.ends = self._start + window
+	##
+	# @brief count a message
+	#
+	# @param key the template, with anything else that tells messages apart
+	#
+	# @return whether to log the message
+	def allow(self, key):
+		with self._lock:
+			count = self._counts.get(key)
+			if count is None:
+				if len(self._counts) >= LIMIT_TEMPLATES:
+					key = None
+				count = self._counts.setdefault(key, [ 0, 0, ])
+			count[0] += 1
+			over = count[0] - self.burst
+			if over <= 0 or self.sample and over % self.sample == 0:
+				return True
+			count[1] += 1
+			self.suppressed += 1
+			return False
+	##
+	# @brief Start a new window if the current one has ended.
+	#
+	# @param now the time
+	#
+	# @return list of tuples (key, number of messages suppressed) of the
+	# templates that had messages suppressed in the window that ended,
+	# and the length of that window in seconds
+	def sweep(self, now):
+		with self._lock:
+			if now < self.ends:
+				return ([], 0)
+			(counts, self._counts) = (self._counts, {})
+			elapsed = now - self._start
+			self._start = now
+			self.ends = now + self.window
+		return ([ (key, count[1]) for (key, count) in counts.items() if count[1] ], elapsed)
 
 ##
 # @brief Logging mechanism
@@ -22,8 +459,20 @@ class CTFLogger(logging.Logger):
 	# @brief initialize a logging object
 	#
 	# @param args list of files to log to
-	# @param kwargs use level= to set log level. default is DEBUG
+	# @param kwargs use level= to set log level. default is DEBUG.
+	# queue= sets the size of a queue that records are written from by
+	# a background thread, see QueueHandler. 0, the default, writes them
+	# on the logging thread. overflow= is what to do when the queue is
+	# full, an entry of OVERFLOW. rotate_size=, rotate_interval= and
+	# rotate_keep= rotate the files, see RotatingFileHandler.
+	# limit_burst=, limit_window= and limit_sample= rate limit messages
+	# below CRITICAL by template, see RateLimiter. Pass the arguments of a
+	# message separately, l.warn('username %s does not exist.', username),
+	# for the limit to see the template. format= is an entry of FORMATS.
 	def __init__(self, *args, **kwargs):
+		# a logger that is initialized again stops its old writer
+		for h in getattr(self, 'handlers', []):
+			h.close()
 		# call parent init
 		logging.Logger.__init__(self, '', level=logging.DEBUG)
 		stderr = True
@@ -33,16 +482,83 @@ class CTFLogger(logging.Logger):
 		if 'stderr' in kwargs:
 			stderr = kwargs['stderr']
 		# set formatting
-		fmt = logging.Formatter(LFORMAT, DFORMAT)
+		if kwargs.get('format') not in ( None, ) + FORMATS:
+			raise ValueError('format must be one of %s' % ', '.join(FORMATS))
+		if kwargs.get('format') == 'json':
+			fmt = JSONFormatter()
+		else:
+			fmt = logging.Formatter(LFORMAT, DFORMAT)
+		handlers = []
 		# defaults to stderr
 		if stderr:
 			sh = logging.StreamHandler()
 			sh.setFormatter(fmt)
-			self.addHandler(sh)
+			handlers.append(sh)
+		rotate = dict((k, kwargs.get('rotate_' + k) or 0) for k in ( 'size', 'interval', 'keep', ))
 		for f in args:
-			fh = logging.FileHandler(f)
+			if rotate['size'] or rotate['interval']:
+				fh = RotatingFileHandler(f, **rotate)
+			else:
+				fh = logging.FileHandler(f)
 			fh.setFormatter(fmt)
-			self.addHandler(fh)
+			handlers.append(fh)
+		if kwargs.get('queue'):
+			handlers = [ QueueHandler(handlers, size=kwargs['queue'],
+					overflow=kwargs.get('overflow') or 'drop') ]
+		for h in handlers:
+			self.addHandler(h)
+		self.limiter = None
+		if kwargs.get('limit_burst'):
+			self.limiter = RateLimiter(kwargs['limit_burst'], window=kwargs.get('limit_window') or LIMIT_WINDOW,
+					sample=kwargs.get('limit_sample') or 0)
+	##
+	# @brief Create a record, unless the rate limit suppresses it. A
+	# suppressed message costs a count: no record is created and the
+	# message is not formatted.
+	def _log(self, level, msg, args, exc_info=None, extra=None):
+		limiter = self.limiter
+		if limiter is not None and level < logging.CRITICAL:
+			now = time.time()
+			if now >= limiter.ends:
+				(suppressed, elapsed) = limiter.sweep(now)
+				for (key, n) in suppressed:
+					(lvl, template) = key or (logging.WARNING, 'messages of other templates')
+					logging.Logger._log(self, lvl, 'suppressed %s similar messages in the last %ds: %s',
+							(format(n, ','), round(elapsed), template))
+			if not limiter.allow((level, msg)):
+				return
+		logging.Logger._log(self, level, msg, args, exc_info, extra)
+	##
+	# @brief Log a request at INFO. Request records are never rate limited,
+	# so that the log can be analyzed. In the JSON format they carry the
+	# REQUEST_FIELDS.
+	#
+	# @param method the HTTP method
+	# @param route the path
+	# @param status the HTTP status code
+	# @param duration seconds the request took
+	# @param user the logged on user, or None
+	def request(self, method, route, status, duration, user=None):
+		if not self.isEnabledFor(logging.INFO):
+			return
+		duration = round(duration * 1e3, 3)
+		logging.Logger._log(self, logging.INFO, '%s %s %d %.1fms', (method, route, status, duration),
+				extra=dict(method=method, route=route, status=status, duration=duration, user=user))
+	##
+	# @brief Find the function that logged, skipping the methods of this
+	# class that log on behalf of their caller as well as the logging module.
+	def findCaller(self):
+		f = sys._getframe(1)
+		while f is not None:
+			if os.path.normcase(f.f_code.co_filename) != logging._srcfile and f.f_code not in CALLER_SKIP:
+				return (f.f_code.co_filename, f.f_lineno, f.f_code.co_name)
+			f = f.f_back
+		return ('(unknown file)', 0, '(unknown function)')
+	##
+	# @return number of records dropped because the queue was full
+	@property
+	def dropped(self):
+		return sum([ h.dropped for h in self.handlers if isinstance(h, QueueHandler) ])
 
 	##
 	# @brief log a critical error and exit
@@ -53,6 +569,9 @@ class CTFLogger(logging.Logger):
 		self.critical(msg + ' Exit %d' % ec)
 		sys.exit(ec)
 
+## Code of the CTFLogger methods that findCaller() skips
+CALLER_SKIP = ( CTFLogger._log.im_func.func_code, CTFLogger.request.im_func.func_code, )
+
 # Create a logging instance
 l = CTFLogger()
 
@@ -68,6 +587,20 @@ def exceptions(ex_cls, ex, tb):
 	exline = trace[3].replace(',','')
 	l.critical('%s:%s: %s: %s' % (exfile, exline, ex_cls, ex))
 
+##
+# @brief stream that takes a while to write, like a busy disk
+class SlowStream:
+	def __init__(self, delay=0.01):
+		self.data = ''
+		self.delay = delay
+	def write(self, text):
+		time.sleep(self.delay)
+		self.data += text
+	def flush(self):
+		pass
+	def lines(self):
+		return len(self.data.splitlines())
+
 class TestLogger(unittest.TestCase):
 	def test_init(self):
 		self.assertTrue(CTFLogger())
@@ -84,6 +617,174 @@ class TestLogger(unittest.TestCase):
 		self.assertTrue(CTFLogger(level='CRITICAL'))
 		self.assertTrue(os.path.exists('test-data/test.log'))
 		os.unlink('test-data/test.log')
+	def test_queue(self):
+		t = CTFLogger('test-data/queue.log', stderr=False, queue=10)
+		self.assertTrue(isinstance(t.handlers[0], QueueHandler))
+		for i in range(5):
+			t.info('queued %d' % i)
+		try:
+			raise ValueError('queued exception')
+		except ValueError:
+			t.exception('failed')
+		t.handlers[0].close()
+		with open('test-data/queue.log') as f:
+			data = f.read()
+		os.unlink('test-data/queue.log')
+		self.assertEqual([ 'queued %d' % i for i in range(5) ], [ line.split(': ')[-1] for line in data.splitlines()[:5] ])
+		self.assertTrue('ValueError: queued exception' in data)
+		self.assertEqual(t.dropped, 0)
+		self.assertRaises(ValueError, CTFLogger, queue=10, overflow='spill')
+	def test_overflow(self):
+		stream = SlowStream()
+		h = logging.StreamHandler(stream)
+		t = CTFLogger(stderr=False)
+		t.addHandler(QueueHandler([ h ], size=2, overflow='drop'))
+		for i in range(20):
+			t.info('drop %d' % i)
+		self.assertTrue(t.dropped > 0)
+		t.handlers[0].close()
+		self.assertEqual(stream.lines(), 20 - t.dropped + 1)
+		self.assertTrue('dropped %d records' % t.dropped in stream.data)
+		stream = SlowStream()
+		h = logging.StreamHandler(stream)
+		t = CTFLogger(stderr=False)
+		t.addHandler(QueueHandler([ h ], size=2, overflow='block'))
+		for i in range(20):
+			t.info('block %d' % i)
+		t.handlers[0].close()
+		self.assertEqual(t.dropped, 0)
+		self.assertEqual(stream.lines(), 20)
+	def test_fork(self):
+		t = CTFLogger('test-data/queue.log', stderr=False, queue=10)
+		t.info('parent')
+		pid = os.fork()
+		if not pid:
+			t.info('child')
+			logging.shutdown()
+			os._exit(0)
+		os.waitpid(pid, 0)
+		t.handlers[0].close()
+		with open('test-data/queue.log') as f:
+			data = f.read()
+		os.unlink('test-data/queue.log')
+		self.assertTrue('parent' in data and 'child' in data)
+	def rotated(self, path):
+		return sorted([ p for p in glob.glob(path + '.*') if RE_SEGMENT.search(p[len(path):]) ], key=segment_order)
+	def read(self, paths):
+		data = ''
+		for p in paths:
+			with (gzip.open(p) if p.endswith('.gz') else open(p)) as f:
+				data += f.read()
+		return data
+	def cleanup(self, path):
+		for p in glob.glob(path + '*'):
+			os.unlink(p)
+	def test_rotate_size(self):
+		path = os.path.abspath('test-data/rotate.log')
+		self.cleanup(path)
+		t = CTFLogger(path, stderr=False, rotate_size=200, rotate_keep=2)
+		t.handlers[0].delay = 0
+		for i in range(20):
+			t.info('rotate %d' % i)
+		t.handlers[0].close()
+		segments = self.rotated(path)
+		self.assertEqual(len(segments), 2)
+		self.assertTrue(all([ p.endswith('.gz') for p in segments ]))
+		lines = self.read(segments + [ path ]).splitlines()
+		self.assertEqual([ line.split(': ')[-1] for line in lines ], [ 'rotate %d' % i for i in range(20 - len(lines), 20) ])
+		self.cleanup(path)
+	def test_rotate_interval(self):
+		path = os.path.abspath('test-data/rotate.log')
+		self.cleanup(path)
+		t = CTFLogger(path, stderr=False, rotate_interval=3600)
+		t.handlers[0].delay = 0
+		t.info('yesterday')
+		t.handlers[0].flush()
+		os.utime(path, (time.time() - 86400, ) * 2)
+		t.info('today')
+		t.info('still today')
+		t.handlers[0].close()
+		segments = self.rotated(path)
+		self.assertEqual(len(segments), 1)
+		self.assertTrue('yesterday' in self.read(segments))
+		with open(path) as f:
+			self.assertEqual(len(f.readlines()), 2)
+		self.cleanup(path)
+	def test_rotate_processes(self):
+		path = os.path.abspath('test-data/rotate.log')
+		self.cleanup(path)
+		t = CTFLogger(path, stderr=False, queue=100, overflow='block', rotate_size=2000)
+		t.handlers[0].handlers[0].delay = 0.2
+		children = []
+		for n in range(4):
+			pid = os.fork()
+			if not pid:
+				for i in range(500):
+					t.info('process %d record %d' % (n, i))
+				logging.shutdown()
+				os._exit(0)
+			children.append(pid)
+		for pid in children:
+			os.waitpid(pid, 0)
+		t.handlers[0].close()
+		lines = self.read(self.rotated(path) + [ path ]).splitlines()
+		self.assertEqual(len(lines), 2000)
+		self.assertEqual(len(set(lines)), 2000)
+		self.assertFalse([ p for p in glob.glob(path + '.*') if not p.endswith(('.gz', '.lock')) ])
+		self.cleanup(path)
+	def test_limit(self):
+		stream = SlowStream(delay=0)
+		t = CTFLogger(stderr=False, limit_burst=3, limit_window=0.5, limit_sample=10)
+		h = logging.StreamHandler(stream)
+		h.setFormatter(logging.Formatter(LFORMAT, DFORMAT))
+		t.addHandler(h)
+		for i in range(50):
+			t.warn('username %s does not exist.', 'u%d' % i)
+			t.info('GET index')
+			t.critical('critical %d', i)
+		self.assertEqual(stream.data.count('does not exist'), 3 + 4)
+		self.assertEqual(stream.data.count('GET index'), 3 + 4)
+		self.assertEqual(stream.data.count('critical'), 50)
+		self.assertEqual(t.limiter.suppressed, 2 * 43)
+		self.assertTrue('log.py' not in stream.data and 'test_limit' not in stream.data)
+		time.sleep(0.5)
+		t.warn('username %s does not exist.', 'again')
+		self.assertTrue('suppressed 43 similar messages in the last 1s: username %s does not exist.' in stream.data)
+		self.assertTrue('suppressed 43 similar messages in the last 1s: GET index' in stream.data)
+		self.assertTrue('username again does not exist' in stream.data)
+	def test_limit_templates(self):
+		limiter = RateLimiter(1, window=60)
+		for i in range(LIMIT_TEMPLATES + 10):
+			limiter.allow('template %d' % i)
+			limiter.allow('template %d' % i)
+		self.assertEqual(len(limiter._counts), LIMIT_TEMPLATES + 1)
+		self.assertEqual(limiter.suppressed, LIMIT_TEMPLATES + 19)
+		(suppressed, elapsed) = limiter.sweep(limiter.ends)
+		self.assertEqual(sum([ n for (key, n) in suppressed ]), LIMIT_TEMPLATES + 19)
+		self.assertEqual(limiter._counts, {})
+	def test_json(self):
+		stream = SlowStream(delay=0)
+		t = CTFLogger(stderr=False, format='json', limit_burst=1)
+		h = logging.StreamHandler(stream)
+		h.setFormatter(JSONFormatter())
+		t.addHandler(h)
+		t.info('GET %s', 'index')
+		for i in range(3):
+			t.request('POST', '/purchase', 200, 0.0123456, user='alice')
+		try:
+			raise ValueError('caf\xc3\xa9')
+		except ValueError:
+			t.exception('failed')
+		entries = [ json.loads(line) for line in stream.data.splitlines() ]
+		self.assertEqual(len(entries), 5)
+		self.assertEqual(( entries[0]['msg'], entries[0]['level'], entries[0]['module'], ), ( 'GET index', 'INFO', 'log', ))
+		self.assertTrue('route' not in entries[0])
+		request = entries[3]
+		self.assertEqual([ request[k] for k in REQUEST_FIELDS ], [ 'POST', '/purchase', 200, 12.346, 'alice' ])
+		self.assertEqual(request['msg'], 'POST /purchase 200 12.3ms')
+		self.assertTrue(abs(request['ts'] - time.time()) < 5)
+		self.assertTrue(u'ValueError: caf\xe9' in entries[4]['exc'])
+		self.assertRaises(ValueError, CTFLogger, format='xml')
 	def test_log(self):
 		t = CTFLogger('test-data/test.log', stderr=False)
 		self.assertTrue(t)
@@ -0,0 +1,577 @@
+## @package metrics
+# Request latency metrics in the Prometheus text format.
+#
+# Every request is timed as a whole, by method and route, and broken down
+# into stages: cookie verification, session loads and saves, database
+# queries, template rendering and the captcha round trip. Code marks a
+# stage with timer() or timed(), which cost a thread-local lookup when no
+# request is being timed. Stages are exclusive: time spent in a stage that
+# runs inside another one only counts for the inner stage, and the time of
+# a request that is in no stage is counted as the stage 'other'. The stages
+# of a request are added up and observed once, when end() is called.
+#
+# Observations are counted in fixed histogram buckets, so the cost of a
+# request and the memory held do not grow with the traffic. Registry
+# renders the histograms, counters and the values of collector functions
+# for /metrics. Each process counts its own requests; with share() it also
+# writes a snapshot to a directory every few seconds, and render() adds up
+# the snapshots of the other live processes, so that any worker can answer
+# for all of them.
+
+# system modules
+import atexit
+import bisect
+import errno
+import glob
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.dont_write_byte_code = True
+
+## Upper bounds of the latency buckets, in seconds
+BUCKETS = ( 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, )
+## Content type of the text format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+## Default seconds between snapshots written by share()
+SHARE_INTERVAL = 5.0
+
+REQUEST_DURATION = 'ctf_request_duration_seconds'
+REQUESTS = 'ctf_requests_total'
+STAGE_DURATION = 'ctf_stage_duration_seconds'
+PROCESSES = 'ctf_metrics_processes'
+
+##
+# @brief Counts of observations in fixed buckets
+class Histogram:
+	def __init__(self, buckets=BUCKETS):
+		self.buckets = buckets
+		## observations per bucket, the last one for those above all bounds
+		self.counts = [ 0 ] * (len(buckets) + 1)
+		self.sum = 0.0
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+	##
+	# @brief add the observations of another histogram with the same buckets
+	def merge(self, counts, total):
+		for (i, n) in enumerate(counts):
+			self.counts[i] += n
+		self.sum += total
+	@property
+	def count(self):
+		return sum(self.counts)
+	##
+	# @return list of tuples (upper bound, number of observations up to it),
+	# ending with '+Inf'
+	def cumulative(self):
+		seen = 0
+		result = []
+		for (bound, n) in zip(self.buckets + ( '+Inf', ), self.counts):
+			seen += n
+			result.append((bound, seen))
+		return result
+
+##
+# @brief format a number for the text format
+def number(value):
+	if isinstance(value, (int, long)):
+		return str(value)
+	return repr(float(value))
+
+##
+# @brief format the labels of a sample
+#
+# @param labels tuple of (name, value) pairs
+#
+# @return '{name="value",...}', or '' without labels
+def format_labels(labels):
+	if not labels:
+		return ''
+	escape = lambda v: unicode(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+	return '{' + ','.join([ '%s="%s"' % (k, escape(v)) for (k, v) in labels ]) + '}'
+
+##
+# @brief Histograms, counters and collectors of one process
+class Registry:
+	def __init__(self):
+		self._families = {}
+		self._order = []
+		self._histograms = {}
+		self._counters = {}
+		self._collectors = {}
+		self._lock = threading.Lock()
+		self._shared = None
+		# held while a snapshot is written or removed
+		self._share_lock = threading.Lock()
+		self.describe(REQUEST_DURATION, 'histogram', 'Time to handle a request, by method and route.')
+		self.describe(REQUESTS, 'counter', 'Requests handled, by method, route and status.')
+		self.describe(STAGE_DURATION, 'histogram', 'Time a request spent in each stage, by route.')
+		self.describe(PROCESSES, 'gauge', 'Processes whose metrics are included.')
+	##
+	# @brief declare a metric. Samples of undeclared metrics are rendered
+	# as untyped.
+	#
+	# @param name name of the metric
+	# @param kind 'counter', 'gauge' or 'histogram'
+	# @param text help text
+	def describe(self, name, kind, text):
+		with self._lock:
+			if name not in self._families:
+				self._order.append(name)
+			self._families[name] = (kind, text)
+	##
+	# @brief add a function that returns samples whenever the metrics are
+	# read, for counts that are kept elsewhere
+	#
+	# @param key name of the collector, replacing one added before under it
+	# @param f function returning a list of tuples (name, labels, value)
+	def collector(self, key, f):
+		with self._lock:
+			self._collectors[key] = f
+	##
+	# @brief observe values of histograms and increment counters at once
+	#
+	# @param observations list of tuples (name, labels, value) of histograms
+	# @param increments list of tuples (name, labels) of counters
+	def record(self, observations, increments=()):
+		with self._lock:
+			for (name, labels, value) in observations:
+				h = self._histograms.get((name, labels))
+				if h is None:
+					h = self._histograms[(name, labels)] = Histogram()
+				h.observe(value)
+			for key in increments:
+				self._counters[key] = self._counters.get(key, 0) + 1
+	def observe(self, name, labels, value):
+		self.record([ (name, labels, value) ])
+	def inc(self, name, labels=()):
+		self.record([], [ (name, labels) ])
+	##
+	# @return the metrics of this process as a dictionary that can be
+	# written as JSON: histograms, a list of [name, labels, counts, sum],
+	# and samples, a list of [name, labels, value]
+	def snapshot(self):
+		with self._lock:
+			histograms = [ [ name, labels, list(h.counts), h.sum ] for ((name, labels), h) in self._histograms.iteritems() ]
+			samples = [ [ name, labels, n ] for ((name, labels), n) in self._counters.iteritems() ]
+			collectors = self._collectors.values()
+		for f in collectors:
+			samples.extend([ list(sample) for sample in f() ])
+		return dict(histograms=histograms, samples=samples)
+	##
+	# @brief write a snapshot of this process to a directory every interval
+	# seconds from a background thread, for render() in other processes.
+	# Starts at most one thread per process; call it after forking. The
+	# snapshot is removed when the process exits normally; a worker killed
+	# by a signal relies on its supervisor, see remove_snapshot().
+	#
+	# @param directory directory shared by the processes
+	# @param interval seconds between snapshots
+	def share(self, directory, interval=SHARE_INTERVAL):
+		with self._lock:
+			if self._shared == (os.getpid(), directory):
+				return
+			self._shared = (os.getpid(), directory)
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		atexit.register(self.unshare)
+		t = threading.Thread(target=self._write_snapshots, args=(directory, interval), name='metrics')
+		t.daemon = True
+		t.start()
+	##
+	# @brief stop writing snapshots and remove the one of this process
+	def unshare(self):
+		with self._share_lock:
+			with self._lock:
+				shared = self._shared
+				self._shared = None
+			# the registry may have been shared by the parent of a fork
+			if shared is not None and shared[0] == os.getpid():
+				remove_snapshot(shared[1], shared[0])
+	def _write_snapshots(self, directory, interval):
+		path = os.path.join(directory, '%d.json' % os.getpid())
+		while True:
+			with self._share_lock:
+				if self._shared != (os.getpid(), directory):
+					return
+				with open(path + '.tmp', 'w') as f:
+					json.dump(self.snapshot(), f)
+				os.rename(path + '.tmp', path)
+			time.sleep(interval)
+	##
+	# @brief read the snapshots of the other live processes and remove
+	# those of processes that have exited
+	#
+	# @return list of snapshots
+	def _read_snapshots(self, directory):
+		snapshots = []
+		for path in glob.glob(os.path.join(directory, '*.json')):
+			try:
+				pid = int(os.path.basename(path)[:-len('.json')])
+			except ValueError:
+				continue
+			if pid == os.getpid():
+				continue
+			try:
+				os.kill(pid, 0)
+			except OSError as e:
+				if e.errno == errno.ESRCH:
+					remove_snapshot(directory, pid)
+					continue
+			try:
+				with open(path) as f:
+					snapshots.append(json.load(f))
+			except (IOError, ValueError):
+				continue
+		return snapshots
+	##
+	# @brief the metrics in the text format
+	#
+	# @param directory directory of the snapshots of other processes to add
+	# up with this one, or None for this process only
+	#
+	# @return unicode string
+	def render(self, directory=None):
+		snapshots = [ self.snapshot() ]
+		if directory is not None:
+			snapshots.extend(self._read_snapshots(directory))
+		histograms = {}
+		samples = {}
+		for snapshot in snapshots:
+			for (name, labels, counts, total) in snapshot['histograms']:
+				key = (name, tuple([ tuple(pair) for pair in labels ]))
+				h = histograms.get(key)
+				if h is None:
+					h = histograms[key] = Histogram()
+				h.merge(counts, total)
+			for (name, labels, value) in snapshot['samples']:
+				key = (name, tuple([ tuple(pair) for pair in labels ]))
+				samples[key] = samples.get(key, 0) + value
+		samples[(PROCESSES, ())] = len(snapshots)
+		families = {}
+		for (key, h) in histograms.iteritems():
+			families.setdefault(key[0], []).append((key[1], h))
+		for (key, value) in samples.iteritems():
+			families.setdefault(key[0], []).append((key[1], value))
+		with self._lock:
+			order = self._order + sorted(set(families) - set(self._order))
+			described = dict(self._families)
+		lines = []
+		for name in order:
+			if name not in families:
+				continue
+			(kind, text) = described.get(name, ( 'untyped', None, ))
+			if text:
+				lines.append('# HELP %s %s' % (name, text))
+			lines.append('# TYPE %s %s' % (name, kind))
+			for (labels, value) in sorted(families[name]):
+				if not isinstance(value, Histogram):
+					lines.append('%s%s %s' % (name, format_labels(labels), number(value)))
+					continue
+				for (bound, n) in value.cumulative():
+					le = labels + ( ( 'le', bound if isinstance(bound, str) else number(bound) ), )
+					lines.append('%s_bucket%s %d' % (name, format_labels(le), n))
+				lines.append('%s_sum%s %s' % (name, format_labels(labels), number(value.sum)))
+				lines.append('%s_count%s %d' % (name, format_labels(labels), value.count))
+		return u'\n'.join(lines) + u'\n'
+
+## The registry of the process
+REGISTRY = Registry()
+
+##
+# @brief remove the snapshot of a process that has exited, e.g. from the
+# supervisor of the workers
+#
+# @param directory directory the process shared its metrics in
+# @param pid the process
+def remove_snapshot(directory, pid):
+	try:
+		os.unlink(os.path.join(directory, '%d.json' % pid))
+	except OSError:
+		pass
+
+##
+# @brief Stages of one request
+class Request(object):
+	__slots__ = ( 'stages', 'nested', )
+	def __init__(self):
+		## dictionary of stage => seconds
+		self.stages = {}
+		## stack of the seconds spent in stages nested in each open stage
+		self.nested = []
+
+##
+# @brief The request that the thread is handling
+class _Current(threading.local):
+	## Request object, None outside of a request
+	request = None
+_current = _Current()
+
+##
+# @brief start timing the stages of a request on this thread
+#
+# @return the Request, for end()
+def begin():
+	_current.request = Request()
+	return _current.request
+
+##
+# @brief Record a request and its stages. Stops timing stages on this
+# thread if it is handling that request.
+#
+# @param method the request method
+# @param route the route, one of a bounded set
+# @param status the response status
+# @param seconds the duration of the request
+# @param registry the Registry to record in
+# @param request the Request returned by begin(), by default the one of
+# this thread. A streamed response may end on another thread, e.g. when
+# the garbage collector closes it.
+def end(method, route, status, seconds, registry=None, request=None):
+	if request is None:
+		request = _current.request
+	if request is _current.request:
+		_current.request = None
+	stages = request.stages if request is not None else {}
+	labels = ( ( 'method', method ), ( 'route', route ), )
+	observations = [ (REQUEST_DURATION, labels, seconds) ]
+	observations.extend([ (STAGE_DURATION, ( ( 'route', route ), ( 'stage', stage ), ), t)
+			for (stage, t) in stages.iteritems() ])
+	observations.append((STAGE_DURATION, ( ( 'route', route ), ( 'stage', 'other' ), ),
+			max(0.0, seconds - sum(stages.itervalues()))))
+	(registry or REGISTRY).record(observations, [ (REQUESTS, labels + ( ( 'status', str(status) ), )) ])
+
+##
+# @return the time a stage starts, or None if no request is timed
+def _start():
+	request = _current.request
+	if request is None:
+		return None
+	request.nested.append(0.0)
+	return time.time()
+
+##
+# @brief add the time since start to a stage, less that of nested stages
+def _stop(stage, start):
+	if start is None:
+		return
+	elapsed = time.time() - start
+	request = _current.request
+	if request is None or not request.nested:
+		# the request ended inside the stage
+		return
+	nested = request.nested
+	own = elapsed - nested.pop()
+	if nested:
+		nested[-1] += elapsed
+	request.stages[stage] = request.stages.get(stage, 0.0) + own
+
+##
+# @brief Context manager that times a block as a stage of the request
+class timer(object):
+	__slots__ = ( 'stage', 'start', )
+	##
+	# @param stage name of the stage
+	def __init__(self, stage):
+		self.stage = stage
+	def __enter__(self):
+		self.start = _start()
+	def __exit__(self, *exc):
+		_stop(self.stage, self.start)
+
+##
+# @brief decorator that times calls of a function as a stage of the request
+#
+# @param stage name of the stage
+#
+# @return the decorator
+def timed(stage):
+	def decorate(f):
+		def decorated(*args, **kwargs):
+			start = _start()
+			try:
+				return f(*args, **kwargs)
+			finally:
+				_stop(stage, start)
+		return decorated
+	return decorate
+
+##
+# @brief Proxy whose attributes are functions of the target that are timed
+# as a stage, e.g. the templates of a web.template.render object
+class Timed(object):
+	##
+	# @param target the object whose functions are timed
+	# @param stage name of the stage
+	def __init__(self, target, stage):
+		self._target = target
+		self._stage = stage
+	def __getattr__(self, name):
+		return timed(self._stage)(getattr(self._target, name))
+
+class TestHistogram(unittest.TestCase):
+	def test_observe(self):
+		h = Histogram(buckets=( 0.1, 1.0, ))
+		for value in ( 0.05, 0.1, 0.5, 2.0, ):
+			h.observe(value)
+		self.assertEqual(h.counts, [ 2, 1, 1 ])
+		self.assertEqual(h.cumulative(), [ (0.1, 2), (1.0, 3), ('+Inf', 4) ])
+		self.assertEqual(( h.count, h.sum, ), ( 4, 2.65, ))
+		h.merge([ 1, 0, 0 ], 0.01)
+		self.assertEqual(h.cumulative()[0], (0.1, 3))
+
+class TestStages(unittest.TestCase):
+	def setUp(self):
+		self.registry = Registry()
+		self.clock = [ 0.0 ]
+		self.time = time.time
+		time.time = lambda: self.clock[0]
+	def tearDown(self):
+		time.time = self.time
+		_current.request = None
+	def tick(self, seconds):
+		self.clock[0] += seconds
+	def histograms(self):
+		return dict(((name, labels), (counts, total)) for (name, labels, counts, total)
+				in self.registry.snapshot()['histograms'])
+	def test_outside_request(self):
+		with timer('db'):
+			self.tick(1)
+		self.assertEqual(_current.request, None)
+	def test_nested(self):
+		@timed('render')
+		def render():
+			self.tick(0.003)
+			with timer('session'):
+				self.tick(0.02)
+			return 'page'
+		request = begin()
+		with timer('db'):
+			self.tick(0.001)
+			with timer('db_wait'):
+				self.tick(0.002)
+		self.assertEqual(render(), 'page')
+		with timer('db'):
+			self.tick(0.001)
+		self.tick(0.004)
+		self.assertEqual(dict((k, round(v, 6)) for (k, v) in request.stages.items()),
+				dict(db=0.002, db_wait=0.002, render=0.003, session=0.02))
+		end('GET', '/', 200, 0.031, registry=self.registry)
+		self.assertEqual(_current.request, None)
+		histograms = self.histograms()
+		stage = lambda s: histograms[(STAGE_DURATION, ( ( 'route', '/' ), ( 'stage', s ), ))]
+		self.assertEqual(round(stage('other')[1], 6), 0.004)
+		self.assertEqual(stage('session')[0][BUCKETS.index(0.025)], 1)
+		self.assertEqual(sum(histograms[(REQUEST_DURATION, ( ( 'method', 'GET' ), ( 'route', '/' ), ))][0]), 1)
+		samples = self.registry.snapshot()['samples']
+		self.assertEqual(samples, [ [ REQUESTS, ( ( 'method', 'GET' ), ( 'route', '/' ), ( 'status', '200' ), ), 1 ] ])
+	def test_exception(self):
+		@timed('captcha')
+		def fail():
+			self.tick(0.5)
+			raise IOError()
+		request = begin()
+		self.assertRaises(IOError, fail)
+		self.assertEqual(request.stages, dict(captcha=0.5))
+	def test_proxy(self):
+		class Render:
+			def page(this, n):
+				self.tick(0.25)
+				return n + 1
+		request = begin()
+		self.assertEqual(Timed(Render(), 'render').page(1), 2)
+		self.assertEqual(request.stages, dict(render=0.25))
+	def test_other_thread(self):
+		# a streamed page closed by a thread that handles another request
+		streamed = begin()
+		with timer('render'):
+			self.tick(0.25)
+		seen = []
+		def close():
+			own = begin()
+			with timer('db'):
+				self.tick(0.5)
+			end('GET', '/', 200, 1.0, registry=self.registry, request=streamed)
+			with timer('session'):
+				self.tick(0.5)
+			seen.append((own.stages, _current.request is own))
+		t = threading.Thread(target=close)
+		t.start()
+		t.join()
+		self.assertEqual(seen, [ ( dict(db=0.5, session=0.5), True ) ])
+		self.assertTrue(_current.request is streamed)
+		histograms = self.histograms()
+		self.assertEqual(sorted(labels[1][1] for (name, labels) in histograms if name == STAGE_DURATION),
+				[ 'other', 'render' ])
+		self.assertEqual(histograms[(STAGE_DURATION, ( ( 'route', '/' ), ( 'stage', 'other' ), ))][1], 0.75)
+
+class TestRegistry(unittest.TestCase):
+	def parse(self, text):
+		return dict(line.rsplit(' ', 1) for line in text.splitlines() if not line.startswith('#'))
+	def test_render(self):
+		r = Registry()
+		r.describe('ctf_things', 'gauge', 'Things.')
+		r.collector('things', lambda: [ ( 'ctf_things', ( ( 'kind', 'a"b\\' ), ), 3 ) ])
+		r.observe(REQUEST_DURATION, ( ( 'method', 'GET' ), ( 'route', '/' ), ), 0.003)
+		r.inc(REQUESTS, ( ( 'method', 'GET' ), ( 'route', '/' ), ( 'status', '200' ), ))
+		r.inc('ctf_odd')
+		text = r.render()
+		self.assertTrue('# TYPE ctf_request_duration_seconds histogram\n' in text)
+		self.assertTrue('# HELP ctf_things Things.\n# TYPE ctf_things gauge\n' in text)
+		self.assertTrue('# TYPE ctf_odd untyped\n' in text)
+		samples = self.parse(text)
+		self.assertEqual(samples['ctf_request_duration_seconds_bucket{method="GET",route="/",le="0.0025"}'], '0')
+		self.assertEqual(samples['ctf_request_duration_seconds_bucket{method="GET",route="/",le="0.005"}'], '1')
+		self.assertEqual(samples['ctf_request_duration_seconds_bucket{method="GET",route="/",le="+Inf"}'], '1')
+		self.assertEqual(samples['ctf_request_duration_seconds_sum{method="GET",route="/"}'], '0.003')
+		self.assertEqual(samples['ctf_request_duration_seconds_count{method="GET",route="/"}'], '1')
+		self.assertEqual(samples['ctf_requests_total{method="GET",route="/",status="200"}'], '1')
+		self.assertEqual(samples['ctf_things{kind="a\\"b\\\\"}'], '3')
+		self.assertEqual(samples['ctf_metrics_processes'], '1')
+		# a collector is replaced by one with the same key
+		r.collector('things', lambda: [])
+		self.assertFalse('ctf_things' in r.render())
+	def test_share(self):
+		directory = 'test-data/metrics'
+		r = Registry()
+		r.observe(REQUEST_DURATION, ( ( 'route', '/' ), ), 0.003)
+		r.inc(REQUESTS, ( ( 'route', '/' ), ))
+		try:
+			r.share(directory, interval=60)
+			path = os.path.join(directory, '%d.json' % os.getpid())
+			for i in xrange(100):
+				if os.path.exists(path):
+					break
+				time.sleep(0.01)
+			# the snapshot of a live process, and of one that has exited
+			pid = os.fork()
+			if not pid:
+				os._exit(0)
+			os.waitpid(pid, 0)
+			with open(path) as f:
+				snapshot = f.read()
+			for other in ( os.getppid(), pid, ):
+				with open(os.path.join(directory, '%d.json' % other), 'w') as f:
+					f.write(snapshot)
+			samples = self.parse(r.render(directory))
+			self.assertEqual(samples['ctf_requests_total{route="/"}'], '2')
+			self.assertEqual(samples['ctf_request_duration_seconds_count{route="/"}'], '2')
+			self.assertEqual(samples['ctf_metrics_processes'], '2')
+			self.assertFalse(os.path.exists(os.path.join(directory, '%d.json' % pid)))
+			# stopping removes the snapshot of this process
+			r.unshare()
+			self.assertFalse(os.path.exists(path))
+		finally:
+			r.unshare()
+			for path in glob.glob(os.path.join(directory, '*')):
+				os.unlink(path)
+			os.rmdir(directory)
+
+if __name__ == '__main__':
+	# run from the same directory as the module
+	os.chdir(os.path.dirname(os.path.abspath(sys.argv[0])))
+	sys.exit(unittest.main(verbosity=2))
@@ -15,25 +15,61 @@
 # Key-Hashed Message Authentication Codes.
 # - Anti-Replay: Prevent cookie re-use. Achieved through Session ID.
 #
-# The implementation below uses a fixed size packed structure to store
-# the cookie. The fields are as follows:
+# Two cookie formats are understood. Version 1 is a fixed size packed
+# structure with the following fields:
 # - username   => 64 characters
 # - expiration => long long
 # - data       => 256 characters
-# - Session ID => 20 bytes
 # - Digest     => 20 bytes
+#
+# Version 2 is written by default. It is url-safe base64 of a header
+# followed by variable sized fields:
+# - version     => 1 byte, always 2
+# - user length => 1 byte
+# - expiration  => long long
+# - data length => 2 bytes
+# - username    => user length characters
+# - data        => data length rounded up to whole AES blocks
+# - Digest      => 20 bytes
+#
+# In both formats the digest also covers the 20 byte Session ID, which
+# is never sent to the client.
+#
+# Version 1 and 2 belong to the legacy cipher suite: AES-CBC with a key
+# derived per user and expiration, authenticated by a separate HMAC. The
+# aead cipher suite writes version 3, which uses ChaCha20-Poly1305 to encrypt
+# and authenticate in a single pass with one key derived from the secret:
+# - header      => version 2 header with version 3, then a 12 byte nonce
+# - username    => user length characters
+# - data        => data length bytes
+# - Tag         => 16 bytes
+#
+# The header, username and Session ID are authenticated as associated data.
+# Cookies of every version are accepted whichever suite writes new ones.
 
 # system modules
+import base64
+import collections
 import hashlib
 import hmac
+import itertools
+import multiprocessing
 import os
+import re
 import struct
 import sys
+import threading
 import time
 import unittest
 from Crypto.Cipher import AES
+try:
+	from Crypto.Cipher import ChaCha20_Poly1305
+except ImportError:
+	# only pycryptodome provides it, see HAVE_AEAD
+	ChaCha20_Poly1305 = None
 
 # local modules
+import metrics
 from log import l
 
 sys.dont_write_byte_code = True
@@ -44,6 +80,34 @@ EXPR_FMT = 'q'
 DATA_FMT = '256s'
 SESS_FMT = '20s'
 DGST_FMT = '20s'
+DGST_LEN = 20
+
+## Cookie format versions
+V1 = 1
+V2 = 2
+V3 = 3
+## Version 1 layout: user, expiration, encrypted data, digest
+V1_STRUCT = struct.Struct(USER_FMT + EXPR_FMT + DATA_FMT + DGST_FMT)
+## Version 2 header: version, user length, expiration, data length
+V2_STRUCT = struct.Struct('!BBqH')
+## Version 3 header: version, user length, expiration, data length, nonce
+V3_STRUCT = struct.Struct('!BBqH12s')
+NONCE_LEN = 12
+TAG_LEN = 16
+
+## Cipher suites by name, and the cookie version each one writes
+SUITES = { 'legacy': V2, 'aead': V3 }
+## Whether the installed Crypto library provides ChaCha20-Poly1305
+HAVE_AEAD = ChaCha20_Poly1305 is not None
+
+RE_B64 = re.compile('^[A-Za-z0-9_-]+$')
+
+## Maximum number of derived keys kept by KeyCache
+KEYCACHE_SIZE = 4096
+## Maximum number of SecureCookie objects kept by verifier()
+VERIFIERS_SIZE = 4096
+## Expiration for cache entries that never expire
+NEVER = float('inf')
 
 ##
 # @brief convenience wrapper for turning arbitrary data into readable hex
@@ -54,15 +118,28 @@ DGST_FMT = '20s'
 def bytes_to_hex(s):
 	return ':'.join(x.encode('hex') for x in s)
 
+##
+# @brief create a keyed HMAC context that can be reused with HMAC()
+#
+# @param secret the key as arbitrary bytes
+#
+# @return HMAC object with the key already applied
+def keyed(secret):
+	return hmac.new(secret, digestmod=hashlib.sha1)
+
 ##
 # @brief compute a Key-Hashed Message Authentication Code
 #
 # @param msg the message as arbitrary bytes
-# @param secret the key as arbitrary bytes
+# @param secret the key as arbitrary bytes, or a context created by keyed().
+# Passing a context skips the key setup on every call.
 #
 # @return 20 byte digest
 def HMAC(msg, secret):
-	h = hmac.new(secret, digestmod=hashlib.sha1)
+	if isinstance(secret, str):
+		h = keyed(secret)
+	else:
+		h = secret.copy()
 	for i in range(100):
 		h.update(msg)
 	return h.digest()
@@ -73,7 +150,7 @@ def HMAC(msg, secret):
 #
 # @param user username (public)
 # @param expiration expiration date (public)
-# @param secret secret (private)
+# @param secret secret (private), or a context created by keyed()
 #
 # @return 20 byte secret key tied to this user and expiration
 def hashk(user, expiration, secret):
@@ -87,7 +164,8 @@ def hashk(user, expiration, secret):
 # @param expiration expiration date (public)
 # @param data data to be encrypted in the cookie (private)
 # @param session session ID (public)
-# @param key secret key generated by HMAC of user/expiration/secret
+# @param key secret key generated by HMAC of user/expiration/secret,
+# or a context created by keyed()
 #
 # @return 20 byte authentication code of cookie data
 def hashd(user, expiration, data, session, key):
@@ -95,6 +173,65 @@ def hashd(user, expiration, data, session, key):
 			user, expiration, data, session)
 	return HMAC(msg, key)
 
+##
+# @brief compute HMAC over a version 2 cookie
+#
+# @param head packed V2_STRUCT header, which covers user and expiration
+# @param user username (public)
+# @param data data to be encrypted in the cookie (private)
+# @param session session ID (public)
+# @param key secret key generated by HMAC of user/expiration/secret,
+# or a context created by keyed()
+#
+# @return 20 byte authentication code of cookie data
+def hashd2(head, user, data, session, key):
+	return HMAC(head + user + data + session, key)
+
+##
+# @brief hash information about a client into a Session ID
+#
+# @param info dictionary of the information, e.g. HTTP headers
+#
+# @return 20 byte hash of the values, in key order
+def session_hash(info):
+	h = hashlib.sha1()
+	for key in sorted(info):
+		value = str(info[key])
+		# the lengths keep the boundaries between values unambiguous
+		h.update(struct.pack('!I', len(value)))
+		h.update(value)
+	return h.digest()
+
+##
+# @brief round a length up to a whole number of AES blocks
+#
+# @param n length in bytes
+#
+# @return the padded length, at least one block
+def blocks(n):
+	return max(1, (n + AES.block_size - 1) // AES.block_size) * AES.block_size
+
+##
+# @brief url-safe base64 without padding, suitable for a cookie value
+#
+# @param s arbitrary bytes
+#
+# @return encoded string
+def b64encode(s):
+	return base64.urlsafe_b64encode(s).rstrip('=')
+
+##
+# @brief inverse of b64encode()
+#
+# @param s encoded string
+#
+# @return decoded bytes
+def b64decode(s):
+	try:
+		return base64.urlsafe_b64decode(s + '=' * (-len(s) % 4))
+	except TypeError:
+		raise struct.error('bad base64 padding')
+
 ##
 # @brief encrypt a message with AES
 #
@@ -120,22 +257,208 @@ def decrypt(msg, key, iv):
 	crypter = AES.new(key, AES.MODE_CBC, iv)
 	return crypter.decrypt(msg)
 
+##
+# @brief list the cipher suites usable with the installed Crypto library
+#
+# @return list of suite names
+def suites():
+	return [name for name in SUITES if HAVE_AEAD or SUITES[name] != V3]
+
+##
+# @brief create a ChaCha20-Poly1305 cipher
+#
+# @param key 32 byte secret key (private)
+# @param nonce 12 byte nonce, never reused with the same key (public)
+# @param aad associated data to authenticate but not encrypt (public)
+#
+# @return cipher object ready for encrypt() or decrypt()
+def aead(key, nonce, aad):
+	crypter = ChaCha20_Poly1305.new(key=key, nonce=nonce)
+	crypter.update(aad)
+	return crypter
+
+##
+# @brief Bounded, thread-safe cache of derived cookie keys.
+#
+# Entries are evicted in least recently used order once the cache is full,
+# and are never returned after their expiration time has passed. The hits
+# and misses counters record how effective the cache is.
+#
+# Lookups do not wait for the lock: the entry is read with a single dict
+# lookup, and its recency is only refreshed when the lock is free. Under
+# contention the order is approximate, a lookup may miss an entry that is
+# being moved, and the counters may lose updates; none of this affects the
+# values returned.
+class KeyCache:
+	##
+	# @brief create an empty cache
+	#
+	# @param size maximum number of entries
+	def __init__(self, size=KEYCACHE_SIZE):
+		self._size = size
+		self._entries = collections.OrderedDict()
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+	##
+	# @return number of entries in the cache
+	def __len__(self):
+		return len(self._entries)
+	##
+	# @brief look up a cached value
+	#
+	# @param key the cache key
+	# @param now current time, defaults to time.time()
+	#
+	# @return the cached value, or None if it is missing or expired
+	def get(self, key, now=None):
+		if now is None:
+			now = time.time()
+		# dict.get() is atomic, so readers never block on the lock
+		entry = self._entries.get(key)
+		if entry is None or entry[1] <= now:
+			self.misses += 1
+			if entry is not None and self._lock.acquire(False):
+				try:
+					# drop the stale entry unless it was just replaced
+					if self._entries.get(key) is entry:
+						del self._entries[key]
+				finally:
+					self._lock.release()
+			return None
+		self.hits += 1
+		if self._lock.acquire(False):
+			try:
+				# reinsert to mark as most recently used
+				if self._entries.pop(key, None) is not None:
+					self._entries[key] = entry
+			finally:
+				self._lock.release()
+		return entry[0]
+	##
+	# @brief add a value to the cache
+	#
+	# @param key the cache key
+	# @param value the value to cache
+	# @param expiration time after which the value is no longer returned
+	# @param now current time, defaults to time.time()
+	def put(self, key, value, expiration, now=None):
+		if now is None:
+			now = time.time()
+		if expiration <= now:
+			# never cache something that is already stale
+			return
+		with self._lock:
+			self._entries.pop(key, None)
+			if len(self._entries) >= self._size:
+				self._evict(now)
+			self._entries[key] = (value, expiration)
+	##
+	# @brief make room for a new entry. Expired entries are dropped first,
+	# then the least recently used ones. The caller must hold the lock.
+	#
+	# @param now current time
+	def _evict(self, now):
+		for key in [k for (k, e) in self._entries.iteritems() if e[1] <= now]:
+			del self._entries[key]
+		while len(self._entries) >= self._size:
+			self._entries.popitem(last=False)
+	##
+	# @brief remove all entries and reset the counters
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self.hits = 0
+			self.misses = 0
+
+##
+# @brief The verified contents of an authentication cookie.
+#
+# Produced by SecureCookie.verify() so that callers can read the user,
+# expiration and data of a cookie without repeating the cryptography.
+class Credentials:
+	##
+	# @brief hold the fields of a verified cookie
+	#
+	# @param user owner of the cookie (public)
+	# @param expiration expiration time of the cookie (public)
+	# @param data decrypted data section of the cookie (private)
+	def __init__(self, user, expiration, data):
+		self.user = user
+		self.expiration = expiration
+		self.data = data
+
 ##
 # @brief Secure Cookie implementation
 class SecureCookie:
+	## Derived keys shared by all cookies, keyed on (secret, user, expiration)
+	keys = KeyCache()
 	##
 	# @brief initialize a cookie that is unique per session
 	#
 	# @param session unique identifying information about the session (public)
 	# @param secret secret key uses for encrypting all cookies
+	# @param suite name of the cipher suite used for new cookies, see SUITES
 	#
 	# @return SecureCookie object
-	def __init__(self, session, secret):
+	def __init__(self, session, secret, suite='legacy'):
+		if suite not in suites():
+			raise ValueError('cipher suite %s is not available' % suite)
 		s = hashlib.sha1()
 		s.update(session)
 		self._session = session
 		self._secret = secret
 		self._ivec = s.digest()[:16]
+		self._mac = keyed(secret)
+		self._version = SUITES[suite]
+		# a single key for the aead suite, independent of the legacy keys
+		self._aead = hmac.new(secret, 'scp aead', hashlib.sha256).digest()
+	##
+	# @brief HMAC contexts cannot be pickled, so leave out the keyed context
+	# when the cookie is stored and rebuild it when it is loaded.
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		del state['_mac']
+		return state
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._mac = keyed(self._secret)
+		# cookies stored before cipher suites existed
+		if '_version' not in state:
+			self._version = V2
+			self._aead = hmac.new(self._secret, 'scp aead', hashlib.sha256).digest()
+	##
+	# @brief get the derived key for a user and expiration, using the
+	# shared key cache when possible
+	#
+	# @param user username (public)
+	# @param expiration expiration date (public)
+	# @param cache whether keys that are derived are added to the cache.
+	# False when the user and expiration come from a cookie that has not
+	# been verified, so that forged cookies cannot evict real users' keys.
+	#
+	# @return tuple (20 byte key tied to this user and expiration,
+	# keyed HMAC context of that key)
+	def _keys(self, user, expiration, cache=True):
+		k = (self._secret, user, expiration)
+		keys = self.keys.get(k)
+		if keys is None:
+			keys = self._derive(user, expiration)
+			if cache:
+				self.keys.put(k, keys, expiration)
+		return keys
+	##
+	# @brief derive the key for a user and expiration, bypassing the cache
+	#
+	# @return tuple as returned by _keys()
+	def _derive(self, user, expiration):
+		key = hashk(user, expiration, self._mac)
+		return (key, keyed(key))
+	##
+	# @return the 20 byte derived key for a user and expiration, which is
+	# not added to the cache, see _keys()
+	def _key(self, user, expiration):
+		return self._keys(user, expiration, cache=False)[0]
 	##
 	# @brief convert inputs to a packed data structure suiteable for
 	# passing to the client
@@ -143,14 +466,56 @@ class SecureCookie:
 	# @param user any tag that identifies the owner of the data (public)
 	# @param expiration time at which the cookie has expired (public)
 	# @param data any data we wish to store with the client (private)
+	# @param version cookie format to write. Defaults to the version of
+	# the cipher suite chosen at construction.
+	# @param cache whether the derived keys are cached, see _keys()
 	#
 	# @return stream that can be used to set a client cookie
-	def serialize(self, user, expiration, data):
-		key = hashk(user, expiration, self._secret)
-		mac = hashd(user, expiration, data, self._session, str(key))
-		ciphertext = encrypt(data.ljust(256, '\0'), str(key)[:16], self._ivec)
-		return struct.pack(USER_FMT + EXPR_FMT + DATA_FMT + DGST_FMT,
-				user, expiration, ciphertext, mac)
+	@metrics.timed('cookie')
+	def serialize(self, user, expiration, data, version=None, cache=True):
+		if version is None:
+			version = self._version
+		if version == V3:
+			head = V3_STRUCT.pack(V3, len(user), expiration, len(data), os.urandom(NONCE_LEN))
+			crypter = aead(self._aead, head[-NONCE_LEN:], head + user + self._session)
+			ciphertext = crypter.encrypt(data)
+			return b64encode(head + user + ciphertext + crypter.digest())
+		(key, kmac) = self._keys(user, expiration, cache)
+		if version == V1:
+			mac = hashd(user, expiration, data, self._session, kmac)
+			ciphertext = encrypt(data.ljust(256, '\0'), key[:16], self._ivec)
+			return V1_STRUCT.pack(user, expiration, ciphertext, mac)
+		head = V2_STRUCT.pack(V2, len(user), expiration, len(data))
+		mac = hashd2(head, user, data, self._session, kmac)
+		ciphertext = encrypt(data.ljust(blocks(len(data)), '\0'), key[:16], self._ivec)
+		return b64encode(head + user + ciphertext + mac)
+	##
+	# @brief convert a cookie stream of either format into its components
+	#
+	# @param cookie cookie stream created by serialize()
+	#
+	# @return (version, user, expiration, encrypted data, data length, mac)
+	def _unpack(self, cookie):
+		if len(cookie) == V1_STRUCT.size and not RE_B64.match(cookie):
+			(user, expiration, ciphertext, mac) = V1_STRUCT.unpack(cookie)
+			return (V1, user.rstrip('\0'), expiration, ciphertext.rstrip('\0'), None, mac)
+		if not RE_B64.match(cookie):
+			raise struct.error('cookie is not url-safe base64')
+		raw = b64decode(cookie)
+		(version, ulen, expiration, dlen) = V2_STRUCT.unpack_from(raw)
+		if version == V3:
+			if len(raw) != V3_STRUCT.size + ulen + dlen + TAG_LEN:
+				raise struct.error('bad cookie length')
+			user = raw[V3_STRUCT.size:V3_STRUCT.size + ulen]
+			# keep the nonce with the encrypted data
+			ciphertext = raw[V3_STRUCT.size - NONCE_LEN:V3_STRUCT.size] + raw[V3_STRUCT.size + ulen:-TAG_LEN]
+			return (V3, user, expiration, ciphertext, dlen, raw[-TAG_LEN:])
+		clen = blocks(dlen)
+		if version != V2 or len(raw) != V2_STRUCT.size + ulen + clen + DGST_LEN:
+			raise struct.error('bad cookie version or length')
+		user = raw[V2_STRUCT.size:V2_STRUCT.size + ulen]
+		ciphertext = raw[V2_STRUCT.size + ulen:-DGST_LEN]
+		return (V2, user, expiration, ciphertext, dlen, raw[-DGST_LEN:])
 	##
 	# @brief convert a cookie stream into it's individual components
 	#
@@ -158,14 +523,52 @@ class SecureCookie:
 	#
 	# @return (user, expiration, encrypted data, mac)
 	def deserialize(self, cookie):
-		unpacked = struct.unpack(USER_FMT + EXPR_FMT + DATA_FMT + DGST_FMT, cookie)
-		if len(unpacked) != 4:
-			l.error("Failed to unpack cookie data.")
-		user = unpacked[0]
-		expiration = unpacked[1]
-		ciphertext = unpacked[2]
-		mac = unpacked[3]
-		return (user.rstrip('\0'), expiration, ciphertext.rstrip('\0'), mac)
+		(_, user, expiration, ciphertext, _, mac) = self._unpack(cookie)
+		return (user, expiration, ciphertext, mac)
+	##
+	# @brief decrypt the data of an unpacked cookie and check its integrity
+	#
+	# @param unpacked the tuple returned by _unpack()
+	# @param keys derived keys for legacy cookies, as returned by _keys().
+	# Looked up when not given, and only added to the key cache once the
+	# cookie has proved to be genuine, so that forged cookies with made up
+	# users and expirations cannot evict the keys of real users.
+	#
+	# @return the plaintext, or None if the cookie has been altered
+	def _open(self, unpacked, keys=None):
+		(version, user, expiration, ciphertext, dlen, mac) = unpacked
+		if version == V3:
+			if not HAVE_AEAD:
+				l.error("Cannot verify aead cookie without ChaCha20-Poly1305 support.")
+				return None
+			nonce = ciphertext[:NONCE_LEN]
+			head = V3_STRUCT.pack(V3, len(user), expiration, dlen, nonce)
+			crypter = aead(self._aead, nonce, head + user + self._session)
+			plaintext = crypter.decrypt(ciphertext[NONCE_LEN:])
+			try:
+				crypter.verify(mac)
+			except ValueError:
+				return None
+			return plaintext
+		derived = None
+		if keys is None:
+			keys = self.keys.get((self._secret, user, expiration))
+			if keys is None:
+				keys = derived = self._derive(user, expiration)
+		(key, kmac) = keys
+		if version == V1:
+			plaintext = decrypt(ciphertext.ljust(256, '\0'), key[:16], self._ivec)
+			vmac = hashd(user, expiration, plaintext, self._session, kmac)
+			plaintext = plaintext.rstrip('\0')
+		else:
+			plaintext = decrypt(ciphertext, key[:16], self._ivec)[:dlen]
+			head = V2_STRUCT.pack(V2, len(user), expiration, dlen)
+			vmac = hashd2(head, user, plaintext, self._session, kmac)
+		if not hmac.compare_digest(mac, vmac):
+			return None
+		if derived is not None:
+			self.keys.put((self._secret, user, expiration), derived, expiration)
+		return plaintext
 	##
 	# @brief get the expiration time of a cookie
 	#
@@ -183,11 +586,12 @@ class SecureCookie:
 	#
 	# @return serialized cookie stream with updated expiration
 	def setExpiration(self, cookie, expiration):
-		if not self.isValid(cookie):
+		valid = self.isValid(cookie)
+		if not valid:
 			l.warn("SECURITY ALERT: Setting expiration on invalid cookie.")
 		(user, _, ciphertext, _) = self.deserialize(cookie)
 		plaintext = self.getData(cookie)
-		return self.serialize(user, expiration, plaintext)
+		return self.serialize(user, expiration, plaintext, cache=valid)
 	##
 	# @brief get the data from a cookie
 	#
@@ -195,10 +599,16 @@ class SecureCookie:
 	#
 	# @return decrypted data section of the cookie
 	def getData(self, cookie):
-		(user, expiration, ciphertext, mac) = self.deserialize(cookie)
-		key = hashk(user, expiration, self._secret)
-		plaintext = decrypt(ciphertext.ljust(256, '\0'), str(key)[:16], self._ivec)
-		return plaintext.rstrip('\0')
+		unpacked = self._unpack(cookie)
+		(version, user, expiration, ciphertext, dlen, _) = unpacked
+		if version == V3:
+			# aead decryption always checks integrity
+			return self._open(unpacked)
+		key = self._key(user, expiration)
+		if version == V1:
+			plaintext = decrypt(ciphertext.ljust(256, '\0'), key[:16], self._ivec)
+			return plaintext.rstrip('\0')
+		return decrypt(ciphertext, key[:16], self._ivec)[:dlen]
 	##
 	# @brief set data field for a cookie
 	#
@@ -207,10 +617,11 @@ class SecureCookie:
 	#
 	# @return serialize cookie stream with updated data
 	def setData(self, cookie, data):
-		if not self.isValid(cookie):
+		valid = self.isValid(cookie)
+		if not valid:
 			l.warn("SECURITY ALERT: Setting data on invalid cookie.")
 		(user, expiration, _, _) = self.deserialize(cookie)
-		return self.serialize(user, expiration, data)
+		return self.serialize(user, expiration, data, cache=valid)
 	##
 	# @brief detect if the cookie integrity has been compromised.
 	#
@@ -218,13 +629,124 @@ class SecureCookie:
 	#
 	# @return  True or False
 	def isValid(self, cookie):
-		(user, expiration, ciphertext, mac) = self.deserialize(cookie)
-		key = hashk(user, expiration, self._secret)
-		plaintext = decrypt(ciphertext.ljust(256, '\0'), str(key)[:16], self._ivec)
-		vmac = hashd(user, expiration, plaintext, self._session, str(key))
-		if mac == vmac:
-			return True
-		return False
+		return self.verify(cookie) is not None
+	##
+	# @brief verify a cookie and decrypt its data in a single pass
+	#
+	# @param cookie the cookie stream created by serialize()
+	#
+	# @return Credentials of the cookie, or None if it is not valid
+	@metrics.timed('cookie')
+	def verify(self, cookie):
+		try:
+			unpacked = self._unpack(cookie)
+		except struct.error:
+			l.warn("Failed to unpack cookie data.")
+			return None
+		plaintext = self._open(unpacked)
+		if plaintext is None:
+			return None
+		return Credentials(unpacked[1], unpacked[2], plaintext)
+
+## SecureCookie objects by (session, secret, suite), see verifier()
+VERIFIERS = KeyCache(size=VERIFIERS_SIZE)
+
+##
+# @brief get a SecureCookie for a session, reusing a cached one if possible.
+# This saves rebuilding the keyed HMAC contexts and the aead key on every
+# request without having to store the SecureCookie anywhere.
+#
+# @param session unique identifying information about the session (public)
+# @param secret secret key uses for encrypting all cookies
+# @param suite name of the cipher suite used for new cookies
+#
+# @return SecureCookie object
+@metrics.timed('cookie')
+def verifier(session, secret, suite='legacy'):
+	k = (session, secret, suite)
+	c = VERIFIERS.get(k)
+	if c is None:
+		c = SecureCookie(session, secret, suite=suite)
+		VERIFIERS.put(k, c, NEVER)
+	return c
+
+##
+# @brief verify one chunk of cookies for verify_many()
+#
+# Cookies are grouped by user and expiration so that the legacy key for
+# each group is derived once, even for cookies that have already expired
+# and so are never held in the key cache.
+#
+# @param args tuple (secret, default session, list of cookies)
+#
+# @return list with Credentials or None for each cookie, in input order
+def _verify_chunk(args):
+	(secret, session, items) = args
+	verifiers = {}
+	groups = collections.defaultdict(list)
+	results = [None] * len(items)
+	for (i, item) in enumerate(items):
+		(sess, cookie) = item if isinstance(item, tuple) else (session, item)
+		if sess not in verifiers:
+			verifiers[sess] = SecureCookie(sess, secret)
+		try:
+			unpacked = verifiers[sess]._unpack(cookie)
+		except struct.error:
+			continue
+		groups[unpacked[1:3]].append((i, verifiers[sess], unpacked))
+	for ((user, expiration), group) in groups.iteritems():
+		keys = None
+		for (i, verifier, unpacked) in group:
+			if keys is None and unpacked[0] != V3:
+				keys = verifier._derive(user, expiration)
+			plaintext = verifier._open(unpacked, keys)
+			if plaintext is not None:
+				results[i] = Credentials(user, expiration, plaintext)
+	return results
+
+##
+# @brief verify a large number of cookies, for auditing captured traffic
+#
+# Results are streamed in input order. Inputs that span more than one
+# chunk are spread across a pool of worker processes.
+#
+# @param cookies iterable of cookie streams, or of (session, cookie) tuples
+# for cookies that were issued to different sessions
+# @param secret secret key used to create the cookies
+# @param session session ID for cookies given without one
+# @param processes size of the process pool, defaults to the number of CPUs
+# @param chunksize number of cookies handed to a worker at a time
+#
+# @return generator of (cookie, Credentials or None)
+def verify_many(cookies, secret, session=None, processes=None, chunksize=10000):
+	it = iter(cookies)
+	chunks = iter(lambda: list(itertools.islice(it, chunksize)), [])
+	first = next(chunks, [])
+	second = next(chunks, [])
+	if not second or processes == 1:
+		# not worth starting processes
+		for chunk in itertools.chain([first, second], chunks):
+			for (item, result) in itertools.izip(chunk, _verify_chunk((secret, session, chunk))):
+				yield (item, result)
+		return
+	processes = processes or multiprocessing.cpu_count()
+	pool = multiprocessing.Pool(processes)
+	# bound the chunks in flight so that memory does not grow with the input
+	pending = collections.deque()
+	try:
+		for chunk in itertools.chain([first, second], chunks):
+			pending.append((chunk, pool.apply_async(_verify_chunk, ((secret, session, chunk),))))
+			if len(pending) < 2 * processes:
+				continue
+			(chunk, results) = pending.popleft()
+			for (item, result) in itertools.izip(chunk, results.get()):
+				yield (item, result)
+		while pending:
+			(chunk, results) = pending.popleft()
+			for (item, result) in itertools.izip(chunk, results.get()):
+				yield (item, result)
+	finally:
+		pool.terminate()
 
 # Values for testing
 TEST_USER = 'mytestuser'
@@ -232,6 +754,121 @@ TEST_EXPIRATION = int(time.time())
 TEST_DATA = 'mytestdata'
 TEST_SESSION = '123456789009876543211234567890'
 
+class TestHMAC(unittest.TestCase):
+	def test_keyed(self):
+		secret = os.urandom(16)
+		ctx = keyed(secret)
+		self.assertEqual(HMAC(TEST_DATA, ctx), HMAC(TEST_DATA, secret))
+		# the context must not be consumed by use
+		self.assertEqual(HMAC(TEST_USER, ctx), HMAC(TEST_USER, secret))
+
+class TestSessionHash(unittest.TestCase):
+	def test_values(self):
+		a = dict(HTTP_USER_AGENT='agent a', HTTP_X_FORWARDED_FOR='NO_HTTP_X_FORWARDED_FOR')
+		b = dict(a, HTTP_USER_AGENT='agent b')
+		self.assertEqual(session_hash(a), session_hash(dict(a)))
+		self.assertNotEqual(session_hash(a), session_hash(b))
+		self.assertEqual(len(session_hash(a)), 20)
+	def test_boundaries(self):
+		self.assertNotEqual(session_hash(dict(a='xy', b='z')), session_hash(dict(a='x', b='yz')))
+
+class TestKeyCache(unittest.TestCase):
+	def test_get_put(self):
+		c = KeyCache(size=2)
+		self.assertTrue(c.get('a') is None)
+		c.put('a', 'key', TEST_EXPIRATION + 60)
+		self.assertEqual(c.get('a'), 'key')
+		self.assertEqual(( c.hits, c.misses, ), ( 1, 1, ))
+	def test_lru(self):
+		c = KeyCache(size=2)
+		c.put('a', 1, TEST_EXPIRATION + 60)
+		c.put('b', 2, TEST_EXPIRATION + 60)
+		c.get('a')
+		c.put('c', 3, TEST_EXPIRATION + 60)
+		self.assertEqual(len(c), 2)
+		self.assertTrue(c.get('b') is None)
+		self.assertEqual(c.get('a'), 1)
+	def test_expired(self):
+		c = KeyCache(size=2)
+		c.put('a', 1, TEST_EXPIRATION - 1)
+		self.assertEqual(len(c), 0)
+		c.put('b', 2, TEST_EXPIRATION + 1, now=TEST_EXPIRATION)
+		self.assertTrue(c.get('b', now=TEST_EXPIRATION + 2) is None)
+		self.assertEqual(len(c), 0)
+	def test_evict_expired_first(self):
+		c = KeyCache(size=2)
+		c.put('a', 1, TEST_EXPIRATION + 60, now=TEST_EXPIRATION)
+		c.put('b', 2, TEST_EXPIRATION + 1, now=TEST_EXPIRATION)
+		c.get('a', now=TEST_EXPIRATION)
+		c.put('c', 3, TEST_EXPIRATION + 60, now=TEST_EXPIRATION + 2)
+		self.assertEqual(c.get('a', now=TEST_EXPIRATION + 2), 1)
+		self.assertEqual(c.get('c', now=TEST_EXPIRATION + 2), 3)
+	def test_contended(self):
+		c = KeyCache(size=2)
+		c.put('a', 1, TEST_EXPIRATION + 60)
+		c.put('b', 2, TEST_EXPIRATION + 60)
+		with c._lock:
+			# a writer holds the lock: lookups still succeed without blocking
+			self.assertEqual(c.get('a'), 1)
+		c.put('c', 3, TEST_EXPIRATION + 60)
+		self.assertTrue(c.get('a') is None)
+	def test_threads(self):
+		c = KeyCache(size=64)
+		errors = []
+		def worker(n):
+			for i in range(2000):
+				k = (n * i) % 100
+				v = c.get(k)
+				if v is None:
+					c.put(k, k * 2, TEST_EXPIRATION + 60)
+				elif v != k * 2:
+					errors.append((k, v))
+		threads = [ threading.Thread(target=worker, args=(n,)) for n in range(8) ]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		self.assertEqual(errors, [])
+		self.assertTrue(len(c) <= 64)
+
+class TestVerifier(unittest.TestCase):
+	def test_verifier(self):
+		secret = os.urandom(16)
+		c = verifier(TEST_SESSION, secret)
+		self.assertTrue(verifier(TEST_SESSION, secret) is c)
+		self.assertFalse(verifier(TEST_SESSION + 'x', secret) is c)
+		self.assertFalse(verifier(TEST_SESSION, os.urandom(16)) is c)
+		s = c.serialize(TEST_USER, TEST_EXPIRATION, TEST_DATA)
+		self.assertEqual(verifier(TEST_SESSION, secret).verify(s).data, TEST_DATA)
+
+class TestVerifyMany(unittest.TestCase):
+	def setUp(self):
+		self.secret = os.urandom(16)
+		c = SecureCookie(TEST_SESSION, self.secret)
+		self.cookies = []
+		for i in range(50):
+			self.cookies.append(c.serialize(TEST_USER + str(i % 7), TEST_EXPIRATION - i % 3, TEST_DATA + str(i)))
+		self.cookies[3] = self.cookies[3][:-2]
+		self.cookies[9] = c.serialize(TEST_USER, TEST_EXPIRATION, TEST_DATA, version=V1)
+		self.cookies[11] = (TEST_SESSION + 'x', self.cookies[11])
+		self.cookies[12] = (TEST_SESSION + 'x', SecureCookie(TEST_SESSION + 'x', self.secret).serialize(TEST_USER, TEST_EXPIRATION, TEST_DATA))
+	def check(self, results):
+		results = list(results)
+		self.assertEqual([r[0] for r in results], self.cookies)
+		for (i, (cookie, v)) in enumerate(results):
+			if i in ( 3, 11 ):
+				self.assertTrue(v is None)
+			elif i in ( 9, 12 ):
+				self.assertEqual(v.data, TEST_DATA)
+			else:
+				self.assertEqual(( v.user, v.data, ), ( TEST_USER + str(i % 7), TEST_DATA + str(i), ))
+	def test_inprocess(self):
+		self.check(verify_many(self.cookies, self.secret, TEST_SESSION))
+	def test_pool(self):
+		self.check(verify_many(self.cookies, self.secret, TEST_SESSION, processes=2, chunksize=8))
+	def test_empty(self):
+		self.assertEqual(list(verify_many([], self.secret, TEST_SESSION)), [])
+
 class TestSecureCookie(unittest.TestCase):
 	def setUp(self):
 		self.secret = os.urandom(16)
@@ -241,6 +878,14 @@ class TestSecureCookie(unittest.TestCase):
 		self.assertFalse(c._session is None)
 		self.assertFalse(c._secret is None)
 		self.assertFalse(c._ivec is None)
+		self.assertFalse(c._mac is None)
+	def test_pickle(self):
+		import pickle
+		c = SecureCookie(TEST_SESSION, self.secret)
+		s = c.serialize(TEST_USER, TEST_EXPIRATION, TEST_DATA)
+		c2 = pickle.loads(pickle.dumps(c))
+		self.assertEqual(c2.getData(s), TEST_DATA)
+		self.assertTrue(c2.isValid(s))
 	def test_serialize(self):
 		c = SecureCookie(TEST_SESSION, self.secret)
 		self.assertFalse(c is None)
@@ -291,6 +936,106 @@ class TestSecureCookie(unittest.TestCase):
 		s = c.serialize(TEST_USER, TEST_EXPIRATION, TEST_DATA)
 		self.assertFalse(s is None)
 		self.assertTrue(c.isValid(s))
+	def test_verify(self):
+		c = SecureCookie(TEST_SESSION, self.secret)
+		s = c.serialize(TEST_USER, TEST_EXPIRATION, TEST_DATA)
+		v = c.verify(s)
+		self.assertFalse(v is None)
+		self.assertEqual(( TEST_USER, TEST_EXPIRATION, TEST_DATA, ), ( v.user, v.expiration, v.data, ))
+	def test_verify_neg_session(self):
+		c = SecureCookie(TEST_SESSION, self.secret)
+		s = c.serialize(TEST_USER, TEST_EXPIRATION, TEST_DATA)
+		other = SecureCookie(TEST_SESSION + 'x', self.secret)
+		self.assertTrue(other.verify(s) is None)
+	def test_verify_neg_malformed(self):
+		c = SecureCookie(TEST_SESSION, self.secret)
+		self.assertTrue(c.verify('garbage') is None)
+		self.assertTrue(c.verify('') is None)
+		self.assertTrue(c.verify('A' * V1_STRUCT.size) is None)
+	def test_verify_neg_tampered(self):
+		c = SecureCookie(TEST_SESSION, self.secret)
+		raw = b64decode(c.serialize(TEST_USER, TEST_EXPIRATION, TEST_DATA))
+		raw = raw[:-DGST_LEN - 1] + chr(ord(raw[-DGST_LEN - 1]) ^ 1) + raw[-DGST_LEN:]
+		self.assertTrue(c.verify(b64encode(raw)) is None)
+	def test_v1(self):
+		c = SecureCookie(TEST_SESSION, self.secret)
+		s = c.serialize(TEST_USER, TEST_EXPIRATION, TEST_DATA, version=V1)
+		self.assertEqual(len(s), V1_STRUCT.size)
+		self.assertEqual(c.getData(s), TEST_DATA)
+		v = c.verify(s)
+		self.assertEqual(( TEST_USER, TEST_EXPIRATION, TEST_DATA, ), ( v.user, v.expiration, v.data, ))
+		# updating a version 1 cookie upgrades it
+		s2 = c.setData(s, TEST_DATA + 'more')
+		self.assertTrue(RE_B64.match(s2))
+		self.assertEqual(c.getData(s2), TEST_DATA + 'more')
+	def test_suite_neg(self):
+		self.assertRaises(ValueError, SecureCookie, TEST_SESSION, self.secret, suite='rot13')
+	@unittest.skipUnless(HAVE_AEAD, 'ChaCha20-Poly1305 is not available')
+	def test_aead(self):
+		c = SecureCookie(TEST_SESSION, self.secret, suite='aead')
+		for data in ( '', TEST_DATA, 'x' * 300 ):
+			s = c.serialize(TEST_USER, TEST_EXPIRATION, data)
+			self.assertTrue(RE_B64.match(s))
+			v = c.verify(s)
+			self.assertEqual(( TEST_USER, TEST_EXPIRATION, data, ), ( v.user, v.expiration, v.data, ))
+			self.assertEqual(c.getData(s), data)
+		s = c.serialize(TEST_USER, TEST_EXPIRATION, TEST_DATA)
+		self.assertTrue(SecureCookie(TEST_SESSION + 'x', self.secret).verify(s) is None)
+		self.assertTrue(SecureCookie(TEST_SESSION, os.urandom(16)).verify(s) is None)
+		raw = b64decode(s)
+		for i in ( 1, 5, V3_STRUCT.size - 1, len(raw) - TAG_LEN - 1, len(raw) - 1 ):
+			bad = raw[:i] + chr(ord(raw[i]) ^ 1) + raw[i + 1:]
+			self.assertTrue(c.verify(b64encode(bad)) is None)
+	@unittest.skipUnless(HAVE_AEAD, 'ChaCha20-Poly1305 is not available')
+	def test_aead_migration(self):
+		legacy = SecureCookie(TEST_SESSION, self.secret)
+		aead = SecureCookie(TEST_SESSION, self.secret, suite='aead')
+		for version in ( V1, V2 ):
+			s = legacy.serialize(TEST_USER, TEST_EXPIRATION, TEST_DATA, version=version)
+			self.assertEqual(aead.verify(s).data, TEST_DATA)
+		s = aead.serialize(TEST_USER, TEST_EXPIRATION, TEST_DATA)
+		self.assertEqual(legacy.verify(s).data, TEST_DATA)
+	def test_v2(self):
+		c = SecureCookie(TEST_SESSION, self.secret)
+		s = c.serialize(TEST_USER, TEST_EXPIRATION, TEST_DATA)
+		self.assertTrue(RE_B64.match(s))
+		self.assertTrue(len(s) < V1_STRUCT.size / 4)
+		for data in ( '', 'x' * 16, 'x' * 300 ):
+			v = c.verify(c.serialize(TEST_USER, TEST_EXPIRATION, data))
+			self.assertEqual(v.data, data)
+	def test_keycache(self):
+		c = SecureCookie(TEST_SESSION, self.secret)
+		hits = c.keys.hits
+		s = c.serialize(TEST_USER, TEST_EXPIRATION + 60, TEST_DATA)
+		self.assertFalse(c.verify(s) is None)
+		self.assertEqual(c.keys.hits, hits + 1)
+		self.assertEqual(c._key(TEST_USER, TEST_EXPIRATION + 60), hashk(TEST_USER, TEST_EXPIRATION + 60, self.secret))
+	def test_keycache_forged(self):
+		c = SecureCookie(TEST_SESSION, self.secret)
+		c.keys = KeyCache(size=2)
+		s = c.serialize(TEST_USER, TEST_EXPIRATION + 60, TEST_DATA)
+		forger = SecureCookie(TEST_SESSION, os.urandom(16))
+		for i in range(8):
+			forged = forger.serialize('user%d' % i, 2 ** 40 + i, TEST_DATA)
+			self.assertTrue(c.verify(forged) is None)
+		# forged cookies do not take the place of the real user's keys
+		self.assertEqual(len(c.keys), 1)
+		hits = c.keys.hits
+		self.assertFalse(c.verify(s) is None)
+		self.assertEqual(c.keys.hits, hits + 1)
+		# nor do forged cookies that are read or rewritten
+		for i in range(8):
+			forged = forger.serialize('user%d' % i, 2 ** 40 + i, TEST_DATA)
+			c.getData(forged)
+			c.setData(forged, 'x')
+			c.setExpiration(forged, 2 ** 40)
+		self.assertEqual(len(c.keys), 1)
+		self.assertFalse(c.verify(s) is None)
+		self.assertEqual(c.keys.hits, hits + 2)
+		# keys are cached once a cookie has been verified
+		c.keys.clear()
+		self.assertFalse(c.verify(s) is None)
+		self.assertEqual(len(c.keys), 1)
 
 if __name__ == "__main__":
 	# run from the same directory as the module
@@ -0,0 +1,360 @@
+## @package sessions
+# Session store backends for web.py.
+#
+# Both stores implement the web.session.Store interface, and both expire
+# sessions that have not been saved within their time to live.
+# - MemoryStore keeps sessions in process, bounded in number and evicted
+# in least recently used order.
+# - SQLiteStore keeps sessions in a table of the service database with an
+# indexed expiry column, pruned by a background sweeper thread.
+#
+# LazySession replaces web.session.Session so that requests which never
+# touch the session do no session I/O.
+
+# system modules
+import atexit
+import collections
+import copy
+import os
+import sys
+import threading
+import time
+import unittest
+import web
+
+# local modules
+import db
+import metrics
+from log import l
+
+sys.dont_write_byte_code = True
+
+## Default number of sessions kept by MemoryStore
+SESSION_MAX = 100000
+## Default session lifetime, in seconds
+SESSION_TTL = 86400
+## Default interval between sweeps of SQLiteStore, in seconds
+SWEEP_INTERVAL = 60
+## Number of requests between logs of LazySession statistics
+STATS_INTERVAL = 1000
+## Maximum number of distinct paths LazySession keeps statistics for
+STATS_PATHS = 64
+
+##
+# @brief In-process session store with a size bound and a time to live
+class MemoryStore(web.session.Store):
+	##
+	# @brief create an empty store
+	#
+	# @param size maximum number of sessions
+	# @param ttl seconds a session lives after it was last saved
+	def __init__(self, size=SESSION_MAX, ttl=SESSION_TTL):
+		self._size = size
+		self._ttl = ttl
+		self._sessions = collections.OrderedDict()
+		self._lock = threading.Lock()
+	def __len__(self):
+		return len(self._sessions)
+	##
+	# @brief look up a live session. The caller must hold the lock.
+	#
+	# @return tuple (expiration, session dict) or None
+	def _get(self, key):
+		entry = self._sessions.get(key)
+		if entry is not None and entry[0] <= time.time():
+			del self._sessions[key]
+			return None
+		return entry
+	def __contains__(self, key):
+		with self._lock:
+			return self._get(key) is not None
+	def __getitem__(self, key):
+		with self._lock:
+			entry = self._get(key)
+			if entry is None:
+				raise KeyError, key
+			# reinsert to mark as most recently used and keep it alive
+			del self._sessions[key]
+			self._sessions[key] = (time.time() + self._ttl, entry[1])
+			return entry[1]
+	def __setitem__(self, key, value):
+		with self._lock:
+			self._sessions.pop(key, None)
+			while len(self._sessions) >= self._size:
+				self._sessions.popitem(last=False)
+			self._sessions[key] = (time.time() + self._ttl, value)
+	def __delitem__(self, key):
+		with self._lock:
+			self._sessions.pop(key, None)
+	##
+	# @brief remove expired sessions
+	#
+	# @param timeout ignored, the store's own time to live applies
+	def cleanup(self, timeout):
+		now = time.time()
+		with self._lock:
+			for key in [k for (k, e) in self._sessions.iteritems() if e[0] <= now]:
+				del self._sessions[key]
+
+##
+# @brief Session store in the service database
+class SQLiteStore(web.session.Store):
+	##
+	# @brief start the sweeper
+	#
+	# @param xec web.database connection to the service database, migrated
+	# by db.Connection.migrate(), which creates the Sessions table
+	# @param ttl seconds a session lives after it was last saved
+	# @param sweep seconds between sweeps of expired sessions, 0 to sweep
+	# only when web.py asks for a cleanup
+	def __init__(self, xec, ttl=SESSION_TTL, sweep=SWEEP_INTERVAL):
+		self._xec = xec
+		self._ttl = ttl
+		self._sweeper = None
+		if sweep:
+			self._stop = threading.Event()
+			self._sweeper = threading.Thread(target=self._sweep, args=(sweep,), name='session-sweeper')
+			self._sweeper.daemon = True
+			self._sweeper.start()
+			# daemon threads die noisily during interpreter shutdown
+			atexit.register(self.close)
+	def __contains__(self, key):
+		res = self._xec.query('SELECT 1 FROM Sessions WHERE SessionID=$key AND Expires>$now',
+				vars=dict(key=key, now=time.time()))
+		return bool(list(res))
+	def __getitem__(self, key):
+		res = self._xec.query('SELECT Data FROM Sessions WHERE SessionID=$key AND Expires>$now',
+				vars=dict(key=key, now=time.time()))
+		try:
+			return self.decode(res[0].Data)
+		except IndexError:
+			raise KeyError, key
+	def __setitem__(self, key, value):
+		self._xec.query('INSERT OR REPLACE INTO Sessions VALUES ($key, $expires, $data)',
+				vars=dict(key=key, expires=time.time() + self._ttl, data=self.encode(value)))
+	def __delitem__(self, key):
+		self._xec.delete('Sessions', where='SessionID=$key', vars=dict(key=key))
+	##
+	# @brief remove expired sessions
+	#
+	# @return number of sessions removed
+	def expire(self):
+		return self._xec.delete('Sessions', where='Expires<=$now', vars=dict(now=time.time()))
+	##
+	# @brief remove expired sessions, unless the sweeper already does
+	#
+	# @param timeout ignored, the store's own time to live applies
+	def cleanup(self, timeout):
+		if self._sweeper is None:
+			self.expire()
+	##
+	# @brief background loop removing expired sessions
+	#
+	# @param interval seconds between sweeps
+	def _sweep(self, interval):
+		while not self._stop.wait(interval):
+			try:
+				n = self.expire()
+			except Exception as e:
+				l.error('session sweep failed: %s' % e)
+				continue
+			if n:
+				l.debug('swept %d expired sessions' % n)
+	##
+	# @brief stop the sweeper thread
+	def close(self):
+		if self._sweeper is not None:
+			self._stop.set()
+			self._sweeper.join()
+			self._sweeper = None
+
+##
+# @brief web.py session that is loaded on first use and saved only if changed
+#
+# The stock session loads and saves on every request. This one loads the
+# session the first time a handler touches it, and saves it only if its
+# contents changed or it was killed. New sessions that never receive any
+# data are not stored, and no session cookie is sent for them. Sessions in
+# stores with a time to live expire that long after their last change.
+#
+# Per-path counts of requests, loads and saves are kept in stats.
+class LazySession(web.session.Session):
+	__slots__ = web.session.Session.__slots__ + [ 'stats', '_stats_lock', '_requests' ]
+	def __init__(self, app, store, initializer=None):
+		self.stats = {}
+		self._stats_lock = threading.Lock()
+		self._requests = 0
+		web.session.Session.__init__(self, app, store, initializer)
+	##
+	# @brief load the session if this request has not done so yet. Loads and
+	# saves are timed as the session stage of the request.
+	def _ensure(self):
+		if web.ctx.get('session_loaded'):
+			return
+		web.ctx.session_loaded = True
+		self._count(1)
+		with metrics.timer('session'):
+			self._cleanup()
+			self._load()
+			web.ctx.session_snapshot = copy.deepcopy(dict(self._data))
+	def __contains__(self, name):
+		self._ensure()
+		return web.session.Session.__contains__(self, name)
+	def __getattr__(self, name):
+		self._ensure()
+		return web.session.Session.__getattr__(self, name)
+	def __setattr__(self, name, value):
+		if name not in self.__slots__:
+			self._ensure()
+		web.session.Session.__setattr__(self, name, value)
+	def __delattr__(self, name):
+		self._ensure()
+		web.session.Session.__delattr__(self, name)
+	##
+	# @brief application processor, replacing the eager one
+	def _processor(self, handler):
+		self._count(0)
+		try:
+			return handler()
+		finally:
+			if web.ctx.get('session_loaded'):
+				if self._data.get('_killed') or dict(self._data) != web.ctx.session_snapshot:
+					self._count(2)
+					with metrics.timer('session'):
+						self._save()
+	##
+	# @brief count a request, load or save for the current path
+	#
+	# @param index 0 for requests, 1 for loads, 2 for saves
+	def _count(self, index):
+		path = web.ctx.get('path', '')
+		with self._stats_lock:
+			if path not in self.stats:
+				if len(self.stats) >= STATS_PATHS:
+					path = 'other'
+				self.stats.setdefault(path, [0, 0, 0])
+			self.stats[path][index] += 1
+			if index == 0:
+				self._requests += 1
+				if self._requests % STATS_INTERVAL == 0:
+					l.info('session requests/loads/saves: %s' % ', '.join(
+							'%s %d/%d/%d' % ((p,) + tuple(c)) for (p, c) in sorted(self.stats.iteritems())))
+
+class TestMemoryStore(unittest.TestCase):
+	def test_store(self):
+		s = MemoryStore()
+		s['a'] = { 'x': 1 }
+		self.assertTrue('a' in s)
+		self.assertEqual(s['a'], { 'x': 1 })
+		del s['a']
+		self.assertFalse('a' in s)
+		self.assertRaises(KeyError, s.__getitem__, 'a')
+	def test_size(self):
+		s = MemoryStore(size=2)
+		s['a'] = 1
+		s['b'] = 2
+		s['a']
+		s['c'] = 3
+		self.assertEqual(len(s), 2)
+		self.assertFalse('b' in s)
+		self.assertTrue('a' in s)
+	def test_ttl(self):
+		s = MemoryStore(ttl=-1)
+		s['a'] = 1
+		self.assertFalse('a' in s)
+		s['b'] = 2
+		s.cleanup(0)
+		self.assertEqual(len(s), 0)
+
+class TestSQLiteStore(unittest.TestCase):
+	def setUp(self):
+		self.xec = db.Connection(':memory:')
+		self.xec.migrate()
+	def test_store(self):
+		s = SQLiteStore(self.xec, sweep=0)
+		s['a'] = { 'x': 1 }
+		self.assertTrue('a' in s)
+		self.assertEqual(s['a'], { 'x': 1 })
+		s['a'] = { 'x': 2 }
+		self.assertEqual(s['a'], { 'x': 2 })
+		del s['a']
+		self.assertFalse('a' in s)
+		self.assertRaises(KeyError, s.__getitem__, 'a')
+	def test_ttl(self):
+		s = SQLiteStore(self.xec, ttl=-1, sweep=0)
+		s['a'] = 1
+		self.assertFalse('a' in s)
+		self.assertRaises(KeyError, s.__getitem__, 'a')
+		self.assertEqual(s.expire(), 1)
+	def test_plan(self):
+		SQLiteStore(self.xec, sweep=0)
+		plan = self.xec.query('EXPLAIN QUERY PLAN DELETE FROM Sessions WHERE Expires<=1')
+		self.assertTrue('SessionsExpires' in ' '.join(str(r.values()) for r in plan))
+	def test_sweeper(self):
+		path = 'test-data/sessions.db'
+		xec = db.Connection(path)
+		try:
+			xec.migrate()
+			s = SQLiteStore(xec, ttl=-1, sweep=0.01)
+			s['a'] = 1
+			time.sleep(0.2)
+			s.close()
+			self.assertEqual(list(xec.query('SELECT * FROM Sessions')), [])
+		finally:
+			os.unlink(path)
+
+## Handler names used by TestLazySession
+lazy_urls = (
+	'/none', 'lazy_none',
+	'/read', 'lazy_read',
+	'/write', 'lazy_write',
+)
+class lazy_none:
+	def GET(self):
+		return 'none'
+class lazy_read:
+	def GET(self):
+		return str('n' in lazy_session)
+class lazy_write:
+	def GET(self):
+		lazy_session.n = lazy_session.get('n', 0) + 1
+		return str(lazy_session.n)
+
+class TestLazySession(unittest.TestCase):
+	def setUp(self):
+		global lazy_session
+		self.app = web.application(lazy_urls, globals(), autoreload=False)
+		self.store = MemoryStore()
+		lazy_session = LazySession(self.app, self.store)
+		self.session = lazy_session
+	def get(self, path, sid=None):
+		headers = {}
+		if sid:
+			headers['Cookie'] = 'webpy_session_id=%s' % sid
+		r = self.app.request(path, headers=headers)
+		cookies = [v for (k, v) in r.header_items if k == 'Set-Cookie']
+		return (r.data, cookies[0].split(';')[0].split('=')[1] if cookies else None)
+	def test_none(self):
+		self.assertEqual(self.get('/none'), ( 'none', None, ))
+		self.assertEqual(len(self.store), 0)
+		self.assertEqual(self.session.stats['/none'], [1, 0, 0])
+	def test_read_new(self):
+		self.assertEqual(self.get('/read'), ( 'False', None, ))
+		self.assertEqual(len(self.store), 0)
+		self.assertEqual(self.session.stats['/read'], [1, 1, 0])
+	def test_write(self):
+		(data, sid) = self.get('/write')
+		self.assertEqual(data, '1')
+		self.assertFalse(sid is None)
+		self.assertEqual(self.get('/read', sid), ( 'True', None, ))
+		self.assertEqual(self.get('/none', sid), ( 'none', None, ))
+		self.assertEqual(self.get('/write', sid), ( '2', sid, ))
+		self.assertEqual(self.session.stats, { '/write': [2, 2, 2], '/read': [1, 1, 0], '/none': [1, 0, 0] })
+
+if __name__ == '__main__':
+	import logging
+	# suppress logging for unit tests
+	logging.disable(logging.CRITICAL)
+	# run from the same directory as the module
+	os.chdir(os.path.dirname(os.path.abspath(sys.argv[0])))
+	sys.exit(unittest.main(verbosity=2))
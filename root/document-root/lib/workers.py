@@ -0,0 +1,182 @@
+## @package workers
+# Pre-forked worker processes.
+#
+# The parent process does all of the expensive setup once, then forks the
+# workers, which inherit the loaded state and the listening socket. The
+# parent only supervises: it restarts workers that die and passes SIGTERM
+# and SIGINT on to them.
+
+# system modules
+import errno
+import logging
+import multiprocessing
+import os
+import signal
+import stat
+import sys
+import time
+import unittest
+
+# local modules
+from log import l
+
+sys.dont_write_byte_code = True
+
+## Workers that exit sooner than this after starting are restarted with a delay
+RESPAWN_DELAY = 1.0
+
+##
+# @brief resolve a configured worker count
+#
+# @param n configured count. 0 or None means one per CPU.
+#
+# @return number of workers, at least 1
+def count(n):
+	if not n:
+		try:
+			return multiprocessing.cpu_count()
+		except NotImplementedError:
+			return 1
+	return max(1, int(n))
+
+##
+# @brief check whether the process was started with a listening socket on
+# stdin, which is how lighttpd hands a FastCGI socket to the service
+#
+# @return True or False
+def inherited_socket():
+	try:
+		return stat.S_ISSOCK(os.fstat(0).st_mode)
+	except OSError:
+		return False
+
+##
+# @brief Supervisor of pre-forked workers
+class Prefork:
+	##
+	# @brief prepare a supervisor
+	#
+	# @param workers number of worker processes
+	# @param serve function run by each worker after the fork. The worker
+	# exits when it returns.
+	# @param reap function called with the pid of each worker that has
+	# exited, however it exited, to clean up after it; or None
+	def __init__(self, workers, serve, reap=None):
+		self._workers = workers
+		self._serve = serve
+		self._reap = reap
+		self._children = {}
+		self._running = False
+	##
+	# @brief fork one worker
+	def _spawn(self):
+		pid = os.fork()
+		if pid:
+			self._children[pid] = time.time()
+			return
+		# worker
+		signal.signal(signal.SIGTERM, signal.SIG_DFL)
+		signal.signal(signal.SIGINT, signal.SIG_DFL)
+		code = 0
+		try:
+			self._serve()
+		except SystemExit as e:
+			code = e.code if isinstance(e.code, int) else 1
+		except:
+			l.exception('worker %d failed' % os.getpid())
+			code = 1
+		finally:
+			# write out the queued log records, os._exit() skips that
+			logging.shutdown()
+			os._exit(code)
+	##
+	# @brief signal handler that stops all workers
+	def _stop(self, signum, frame):
+		self._running = False
+		for pid in self._children:
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except OSError:
+				pass
+	##
+	# @brief fork the workers and supervise them until they are stopped
+	def run(self):
+		self._running = True
+		signal.signal(signal.SIGTERM, self._stop)
+		signal.signal(signal.SIGINT, self._stop)
+		l.info('Starting %d workers.' % self._workers)
+		for i in range(self._workers):
+			self._spawn()
+		while self._children:
+			try:
+				(pid, status) = os.wait()
+			except OSError as e:
+				if e.errno == errno.EINTR:
+					continue
+				if e.errno == errno.ECHILD:
+					break
+				raise
+			started = self._children.pop(pid, None)
+			if started is not None and self._reap:
+				self._reap(pid)
+			if started is None or not self._running:
+				continue
+			l.error('worker %d exited with status %d, restarting.' % (pid, status))
+			if time.time() - started < RESPAWN_DELAY:
+				# do not spin if workers die on startup
+				time.sleep(RESPAWN_DELAY)
+			self._spawn()
+
+class TestPrefork(unittest.TestCase):
+	def test_count(self):
+		self.assertTrue(count(0) >= 1)
+		self.assertTrue(count(None) >= 1)
+		self.assertEqual(count(3), 3)
+		self.assertEqual(count(-1), 1)
+	def test_inherited_socket(self):
+		self.assertTrue(inherited_socket() in ( True, False, ))
+	def test_run(self):
+		(r, w) = os.pipe()
+		(reaped, reap) = os.pipe()
+		def serve():
+			os.write(w, '%8d' % os.getpid())
+			time.sleep(60)
+		supervisor = os.fork()
+		if not supervisor:
+			os.close(r)
+			os.close(reaped)
+			Prefork(3, serve, reap=lambda pid: os.write(reap, '%8d' % pid)).run()
+			os._exit(0)
+		os.close(w)
+		os.close(reap)
+		read = lambda: int(os.read(r, 8))
+		pids = [read(), read(), read()]
+		self.assertEqual(len(set(pids)), 3)
+		# a worker that dies is replaced
+		os.kill(pids[0], signal.SIGKILL)
+		pids.append(read())
+		self.assertFalse(pids[3] in pids[:3])
+		# stopping the supervisor stops the workers
+		os.kill(supervisor, signal.SIGTERM)
+		(_, status) = os.waitpid(supervisor, 0)
+		self.assertEqual(status, 0)
+		for pid in pids[1:]:
+			self.assertRaises(OSError, os.kill, pid, 0)
+		# every worker was reaped, the one that died and those stopped
+		data = ''
+		while True:
+			chunk = os.read(reaped, 64)
+			if not chunk:
+				break
+			data += chunk
+		self.assertEqual(sorted(int(data[i:i + 8]) for i in xrange(0, len(data), 8)), sorted(pids))
+		os.close(r)
+		os.close(reaped)
+
+if __name__ == '__main__':
+	import logging
+	# suppress logging for unit tests
+	logging.disable(logging.CRITICAL)
+	# run from the same directory as the module
+	os.chdir(os.path.dirname(os.path.abspath(sys.argv[0])))
+	sys.exit(unittest.main(verbosity=2))
@@ -8,24 +8,30 @@ import os
 import re
 import sys
 import time
+import types
+import urllib
 import uuid
 import web
 from recaptcha.client import captcha
 
-## The directory where the project is run from
-rootdir = os.path.dirname(os.path.abspath(sys.argv[0]))
+## The directory of the service, which relative paths are resolved against
+rootdir = os.path.dirname(os.path.abspath(__file__))
 
 ## Make sure that the service can find its libraries
 sys.path.append(os.path.join(rootdir, 'lib'))
 
 # local modules
 import config
+import csrf
 import db
+import metrics
 import scp
+import sessions
+import workers
 from log import l, exceptions
 
 ## Set the path to our configuration
-configfile = os.path.join('ctf-data/ctf.yaml')
+configfile = os.path.join(rootdir, 'ctf-data/ctf.yaml')
 # Set a hook to log uncaught exceptions
 sys.excepthook = exceptions
 
@@ -37,18 +43,51 @@ urls = (
 	'/logoff', 'logoff',
 	'/checkout', 'checkout',
 	'/purchase', 'purchase',
+	'/search', 'search',
+	'/metrics', 'prometheus',
 )
+## Routes that requests are counted under in the metrics, any other path
+# counts as 'other'
+ROUTES = frozenset(urls[0::2])
 
 RE_USERNAME = re.compile('^\w+$')
 RE_PASSWORD = re.compile('^\w+$')
 RE_CAPTCHA  = re.compile('^\w+$')
 RE_CARDNO   = re.compile('^\d{16}$')
 RE_NAME     = re.compile('^[a-zA-Z ]+$')
+RE_BOOK_ID  = re.compile('^\d{1,18}$')
+RE_PAGE     = re.compile('^\d{1,3}$')
 
 ## Name of authorization cookie
 COOKIE_NAME = 'ctfauth'
 ## Cookie expiration time, in seconds
 COOKIE_TTL = 300 # five minutes
+## Name of the cookie with the client id that stateless csrf tokens are bound to
+CSRF_COOKIE_NAME = 'ctfcsrf'
+## Number of books on a page of the index
+BOOKS_PER_PAGE = 50
+## Number of books read and sent at a time while the index is streamed
+BOOKS_PER_CHUNK = 10
+## Number of books on a page of search results
+RESULTS_PER_PAGE = 20
+## Number of pages of search results that can be browsed
+RESULTS_PAGES_MAX = 50
+## Clients that may read /metrics when the configuration does not say
+METRICS_ALLOW = ( '127.0.0.1', '::1', )
+
+## Metrics read from the state of a worker, see AppContext.collect()
+METRICS = (
+	( 'ctf_session_requests_total', 'counter', 'Requests seen by the session, by path.', ),
+	( 'ctf_session_loads_total', 'counter', 'Session loads, by path.', ),
+	( 'ctf_session_saves_total', 'counter', 'Session saves, by path.', ),
+	( 'ctf_cache_hits_total', 'counter', 'Cookie key cache hits, by cache.', ),
+	( 'ctf_cache_misses_total', 'counter', 'Cookie key cache misses, by cache.', ),
+	( 'ctf_catalog_hits_total', 'counter', 'Full catalog reads answered from the catalog cache.', ),
+	( 'ctf_catalog_reloads_total', 'counter', 'Reloads of the catalog cache.', ),
+	( 'ctf_db_connections', 'gauge', 'Database connections open.', ),
+	( 'ctf_log_dropped_total', 'counter', 'Log records dropped because the queue was full.', ),
+	( 'ctf_log_suppressed_total', 'counter', 'Log messages suppressed by the rate limit.', ),
+)
 
 ##
 # @brief get information specific to this session.
@@ -68,11 +107,161 @@ def get_session_info():
 #
 # @return 20 byte hash of HTTP session information
 def get_session_hash():
-	values = get_session_info()
-	h = hashlib.sha1()
-	for value in values:
-		h.update(value)
-	return h.digest()
+	return scp.session_hash(get_session_info())
+
+##
+# @brief look up the book a form refers to. Forms carry the book ID, but
+# pages rendered before books had IDs post the full name, which still works.
+#
+# @param field the book form field
+#
+# @return web.storage with ID, Name and Price, or None
+def get_book(field):
+	if RE_BOOK_ID.match(field):
+		return web.ctx.ctf.d.getBook(int(field))
+	return web.ctx.ctf.d.getBook(field)
+
+##
+# @brief Read one page of the catalog for the index in chunks. Next links
+# carry the ID of the last book on the page as after=, previous links the
+# ID of the first book as before=. The cursors for the links are only
+# known once the page has been read, so they are stored in page.
+#
+# @param after cursor of a next link, or ''
+# @param before cursor of a previous link, or ''
+# @param page web.storage that receives prev and next, the cursors for the
+# previous and next links or None
+#
+# @return generator of lists of books
+def iter_book_page(after, before, page):
+	d = web.ctx.ctf.d
+	n = BOOKS_PER_PAGE
+	page.prev = None
+	page.next = None
+	if RE_BOOK_ID.match(before) and not RE_BOOK_ID.match(after):
+		books = d.getBooks(before=int(before), limit=n + 1)
+		if len(books) > n:
+			books = books[1:]
+			page.prev = books[0].ID
+			if d.getBooks(after=books[-1].ID, limit=1):
+				page.next = books[-1].ID
+			for i in xrange(0, n, BOOKS_PER_CHUNK):
+				yield books[i:i + BOOKS_PER_CHUNK]
+			return
+		# there is less than a page before the cursor, show the first page
+	start = int(after) if RE_BOOK_ID.match(after) else None
+	shown = 0
+	last = None
+	# one book more than the page tells whether there is a next page
+	for books in d.iterBooks(after=start, limit=n + 1, batch=BOOKS_PER_CHUNK):
+		if shown + len(books) > n:
+			books = books[:n - shown]
+			page.next = books[-1].ID if books else last
+		if not books:
+			break
+		if start is not None and page.prev is None:
+			page.prev = books[0].ID
+		shown += len(books)
+		last = books[-1].ID
+		yield books
+	if start is not None and page.prev is None:
+		# past the end, the previous link leads to the last page
+		page.prev = start + 1
+
+##
+# @brief Stream the index page: the header, the books of the page in
+# chunks as they are read and then the links and the logoff footer.
+#
+# @param user name of the logged on user
+# @param after cursor of a next link, or ''
+# @param before cursor of a previous link, or ''
+#
+# @return generator of page fragments
+def stream_index(user, after, before):
+	yield unicode(render.index_head(user, web.ctx.ctf.d.searchable))
+	page = web.storage()
+	for books in iter_book_page(after, before, page):
+		yield unicode(render.index_books(books))
+	yield unicode(render.index_foot(page.prev, page.next))
+	yield unicode(render.logoff(''))
+
+##
+# @brief link to a page of search results
+#
+# @param query the search text
+# @param page the page number, or None
+#
+# @return the link, or None if page is None
+def search_link(query, page):
+	if page is None:
+		return None
+	return '/search?' + urllib.urlencode(dict(q=query.encode('utf-8'), page=page))
+
+##
+# @brief Processor that logs every request with its status and duration,
+# see log.CTFLogger.request(), and records its duration and stages in the
+# metrics. A streamed page is recorded once it has been sent.
+#
+# @param handler the rest of the request
+#
+# @return the response
+def track_request(handler):
+	start = time.time()
+	request = metrics.begin()
+	try:
+		result = handler()
+	except web.HTTPError:
+		end_request(request_fields(), start, request)
+		raise
+	except:
+		end_request(request_fields(status=500), start, request)
+		raise
+	fields = request_fields()
+	if isinstance(result, types.GeneratorType):
+		return tracked_stream(result, fields, start, request)
+	end_request(fields, start, request)
+	return result
+
+##
+# @brief The request fields that are known once the handler has returned.
+#
+# @param status the status, if not the one set by the handler
+#
+# @return dictionary of method, route, status and user
+def request_fields(status=None):
+	auth = web.ctx.get('auth')
+	if status is None:
+		status = int(web.ctx.status.split()[0])
+	return dict(method=web.ctx.method, route=web.ctx.path, status=status, user=auth.data if auth else None)
+
+##
+# @brief log a request and record it in the metrics
+#
+# @param fields the result of request_fields()
+# @param start time the request started
+# @param request the metrics.Request of the request
+def end_request(fields, start, request):
+	duration = time.time() - start
+	l.request(duration=duration, **fields)
+	route = fields['route'] if fields['route'] in ROUTES else 'other'
+	metrics.end(fields['method'], route, fields['status'], duration, request=request)
+
+##
+# @brief pass a streamed page on and end the request when it has been sent
+#
+# @param body generator of page fragments
+# @param fields the result of request_fields()
+# @param start time the request started
+# @param request the metrics.Request of the request. The generator may be
+# closed on another thread, which has a request of its own.
+#
+# @return generator of page fragments
+def tracked_stream(body, fields, start, request):
+	try:
+		for chunk in body:
+			yield chunk
+	finally:
+		end_request(fields, start, request)
 
 ##
 # @brief redirect the user to the logon page.
@@ -86,6 +275,15 @@ def logon_redirect():
 def expire_cookie():
 	web.setcookie(COOKIE_NAME, '', -1)
 
+##
+# @brief Get the Secure Cookie Protocol object for this request. It is
+# rebuilt from the session hash and the secret, so nothing about it needs
+# to be kept in the session.
+#
+# @return scp.SecureCookie object
+def get_verifier():
+	return scp.verifier(web.ctx.session_hash, web.ctx.ctf.secret, suite=web.ctx.ctf.cookie_suite)
+
 #
 # @brief Create the global authentication cookie using the Secure Cookie Protocol
 #
@@ -94,29 +292,72 @@ def expire_cookie():
 def create_cookie(guid, data):
 	# this may produce a slight variation in expiration dates between what we set
 	# and what web.py sets, but we really don't care.
-	session.cookie = scp.SecureCookie(get_session_hash(), web.secret)
-	serial = session.cookie.serialize(guid, int(time.time()) + COOKIE_TTL, data)
+	serial = get_verifier().serialize(guid, int(time.time()) + COOKIE_TTL, data)
 	web.setcookie(COOKIE_NAME, serial, COOKIE_TTL, secure=True, httponly=True)
 
+##
+# @brief Verify the authentication cookie once per request.
+# The session hash and the verified cookie are stored in web.ctx so that
+# handlers do not repeat the cryptography. web.ctx.auth holds the
+# scp.Credentials of the cookie, or None if the user is not logged on.
+def load_auth():
+	web.ctx.session_hash = get_session_hash()
+	web.ctx.auth = None
+	serial = web.cookies().get(COOKIE_NAME)
+	if not serial:
+		return
+	web.ctx.auth = get_verifier().verify(serial)
+
 ##
 # @brief Determine whether the user is logged onto the system
 #
 # @return True or False
 def logged_on():
-	cookie = web.cookies().get(COOKIE_NAME)
-	if cookie is None:
-		return False
-	return session.cookie.isValid(cookie)
+	return web.ctx.auth is not None
 
 ##
-# @brief Get the global csrf token, creating it if it does not exist
+# @brief Get the client id that stateless csrf tokens are bound to, see
+# csrf.client_id(). It is kept in a cookie, which is set with a new id if
+# the client does not have a valid one.
 #
-# @return the hex value of the guid
+# @return the client id
+def csrf_client():
+	if 'csrf_client' not in web.ctx:
+		client = web.cookies().get(CSRF_COOKIE_NAME, '')
+		if not csrf.RE_CLIENT.match(client):
+			client = csrf.client_id()
+			web.setcookie(CSRF_COOKIE_NAME, client, secure=True, httponly=True)
+		web.ctx.csrf_client = client
+	return web.ctx.csrf_client
+
+##
+# @brief Get the csrf token for this request, creating it if it does not exist.
+# In stateless mode the token is signed and bound to the session hash and
+# the client id, otherwise it is a random guid kept in the session.
+#
+# @return the token string
 def csrf_token():
+	if web.ctx.ctf.csrf is not None:
+		if 'csrf_token' not in web.ctx:
+			web.ctx.csrf_token = web.ctx.ctf.csrf.token(web.ctx.session_hash, csrf_client())
+		return web.ctx.csrf_token
+	session = web.ctx.ctf.session
 	if 'csrf_token' not in session:
 		session.csrf_token = uuid.uuid4().hex
 	return session.csrf_token
 
+##
+# @brief check the csrf token submitted with a request
+#
+# @param token the submitted token
+#
+# @return True or False
+def csrf_valid(token):
+	if web.ctx.ctf.csrf is not None:
+		return web.ctx.ctf.csrf.check(token, web.ctx.session_hash,
+				web.cookies().get(CSRF_COOKIE_NAME, ''))
+	return token == web.ctx.ctf.session.pop('csrf_token', None)
+
 ##
 # @brief decorator for protecting requests for forgery
 #
@@ -126,7 +367,7 @@ def csrf_token():
 def csrf_protected(f):
 	def decorated(*args, **kwargs):
 		i = web.input()
-		if 'csrf_token' not in i or i.csrf_token != session.pop('csrf_token', None):
+		if 'csrf_token' not in i or not csrf_valid(i.csrf_token):
 			expire_cookie()
 			raise web.HTTPError(
 					"400 Bad Request",
@@ -149,24 +390,28 @@ def add_logoff(f):
 ##
 # @brief The rendering engine, updated with the directory we care about
 # and the csrf token. This allows templates to reference the csrf token.
-render = web.template.render('templates/', globals={'csrf_token':csrf_token})
+# Compiled templates are cached; by default web.py only does that when
+# web.config.debug is off, which is not yet the case when this runs.
+# Rendering is timed as the render stage of the request.
+render = metrics.Timed(web.template.render(os.path.join(rootdir, 'templates/'),
+		globals={'csrf_token':csrf_token}, cache=True), 'render')
 
 ##
 # @brief index page
 class index:
 	##
-	# @brief generate index
+	# @brief generate index. The page is streamed, so anything that sets
+	# headers or touches the session has to happen before it is returned.
 	#
-	# @return the index page.
-	@add_logoff
+	# @return the index page, as a generator of fragments
 	def GET(self):
 		l.info('GET index')
 		if not logged_on():
 			return logon_redirect()
-		books = web.d.getBooks()
-		serial = web.cookies().get(COOKIE_NAME)
-		user = session.cookie.getData(serial)
-		return render.index(user, books)
+		i = web.input(after='', before='')
+		# the session is saved before the body is sent
+		csrf_token()
+		return stream_index(web.ctx.auth.data, i.after, i.before)
 
 
 ##
@@ -179,7 +424,7 @@ class adduser:
 	def GET(self):
 		l.info('GET adduser')
 		expire_cookie()
-		cap = captcha.displayhtml(web.captcha_public_key, use_ssl=True, error="Something broke.")
+		cap = captcha.displayhtml(web.ctx.ctf.captcha_public_key, use_ssl=True, error="Something broke.")
 		return render.adduser(cap)
 	##
 	# @brief create a new user
@@ -211,16 +456,17 @@ class adduser:
 			l.warn("passwords don't match. not creating user.")
 			return render.error(web.ctx.fullpath, 'BADREQ', 'password mismatch')
 		if not RE_USERNAME.match(username):
-			l.warn('username does not match %s' % RE_USERNAME.pattern)
+			l.warn('username does not match %s', RE_USERNAME.pattern)
 			return render.error(web.ctx.fullpath, 'BADREQ', 'malformed username')
 		if not RE_PASSWORD.match(password):
-			l.warn('password does not match %s' % RE_PASSWORD.pattern)
+			l.warn('password does not match %s', RE_PASSWORD.pattern)
 			return render.error(web.ctx.fullpath, 'BADREQ', 'malformed password')
 		challenge = i['recaptcha_challenge_field']
 		response = i['recaptcha_response_field']
-		result = captcha.submit(challenge, response, web.captcha_private_key, web.ctx.ip)
+		with metrics.timer('captcha'):
+			result = captcha.submit(challenge, response, web.ctx.ctf.captcha_private_key, web.ctx.ip)
 		if result.error_code:
-			l.warn('error validating captcha: %s' % result.error_code)
+			l.warn('error validating captcha: %s', result.error_code)
 			return render.error(web.ctx.fullpath, 'BADREQ', 'bad captcha: %s' % result.error_code)
 		if not result.is_valid:
 			l.warn('invalid captcha')
@@ -230,8 +476,8 @@ class adduser:
 		h.update(password)
 		# hash with salt
 		h.update(username)
-		l.debug('Creating new user %s' % username)
-		guid = web.d.addUser(username, h.hexdigest())
+		l.debug('Creating new user %s', username)
+		guid = web.ctx.ctf.d.addUser(username, h.hexdigest())
 		if not guid:
 			return render.error(web.ctx.fullpath, 'EXISTS', 'username exists')
 		create_cookie(str(guid), username)
@@ -266,17 +512,17 @@ class logon:
 		username = str(i['username'])
 		password = str(i['password'])
 		if not RE_USERNAME.match(username):
-			l.warn('username does not match %s' % RE_USERNAME.pattern)
+			l.warn('username does not match %s', RE_USERNAME.pattern)
 			return render.error(web.ctx.fullpath, 'BADREQ', 'malformed username')
 		if not RE_PASSWORD.match(password):
-			l.warn('password does not match %s' % RE_PASSWORD.pattern)
+			l.warn('password does not match %s', RE_PASSWORD.pattern)
 			return render.error(web.ctx.fullpath, 'BADREQ', 'malformed password')
 		h = hashlib.sha1()
 		# hash password
 		h.update(password)
 		# hash with salt
 		h.update(username)
-		db_guid = web.d.getValidUser(username, h.hexdigest())
+		db_guid = web.ctx.ctf.d.getValidUser(username, h.hexdigest())
 		if not db_guid:
 			# invalid credentials
 			return logon_redirect()
@@ -323,10 +569,10 @@ class checkout():
 		if 'book' not in i:
 			l.error('book required for POST')
 			return web.seeother('/')
-		book = i['book']
-		serial = web.cookies().get(COOKIE_NAME)
-		user = session.cookie.getData(serial)
-		return render.checkout(user, book)
+		book = get_book(i['book'])
+		if book is None:
+			return render.error(web.ctx.fullpath, 'BADREQ', 'unknown book')
+		return render.checkout(web.ctx.auth.data, book)
 
 ##
 # @brief purchase page
@@ -374,43 +620,226 @@ class purchase():
 			return render.error(web.ctx.fullpath, 'BADREQ', 'missing book')
 		name = i['name']
 		card = i['card']
-		book = i['book']
 		if not RE_NAME.match(name):
-			l.warn('name does not match %s' % RE_NAME.pattern)
+			l.warn('name does not match %s', RE_NAME.pattern)
 			return render.error(web.ctx.fullpath, 'BADREQ', 'malformed name')
 		if not RE_CARDNO.match(card):
-			l.warn('name does not match %s' % RE_CARDNO.pattern)
+			l.warn('name does not match %s', RE_CARDNO.pattern)
 			return render.error(web.ctx.fullpath, 'BADREQ', 'malformed card')
-		price = web.d.getPrice(book)
-		l.critical("getting cookie")
-		serial = web.cookies().get(COOKIE_NAME)
-		l.critical("got serial")
-		user = session.cookie.getData(serial)
-		l.critical("got cookie")
-		return render.purchase(user, name, card, book, price)
+		book = get_book(i['book'])
+		if book is None:
+			return render.error(web.ctx.fullpath, 'BADREQ', 'unknown book')
+		return render.purchase(web.ctx.auth.data, name, card, book.Name, book.Price)
+
+##
+# @brief search the catalog
+class search:
+	##
+	# @brief display a page of the books whose names match the query, best
+	# matches first
+	#
+	# @return the search page
+	@add_logoff
+	def GET(self):
+		l.info('GET search')
+		if not logged_on():
+			return logon_redirect()
+		if not web.ctx.ctf.d.searchable:
+			return render.error(web.ctx.fullpath, 'UNAVAIL', 'search is not available')
+		i = web.input(q='', page='0')
+		query = i.q[:db.SEARCH_TERMS_MAX * 32]
+		if not RE_PAGE.match(i.page) or int(i.page) >= RESULTS_PAGES_MAX:
+			return render.error(web.ctx.fullpath, 'BADREQ', 'malformed page')
+		page = int(i.page)
+		n = RESULTS_PER_PAGE
+		# one book more than the page tells whether there is a next page
+		books = web.ctx.ctf.d.search(query, offset=page * n, limit=n + 1)
+		if books is None:
+			# too many matches to rank in time
+			return render.search(web.ctx.auth.data, query, '', None, None, None)
+		prev_page = page - 1 if page > 0 else None
+		next_page = page + 1 if len(books) > n and page + 1 < RESULTS_PAGES_MAX else None
+		books = books[:n]
+		return render.search(web.ctx.auth.data, query, render.index_books(books), len(books),
+				search_link(query, prev_page), search_link(query, next_page))
+
+##
+# @brief request metrics in the Prometheus text format, for the clients
+# allowed by the configuration. With pre-forked workers the metrics of
+# all of them are added up.
+class prometheus:
+	##
+	# @return the metrics
+	def GET(self):
+		ctf = web.ctx.ctf
+		if web.ctx.ip not in ctf.metrics_allow:
+			raise web.notfound()
+		web.header('Content-Type', metrics.CONTENT_TYPE)
+		return metrics.REGISTRY.render(ctf.metrics_dir)
+
+##
+# @brief State of one instance of the service: the configuration and keys
+# loaded by the constructor, and the database and session store opened per
+# process by open(). Handlers reach it through web.ctx.ctf, so nothing is
+# kept in module globals or on the web module.
+class AppContext(object):
+	##
+	# @brief load the configuration and the keys
+	#
+	# @param config_path path to the configuration file
+	# @param root directory that relative paths in the configuration are
+	# resolved against. Defaults to the directory of this file.
+	def __init__(self, config_path, root=None):
+		self.root = root or rootdir
+		c = config.Configurator()
+		c.load(config_path, root=self.root)
+		self.config = c
+		l.__init__(c.log, level=c.lvl, format=c.log_format, queue=c.log_queue, overflow=c.log_overflow,
+				rotate_size=c.log_rotate_size, rotate_interval=c.log_rotate_interval,
+				rotate_keep=c.log_rotate_keep, limit_burst=c.log_limit_burst,
+				limit_window=c.log_limit_window, limit_sample=c.log_limit_sample)
+		if not c.db or not os.path.exists(c.db):
+			l.die("Failed to initialize database.")
+		try:
+			self.secret = c.secret
+		except IOError:
+			l.die("Failed to initialize secret key.")
+		self.cookie_suite = c.cookie_suite or 'legacy'
+		if self.cookie_suite not in scp.suites():
+			l.critical("Cookie cipher suite %s is not available, using legacy." % self.cookie_suite)
+			self.cookie_suite = 'legacy'
+		self.csrf = None
+		if c.csrf_mode == 'stateless':
+			self.csrf = csrf.CSRF(self.secret, ttl=c.csrf_ttl or csrf.CSRF_TTL,
+					single_use=c.csrf_single_use is not False)
+		self.captcha_public_key = c.captcha_public_key
+		self.captcha_private_key = c.captcha_private_key
+		if not self.captcha_public_key:
+			l.critical("SECURITY ERROR: Could not get captcha public key")
+		if not self.captcha_private_key:
+			l.critical("SECURITY ERROR: Could not get captcha private key")
+		self.metrics_allow = frozenset(c.metrics_allow or METRICS_ALLOW)
+		self.metrics_dir = c.metrics_dir
+		self.d = None
+		self.session = None
+	##
+	# @brief create the web.py application bound to this context
+	#
+	# @return web.application object
+	def application(self):
+		web.config.debug = False
+		app = web.application(urls, globals(), autoreload=False)
+		app.add_processor(web.loadhook(self._bind))
+		app.add_processor(track_request)
+		return app
+	##
+	# @brief make this context available to the handlers of a request
+	def _bind(self):
+		web.ctx.ctf = self
+	##
+	# @brief Set up the per-process state of the service: the database
+	# connection, the session and the sharing of the metrics. With
+	# pre-forked workers this runs in each worker after the fork, so that no
+	# connection is shared between processes.
+	#
+	# @param app the application returned by application()
+	def open(self, app):
+		c = self.config
+		try:
+			self.d = db.DB(c.db, pool=c.threads or db.POOL_SIZE, pragmas=c.db_pragmas)
+		except IOError:
+			l.die("Failed to initialize database.")
+		web.config.session_parameters.timeout = c.session_ttl or sessions.SESSION_TTL
+		if c.session_store == 'memory':
+			store = sessions.MemoryStore(size=c.session_size or sessions.SESSION_MAX,
+					ttl=web.config.session_parameters.timeout)
+		elif c.session_store == 'sqlite':
+			store = sessions.SQLiteStore(self.d.xec, ttl=web.config.session_parameters.timeout,
+					sweep=c.session_sweep if c.session_sweep is not None else sessions.SWEEP_INTERVAL)
+		else:
+			store = web.session.DiskStore(os.path.join(self.root, 'ctf-data/sessions'))
+		self.session = sessions.LazySession(app, store)
+		app.add_processor(web.loadhook(load_auth))
+		for (name, kind, text) in METRICS:
+			metrics.REGISTRY.describe(name, kind, text)
+		metrics.REGISTRY.collector('service', self.collect)
+		if self.metrics_dir:
+			metrics.REGISTRY.share(self.metrics_dir, interval=c.metrics_interval or metrics.SHARE_INTERVAL)
+	##
+	# @brief read the counters that the database, the session, the cookie
+	# caches and the logger keep, for the metrics
+	#
+	# @return list of tuples (name, labels, value), see METRICS
+	def collect(self):
+		samples = []
+		with self.session._stats_lock:
+			stats = self.session.stats.items()
+		for (path, counts) in stats:
+			labels = ( ( 'path', path ), )
+			samples.append(( 'ctf_session_requests_total', labels, counts[0], ))
+			samples.append(( 'ctf_session_loads_total', labels, counts[1], ))
+			samples.append(( 'ctf_session_saves_total', labels, counts[2], ))
+		for (name, cache) in ( ( 'keys', scp.SecureCookie.keys, ), ( 'verifiers', scp.VERIFIERS, ), ):
+			samples.append(( 'ctf_cache_hits_total', ( ( 'cache', name ), ), cache.hits, ))
+			samples.append(( 'ctf_cache_misses_total', ( ( 'cache', name ), ), cache.misses, ))
+		samples.append(( 'ctf_catalog_hits_total', (), self.d.catalog_hits, ))
+		samples.append(( 'ctf_catalog_reloads_total', (), self.d.catalog_reloads, ))
+		samples.append(( 'ctf_db_connections', (), self.d.opened, ))
+		samples.append(( 'ctf_log_dropped_total', (), l.dropped, ))
+		samples.append(( 'ctf_log_suppressed_total', (), l.limiter.suppressed if l.limiter else 0, ))
+		return samples
+
+##
+# @brief Create the service as a WSGI application, for running it under
+# any WSGI server or driving it in-process.
+#
+# @param config_path path to the configuration file
+# @param root directory that relative paths in the configuration are
+# resolved against. Defaults to the directory of this file.
+#
+# @return WSGI callable
+def create_app(config_path=None, root=None):
+	context = AppContext(config_path or configfile, root)
+	app = context.application()
+	context.open(app)
+	return app.wsgifunc()
+
+##
+# @brief Serve the application in this process. Under FastCGI requests are
+# handled by at most threads threads; each borrows a connection from the
+# database pool, which has the same size, while it runs a query.
+#
+# @param app the application returned by AppContext.application()
+# @param threads maximum number of serving threads
+def serve(app, threads):
+	if not workers.inherited_socket():
+		return app.run()
+	import flup.server.fcgi as flups
+	flups.WSGIServer(app.wsgifunc(), multiplexed=True, bindAddress=None,
+			debug=False, maxThreads=threads).run()
 
 if __name__ == "__main__":
-	# run from the same directory as the service file
-	os.chdir(rootdir)
-	c = config.Configurator()
-	c.load(configfile)
-	l.__init__(c.log, level=c.lvl)
-	try:
-		web.d = db.DB(c.db)
-	except IOError:
-		l.die("Failed to initialize database.")
-	try:
-		web.secret = c.secret
-	except IOError:
-		l.die("Failed to initialize secret key.")
-	web.captcha_public_key = c.captcha_public_key
-	web.captcha_private_key = c.captcha_private_key
-	if not web.captcha_public_key:
-		l.critical("SECURITY ERROR: Could not get captcha public key")
-	if not web.captcha_private_key:
-		l.critical("SECURITY ERROR: Could not get captcha private key")
+	context = AppContext(configfile)
 	l.info("Starting web service.")
-	web.config.debug = False
-	app = web.application(urls, globals())
-	session = web.session.Session(app, web.session.DiskStore('ctf-data/sessions'))
-	app.run()
+	app = context.application()
+	# lighttpd passes the worker count derived from the number of cores
+	nworkers = workers.count(os.environ.get('CTF_WORKERS') or context.config.workers)
+	# workers can only share a socket that was handed to us
+	nthreads = context.config.threads or db.POOL_SIZE
+	if nworkers == 1 or not workers.inherited_socket():
+		context.open(app)
+		serve(app, nthreads)
+	else:
+		if context.config.session_store == 'memory':
+			# each worker would have its own sessions, and requests of one
+			# user go to any of them
+			l.die("The memory session store cannot be shared by %d workers, "
+					"set server: workers to 1 or use another store." % nworkers)
+		def worker():
+			context.open(app)
+			serve(app, nthreads)
+		reap = None
+		if context.metrics_dir:
+			# workers stopped by a signal cannot remove their own snapshot
+			reap = lambda pid: metrics.remove_snapshot(context.metrics_dir, pid)
+		workers.Prefork(nworkers, worker, reap=reap).run()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+## @package loganalyze
+# Per-route request statistics from JSON service logs.
+#
+# Reads the request records that the service writes with log: format:
+# json, from the given files or stdin, in one pass. Rotated .gz files are
+# read as they are. For every method and route it prints the number of
+# requests, the share of 4xx and 5xx responses and latency percentiles.
+# Latencies are counted in logarithmic buckets that are 1% wide, so
+# memory does not grow with the size of the logs and the percentiles are
+# within 1%. Uncompressed files are split into ranges that are read by
+# parallel processes.
+#
+# Usage: python loganalyze.py [--since SECONDS] [--route ROUTE] [-j JOBS] [files]
+# e.g.   python loganalyze.py --since 3600 --route /purchase ctf-data/ctf.log
+
+# system modules
+import argparse
+import gzip
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+sys.dont_write_byte_code = True
+
+## Relative width of a latency bucket
+BUCKET_WIDTH = 0.01
+## Latencies below this many milliseconds share the first bucket
+BUCKET_MIN = 0.001
+## Percentiles that are printed
+PERCENTILES = ( 50, 90, 99, )
+## The fields of a request record. A match cannot start inside a string,
+# where quotes are escaped.
+RE_FIELD = re.compile(r'"(method|route|status|ts|duration)":("(?:[^"\\]|\\.)*"|[-+\d.eE]+)')
+## Smallest range of a file given to a process
+CHUNK_MIN = 1 << 24
+
+##
+# @brief Latency distribution in logarithmic buckets
+class Histogram:
+	LOG_WIDTH = math.log(1 + BUCKET_WIDTH)
+	def __init__(self):
+		self.buckets = {}
+		self.count = 0
+		self.max = 0.0
+	##
+	# @param ms a latency, in milliseconds
+	def add(self, ms):
+		i = int(math.log(ms / BUCKET_MIN) / self.LOG_WIDTH) if ms > BUCKET_MIN else 0
+		self.buckets[i] = self.buckets.get(i, 0) + 1
+		self.count += 1
+		if ms > self.max:
+			self.max = ms
+	##
+	# @brief add the latencies of another histogram
+	def merge(self, other):
+		for (i, n) in other.buckets.iteritems():
+			self.buckets[i] = self.buckets.get(i, 0) + n
+		self.count += other.count
+		self.max = max(self.max, other.max)
+	##
+	# @param p percentile, 0 to 100
+	#
+	# @return the upper bound of the bucket holding the percentile, in
+	# milliseconds, at most the largest latency
+	def percentile(self, p):
+		rank = math.ceil(self.count * p / 100.0)
+		seen = 0
+		for i in sorted(self.buckets):
+			seen += self.buckets[i]
+			if seen >= rank:
+				return min(BUCKET_MIN * (1 + BUCKET_WIDTH) ** (i + 1), self.max)
+		return self.max
+
+##
+# @brief Statistics of one method and route
+class Route:
+	def __init__(self):
+		self.latency = Histogram()
+		self.client_errors = 0
+		self.server_errors = 0
+	def add(self, status, ms):
+		self.latency.add(ms)
+		if 400 <= status < 500:
+			self.client_errors += 1
+		elif status >= 500:
+			self.server_errors += 1
+	def merge(self, other):
+		self.latency.merge(other.latency)
+		self.client_errors += other.client_errors
+		self.server_errors += other.server_errors
+
+##
+# @brief open a log file, '-' for stdin
+def open_log(path):
+	if path == '-':
+		return sys.stdin
+	if path.endswith('.gz'):
+		return gzip.open(path)
+	return open(path)
+
+##
+# @brief the lines of a byte range of a file. A range starts after the
+# first newline before start, unless that is 0, and ends with the line
+# that runs past end, so that consecutive ranges cover every line once.
+#
+# @return generator of lines
+def lines(path, start, end):
+	with open(path) as f:
+		if start:
+			f.seek(start - 1)
+			f.readline()
+		while f.tell() < end:
+			line = f.readline()
+			if not line:
+				return
+			yield line
+
+##
+# @brief collect the request records of log lines
+#
+# @param lines iterable of log lines
+# @param since only count records at or after this time, seconds since the
+# epoch, or None
+# @param route only count this route, or None
+#
+# @return tuple (dictionary of (method, route) => Route, number of request
+# records that could not be read)
+def analyze(lines, since=None, route=None):
+	routes = {}
+	bad = 0
+	for line in lines:
+		# only request records have a route
+		if '"route"' not in line:
+			continue
+		fields = dict(RE_FIELD.findall(line))
+		try:
+			key = (json.loads(fields['method']), json.loads(fields['route']))
+			(ts, status, ms) = (float(fields['ts']), int(fields['status']), float(fields['duration']))
+		except (ValueError, KeyError):
+			bad += 1
+			continue
+		if since is not None and ts < since:
+			continue
+		if route is not None and key[1] != route:
+			continue
+		stats = routes.get(key)
+		if stats is None:
+			stats = routes[key] = Route()
+		stats.add(status, ms)
+	return (routes, bad)
+
+##
+# @brief analyze() a byte range of a file, in a worker process
+def analyze_range(args):
+	(path, start, end, since, route) = args
+	return analyze(lines(path, start, end), since=since, route=route)
+
+##
+# @brief split the work into byte ranges of plain files for the worker
+# processes, and the rest
+#
+# @param paths the log files
+# @param jobs number of processes
+#
+# @return tuple (list of (path, start, end), list of paths read whole)
+def split(paths, jobs):
+	ranges = []
+	whole = []
+	for path in paths:
+		if path == '-' or path.endswith('.gz') or jobs < 2:
+			whole.append(path)
+			continue
+		size = os.path.getsize(path)
+		step = max(CHUNK_MIN, size // jobs + 1)
+		ranges.extend([ (path, start, min(start + step, size)) for start in xrange(0, size, step) ])
+	return (ranges, whole)
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Per-route request statistics from JSON service logs.')
+	parser.add_argument('--since', type=float, default=None, help='only the last SECONDS')
+	parser.add_argument('--route', default=None, help='only this route, e.g. /purchase')
+	parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes, defaults to the number of CPUs')
+	parser.add_argument('files', nargs='*', default=[ '-' ])
+	args = parser.parse_args(argv[1:])
+	since = time.time() - args.since if args.since is not None else None
+	jobs = args.jobs or multiprocessing.cpu_count()
+	(ranges, whole) = split(args.files or [ '-' ], jobs)
+	results = []
+	if ranges:
+		pool = multiprocessing.Pool(min(jobs, len(ranges)))
+		results = pool.imap_unordered(analyze_range, [ r + (since, args.route) for r in ranges ])
+	results = itertools.chain(results, ( analyze(open_log(path), since=since, route=args.route) for path in whole ))
+	routes = {}
+	bad = 0
+	for (part, n) in results:
+		bad += n
+		for (key, stats) in part.iteritems():
+			if key in routes:
+				routes[key].merge(stats)
+			else:
+				routes[key] = stats
+	print '%-6s %-12s %10s %7s %7s' % ('method', 'route', 'requests', '4xx %', '5xx %') + \
+			''.join([ ' %9s' % ('p%d ms' % p) for p in PERCENTILES ]) + ' %9s' % 'max ms'
+	for (key, stats) in sorted(routes.items()):
+		n = stats.latency.count
+		print '%-6s %-12s %10d %7.2f %7.2f' % (key[0], key[1], n,
+				100.0 * stats.client_errors / n, 100.0 * stats.server_errors / n) + \
+				''.join([ ' %9.2f' % stats.latency.percentile(p) for p in PERCENTILES ]) + \
+				' %9.2f' % stats.latency.max
+	if bad:
+		print >> sys.stderr, '%d malformed request records skipped' % bad
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+## @package migratedb
+# Upgrade the service database to the current schema in place.
+#
+# Opening a db.DB runs any missing migrations, so the service does this on
+# startup as well; this tool lets an install do it up front and report the
+# version.
+#
+# Usage: python migratedb.py ctf.db
+
+# system modules
+import argparse
+import os
+import sys
+
+sys.dont_write_byte_code = True
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'document-root', 'lib'))
+
+# local modules
+import db
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Upgrade the service database schema in place.')
+	parser.add_argument('db', help='database file')
+	args = parser.parse_args(argv[1:])
+	try:
+		d = db.DB(args.db, pool=1)
+	except IOError:
+		return 1
+	print '%s: schema version %d' % (args.db, d.version)
+	return 0 if d.version == db.SCHEMA_VERSION else 1
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
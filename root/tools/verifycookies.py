@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+## @package verifycookies
+# Offline verification of captured ctfauth cookies.
+#
+# Reads one cookie per line from the given files, or stdin. A line may be
+# prefixed with the hex session ID the cookie was issued to and a tab;
+# otherwise --session is used. Version 1 cookies, which are binary, must be
+# hex encoded. Prints one line per cookie, then a summary on stderr.
+#
+# Usage: python verifycookies.py --secret ctf.aes [--session HEX] [files]
+
+# system modules
+import argparse
+import fileinput
+import os
+import sys
+import time
+
+sys.dont_write_byte_code = True
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'document-root', 'lib'))
+
+# local modules
+import scp
+
+##
+# @brief parse input lines into cookies for scp.verify_many()
+#
+# @param lines iterable of text lines
+#
+# @return generator of cookie streams or (session, cookie) tuples
+def cookies(lines):
+	for line in lines:
+		line = line.strip()
+		if not line:
+			continue
+		session = None
+		if '\t' in line:
+			(session, line) = line.split('\t', 1)
+			session = unhex(session)
+		if len(line) == 2 * scp.V1_STRUCT.size:
+			decoded = unhex(line)
+			if not scp.RE_B64.match(decoded):
+				line = decoded
+		yield line if session is None else (session, line)
+
+##
+# @brief decode a hex string
+#
+# @param text the string
+#
+# @return the decoded bytes, or text as it is if it is not hex, so that a
+# malformed line is reported as an invalid cookie instead of stopping the run
+def unhex(text):
+	try:
+		return text.decode('hex')
+	except TypeError:
+		return text
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Verify captured ctfauth cookies.')
+	parser.add_argument('--secret', required=True, help='file holding the server secret')
+	parser.add_argument('--session', default='', help='hex session ID for lines without one')
+	parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes, defaults to the number of CPUs')
+	parser.add_argument('-q', '--quiet', action='store_true', help='only print the summary')
+	parser.add_argument('files', nargs='*')
+	args = parser.parse_args(argv[1:])
+	with open(args.secret) as f:
+		secret = f.read()
+	start = time.time()
+	counts = { True: 0, False: 0 }
+	results = scp.verify_many(cookies(fileinput.input(args.files)), secret,
+			session=args.session.decode('hex'), processes=args.jobs)
+	for (cookie, v) in results:
+		counts[v is not None] += 1
+		if args.quiet:
+			continue
+		if v is None:
+			print 'invalid'
+		else:
+			print 'valid\t%s\t%d\t%s' % (v.user, v.expiration, v.data.encode('string_escape'))
+	elapsed = time.time() - start
+	total = counts[True] + counts[False]
+	sys.stderr.write('%d cookies, %d valid, %d invalid in %.1fs (%.0f/s)\n' %
+			(total, counts[True], counts[False], elapsed, total / max(elapsed, 1e-9)))
+	return 0 if counts[False] == 0 else 1
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))